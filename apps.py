@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class PapernetConfig(AppConfig):
     name = 'papernet'
+
+    def ready(self):
+        # Connect the search index's signal handlers
+        from papernet import search  # noqa: F401
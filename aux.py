@@ -11,10 +11,11 @@ from django.db.models.query import QuerySet
 from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied
 
-from papernet import sources, query
+from papernet import sources, query, search, serializers
 from papernet.sources import crossref
 from papernet import models
 from papernet.data import cleaning
+from papernet.graph import GraphNotReady
 from papernet.models import Reader, Project, Paper, Perusal, Reference
 
 logger = logging.getLogger(__name__)
@@ -148,14 +149,17 @@ def get_reader_top(reader, data=False):
     authors = query.top_authors_for_reader(reader)
     latest = query.latest_papers_for_reader(reader, authors, journals)
 
-    reader_papers = Paper.objects.filter(pk__in=reader.perusal_set.all())
-    top = query.get_similar_papers(reader_papers)
+    reader_papers = Paper.objects.filter(perusal__reader=reader).distinct()
+    try:
+        top = query.get_similar_papers(reader_papers)
+    except GraphNotReady:
+        top = []
 
     if data is True:
         journals = [j.data for j in journals]
-        authors = [a.data for a in authors]
-        latest = [p.preview for p in latest]
-        top = [p.data for p, c in top]
+        authors = serializers.author_data(authors)
+        latest = serializers.paper_previews(latest)
+        top = serializers.paper_data([p for p, c in top])
 
     return {"journals": journals, "authors": authors,
             "latest": latest, "top": top}
@@ -185,7 +189,7 @@ def get_work(doi_raw, retrieve=True):
         return
 
     logger.info("Retrieving paper: %s", doi)
-    data = crossref.get_work(doi)
+    data = sources.get_work(doi).data
 
     if data.get('DOI') is None:
         raise ValueError("DOI (%s) returned bad data: %s" % doi, data)
@@ -197,7 +201,7 @@ def get_work(doi_raw, retrieve=True):
 
 def add_work(data, citations=True, force=False):
     """Add work to database from crossref data"""
-    doi = data['DOI']
+    doi = cleaning.clean_doi(data['DOI'])
     paper, created = Paper.objects.get_or_create(doi=doi)
 
     if not created and not force:
@@ -205,7 +209,8 @@ def add_work(data, citations=True, force=False):
         if paper.retrieved and not force:
             return paper
 
-    paper.from_crossref(data)
+    # Saved and indexed below, once authors and journal are stored
+    paper.from_crossref(data, save=False)
 
     # Authors
     paper.retrieve_authors(data.get('author', []))
@@ -244,6 +249,8 @@ def add_work(data, citations=True, force=False):
         _ = get_cited_by(paper)
 
     paper.save()
+
+    search.index_papers([paper.pk])
     return paper
 
 
@@ -256,6 +263,8 @@ def get_cited_by(paper, retrieve=False):
     logger.debug("Retrieved %s citations for %s", len(citation_data), paper)
 
     cited_doi = paper.doi
+    citing_pks = []
+    added = 0
 
     for res in citation_data:
 
@@ -277,9 +286,16 @@ def get_cited_by(paper, retrieve=False):
             )
 
             if c:
+                added += 1
                 # Log nonexistence of citing->cited reference
                 if citing is not None:
                     logger.error("Backward reference not found: %s", ref)
+                    citing_pks.append(citing.pk)
+
+    # Keep denormalized counters in step with new References
+    Paper.increment_counts('citations_count', citing_pks)
+    Paper.increment_counts('cited_by_count', [paper.pk] * added)
+    paper.refresh_from_db(fields=models.COUNT_FIELDS)
 
     return citation_data
 
@@ -394,10 +410,30 @@ def get_perusal(paper, project, reader, save=False):
     return perusal
 
 
+def get_perusals(papers, project, reader):
+    """Perusals linking each paper to the project, unsaved if new"""
+    assert project.reader_id == reader.pk
+
+    existing = {perusal.paper_id: perusal for perusal in Perusal.objects.filter(
+        paper__in=[paper.pk for paper in papers], reader=reader,
+        project=project)}
+    perusals = []
+    for paper in papers:
+        perusal = existing.get(paper.pk)
+        if perusal is None:
+            perusal = Perusal(paper=paper, reader=reader, project=project)
+        else:
+            perusal.paper = paper
+        perusals.append(perusal)
+    return perusals
+
+
 def get_paper_metadata(paper, user):
     """Get perusal info for paper"""
     reader = get_reader(user)
-    perusals = Perusal.objects.filter(reader=reader, paper=paper)
+    perusals = Perusal.objects.filter(
+        reader=reader, paper=paper).select_related('project').prefetch_related(
+            'tag_set')
     metadata = [perusal.metadata for perusal in perusals]
     projects = [m['project'] for m in metadata]
     return {"projects": projects, "metadata": metadata}
@@ -0,0 +1,6 @@
+"""
+Benchmarks
+----------
+Synthetic data and measurements for the management commands
+bench_ingest and bench_views
+"""
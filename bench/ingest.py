@@ -0,0 +1,195 @@
+"""
+Ingest benchmarks
+-----------------
+Throughput of storing synthetic crossref works
+
+Each target stores n synthetic works in a transaction that is rolled
+back afterwards, so the database is left as it was. Only the calls
+being benchmarked are timed and have their queries counted; setup,
+such as storing the papers whose citations are added, isn't. COCI
+responses for `get_cited_by` are served from memory.
+"""
+
+import json
+import logging
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+from papernet import aux, ingest
+from papernet.bench import synthetic
+from papernet.bench.measure import (Measure, peak_rss, reset_peak_rss,
+                                    rolled_back)
+from papernet.data import cleaning
+from papernet.models import Journal, Paper
+from papernet.sources import cache, crossref
+from papernet.sources.cassette import Cassette, ReplayAdapter
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+SIZES = [1000, 10000, 100000]
+
+BENCH_URL = "http://bench.invalid/"
+CITATIONS_URL = urljoin(BENCH_URL, "coci/citations/")
+
+REPLAY_HEADERS = {"Content-Type": "application/json",
+                  "X-Rate-Limit-Limit": "100000"}
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+@contextmanager
+def offline_citations(n, seed=0):
+    """Serve COCI citations of the synthetic works without the network"""
+    tape = Cassette(None)
+    cited_by = synthetic.citations(n, seed)
+    for i in range(n):
+        doi = synthetic.doi(i)
+        tape.record(urljoin(CITATIONS_URL, doi), 200, REPLAY_HEADERS,
+                    json.dumps(cited_by.get(doi, [])).encode())
+    del cited_by
+
+    citations_url = crossref.CITATIONS_URL
+    crossref.CITATIONS_URL = CITATIONS_URL
+    crossref.SESSION.mount(BENCH_URL, ReplayAdapter(tape))
+    try:
+        yield tape
+    finally:
+        crossref.CITATIONS_URL = citations_url
+        del crossref.SESSION.adapters[BENCH_URL]
+
+
+def store(n, seed=0):
+    """Store the works without references, returning {doi: Paper}"""
+    ingest.add_works(synthetic.works(n, seed), citations=False)
+    return Paper.objects.filter(
+        doi__startswith=synthetic.DOI_PREFIX).in_bulk(field_name='doi')
+
+
+"""
+Targets
+-------
+Each stores n works, timing calls inside `with measure:`
+"""
+
+
+def bench_add_work(n, seed, measure):
+    """aux.add_work for each work, including references and COCI citations"""
+    with offline_citations(n, seed):
+        for data in synthetic.works(n, seed):
+            with measure:
+                aux.add_work(data)
+
+
+def bench_ingest(n, seed, measure):
+    """ingest.add_chunk over chunks of works"""
+    for chunk in ingest.chunked(synthetic.works(n, seed), ingest.CHUNKSIZE):
+        with measure:
+            ingest.add_chunk(chunk)
+
+
+def bench_add_citations(n, seed, measure):
+    """Paper.add_citations for each stored work"""
+    papers = store(n, seed)
+    for data in synthetic.works(n, seed):
+        paper = papers[data['DOI']]
+        with measure:
+            paper.add_citations(data)
+
+
+def bench_retrieve_authors(n, seed, measure):
+    """Paper.retrieve_authors for each work, on bare papers"""
+    Paper.objects.bulk_create(
+        [Paper(doi=synthetic.doi(i)) for i in range(n)])
+    papers = Paper.objects.filter(
+        doi__startswith=synthetic.DOI_PREFIX).in_bulk(field_name='doi')
+    for data in synthetic.works(n, seed):
+        paper = papers[data['DOI']]
+        with measure:
+            paper.retrieve_authors(data['author'])
+
+
+def bench_get_cited_by(n, seed, measure):
+    """aux.get_cited_by for each stored work"""
+    papers = store(n, seed)
+    with offline_citations(n, seed):
+        for paper in papers.values():
+            with measure:
+                aux.get_cited_by(paper)
+
+
+def bench_journal_from_crossref(n, seed, measure):
+    """Journal.from_crossref for each work with an ISSN"""
+    journals = {}
+    for data in synthetic.works(n, seed):
+        issn = cleaning.get_issn(data)['issn']
+        if not issn:
+            continue
+        if issn not in journals:
+            journals[issn] = Journal.objects.create(issn=issn)
+        journal = journals[issn]
+        with measure:
+            journal.from_crossref(data)
+
+
+TARGETS = {
+    "add_work": bench_add_work,
+    "ingest": bench_ingest,
+    "add_citations": bench_add_citations,
+    "retrieve_authors": bench_retrieve_authors,
+    "get_cited_by": bench_get_cited_by,
+    "journal_from_crossref": bench_journal_from_crossref,
+}
+
+
+"""
+Running
+-------
+"""
+
+
+def run_target(name, n, seed=0):
+    """Run one target on n works, returning its result"""
+    logger.info("Benchmarking %s with %s works", name, n)
+    cache.get_cache().clear()
+    reset_peak_rss()
+
+    measure = Measure()
+    with rolled_back(), measure.counting():
+        TARGETS[name](n, seed, measure)
+
+    return {
+        "target": name,
+        "works": n,
+        "calls": measure.calls,
+        "seconds": round(measure.seconds, 3),
+        "works_per_sec": round(n / measure.seconds, 1)
+        if measure.seconds else None,
+        "queries": measure.queries,
+        "queries_per_work": round(measure.queries / n, 2),
+        "peak_rss_mb": round(peak_rss(), 1),
+    }
+
+
+def compare(results, baseline):
+    """Yield (target, works, speedup, query ratio) against a baseline"""
+    before = {(r['target'], r['works']): r for r in baseline}
+    for result in results:
+        old = before.get((result['target'], result['works']))
+        if old is None:
+            continue
+        speedup = (result['works_per_sec'] / old['works_per_sec']
+                   if old['works_per_sec'] and result['works_per_sec']
+                   else None)
+        queries = (result['queries_per_work'] / old['queries_per_work']
+                   if old['queries_per_work'] else None)
+        yield result['target'], result['works'], speedup, queries
@@ -0,0 +1,127 @@
+"""
+Measurement
+-----------
+Timing, query counts and memory for benchmarks
+"""
+
+import platform
+import resource
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import django
+from django.db import connection, reset_queries, transaction
+from django.utils import timezone as tz
+
+
+"""
+Measure
+-------
+"""
+
+
+class Measure():
+    """Time and SQL queries spent inside `with measure:` blocks
+
+    Queries are only counted while `counting()` is active, so setup
+    done outside the blocks isn't included.
+    """
+
+    def __init__(self):
+        self.seconds = 0
+        self.queries = 0
+        self.calls = 0
+        self._active = False
+        self._start = None
+
+    def __enter__(self):
+        self._active = True
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self._start
+        self.calls += 1
+        self._active = False
+
+    def _count(self, execute, sql, params, many, context):
+        if self._active:
+            self.queries += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def counting(self):
+        with connection.execute_wrapper(self._count):
+            yield self
+
+
+@contextmanager
+def rolled_back():
+    """Run a block in a transaction that is always rolled back"""
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+    reset_queries()
+
+
+"""
+Memory
+------
+"""
+
+
+def reset_peak_rss():
+    """Reset the process's peak RSS, where Linux allows it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """Peak resident set size of the process in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # kB on Linux, bytes on macOS, and never reset
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 1024
+
+
+"""
+Environment
+-----------
+"""
+
+
+def git_commit():
+    """Commit of the papernet checkout, if it is a git repo"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True,
+            cwd=Path(__file__).resolve().parent.parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Details needed to compare results between runs"""
+    return {
+        "commit": git_commit(),
+        "time": tz.now().isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "machine": platform.machine(),
+    }
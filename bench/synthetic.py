@@ -0,0 +1,173 @@
+"""
+Synthetic data
+--------------
+Crossref-shaped works for benchmarks, generated without the network
+
+Work `i` of `n` depends only on (i, n, seed), so works can be streamed
+and regenerated in any order. Distributions roughly follow crossref:
+authors per work and references per work are log-normal, a quarter of
+references have no DOI, names, institutions and journals are drawn
+with a heavy skew so popular ones recur, and older works collect more
+citations.
+"""
+
+import random
+from collections import defaultdict
+
+
+"""
+Constants
+---------
+"""
+
+DOI_PREFIX = "10.5555/bench."
+EXTERNAL_PREFIX = "10.5555/external."
+
+# log-normal (mu, sigma): medians of about 3 authors and 25 references
+AUTHORS_DIST = (1.0, 0.7)
+REFERENCES_DIST = (3.2, 0.8)
+MAX_AUTHORS = 50
+MAX_REFERENCES = 300
+
+# Fractions of references with a DOI and of those cited within the set
+DOI_FRACTION = 0.75
+INTERNAL_FRACTION = 0.6
+
+# Fraction of works with no ISSN
+NO_ISSN_FRACTION = 0.05
+
+SYLLABLES = ["an", "ber", "cal", "dor", "el", "fin", "gar", "hol", "is",
+             "jen", "kov", "lin", "mar", "nor", "ol", "per", "ros", "sch",
+             "ta", "ul", "van", "wil", "xu", "yam", "zh"]
+
+TOPICS = ["language", "memory", "attention", "networks", "learning",
+          "syntax", "semantics", "vision", "reward", "decision", "speech",
+          "reading", "models", "cortex", "development", "evidence"]
+
+ARTICLE_TYPES = ["journal-article"] * 9 + ["proceedings-article"]
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def _skewed(r, n, power=3):
+    """Index in [0, n) favouring low values"""
+    return int(n * r.random() ** power)
+
+
+def _name(k):
+    """Deterministic pronounceable name for k"""
+    r = random.Random(k)
+    return "".join(r.choice(SYLLABLES)
+                   for _ in range(r.randint(2, 3))).capitalize()
+
+
+def _issn(k):
+    """Valid ISSN for journal k"""
+    digits = [int(d) for d in f"{1000000 + k:07d}"[-7:]]
+    check = -sum(d * w for d, w in zip(digits, range(8, 1, -1))) % 11
+    check = "X" if check == 10 else str(check)
+    digits = "".join(map(str, digits))
+    return f"{digits[:4]}-{digits[4:]}{check}"
+
+
+def _lognormal(r, dist, maximum):
+    return min(int(r.lognormvariate(*dist)), maximum)
+
+
+def pools(n):
+    """Sizes of the author, institution and journal pools for n works"""
+    return max(n // 2, 10), max(n // 20, 5), max(n // 100, 5)
+
+
+def doi(i):
+    return f"{DOI_PREFIX}{i}"
+
+
+"""
+Works
+-----
+"""
+
+
+def work(i, n, seed=0):
+    """Crossref work message for work i of n"""
+    r = random.Random(f"{seed}:{n}:{i}")
+    n_authors, n_institutions, n_journals = pools(n)
+
+    authors = []
+    for k in range(max(_lognormal(r, AUTHORS_DIST, MAX_AUTHORS), 1)):
+        a = _skewed(r, n_authors)
+        affiliations = [{"name": f"University of {_name(-1 - b)}"}
+                        for b in {_skewed(r, n_institutions)
+                                  for _ in range(r.choice([0, 1, 1, 2]))}]
+        authors.append({
+            "given": _name(a)[:r.choice([1, 8])],
+            "family": _name(n_authors + a),
+            "sequence": "first" if k == 0 else "additional",
+            "affiliation": affiliations,
+        })
+
+    references = []
+    for k in range(_lognormal(r, REFERENCES_DIST, MAX_REFERENCES)):
+        reference = {"key": f"ref{k}",
+                     "year": str(r.randint(1950, 2024))}
+        if r.random() < DOI_FRACTION:
+            if i and r.random() < INTERNAL_FRACTION:
+                reference["DOI"] = doi(_skewed(r, i, power=2))
+            else:
+                reference["DOI"] = f"{EXTERNAL_PREFIX}{_skewed(r, n * 10)}"
+        else:
+            reference["journal-title"] = f"Journal of {_name(k)}"
+            reference["author"] = _name(r.randrange(n_authors))
+        references.append(reference)
+
+    year = 2024 - _skewed(r, 70, power=2)
+    data = {
+        "DOI": doi(i),
+        "title": [" ".join(r.sample(TOPICS, 4)).capitalize()],
+        "type": r.choice(ARTICLE_TYPES),
+        "author": authors,
+        "reference": references,
+        "references-count": len(references),
+        "is-referenced-by-count": _skewed(r, 500),
+        "issued": {"date-parts": [[year, r.randint(1, 12)]]},
+        "published-print": {"date-parts": [[year, r.randint(1, 12), 1]]},
+        "volume": str(year - 1950),
+        "issue": str(r.randint(1, 12)),
+        "page": f"{r.randint(1, 500)}-{r.randint(501, 900)}",
+    }
+
+    if r.random() >= NO_ISSN_FRACTION:
+        j = _skewed(r, n_journals, power=2)
+        data["ISSN"] = [_issn(j), _issn(n_journals + j)]
+        data["issn-type"] = [{"type": "print", "value": _issn(j)},
+                             {"type": "electronic",
+                              "value": _issn(n_journals + j)}]
+        data["container-title"] = [f"Journal of {_name(j)} Studies"]
+        data["short-container-title"] = [f"J {_name(j)} Stud"]
+    return data
+
+
+def works(n, seed=0):
+    """Yield n works"""
+    for i in range(n):
+        yield work(i, n, seed)
+
+
+def citations(n, seed=0):
+    """COCI citation records citing each work, as {doi: [record]}"""
+    cited_by = defaultdict(list)
+    for data in works(n, seed):
+        for reference in data["reference"]:
+            cited = reference.get("DOI", "")
+            if cited.startswith(DOI_PREFIX):
+                cited_by[cited].append({
+                    "oci": f"{data['DOI']}-{cited}",
+                    "citing": data["DOI"],
+                    "cited": cited,
+                })
+    return cited_by
@@ -0,0 +1,159 @@
+"""
+View benchmarks
+---------------
+Latency and query counts of the slowest pages
+
+A synthetic graph is stored in a transaction that is rolled back
+afterwards, with a reader who has read some of its papers. Each view
+is requested through the Django test client as that reader, and its
+p50/p95 latency and query count recorded. A view whose query count
+exceeds its budget in QUERY_BUDGETS fails, so N+1 queries are caught.
+"""
+
+import logging
+import random
+import time
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from papernet import aux, ingest, views
+from papernet.bench import synthetic
+from papernet.bench.measure import rolled_back
+from papernet.models import Author, Journal, Paper, Perusal
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+PAPERS = 1000
+REPEAT = 20
+
+# Papers the benchmark reader has read
+PERUSALS = 50
+TAGS = ["to read", "methods", "review", "important"]
+
+USERNAME = "papernet-bench"
+
+# Most queries each view may make. Views serialize papers in bulk, so
+# their query counts don't grow with the graph; a query per paper or
+# author shown takes a view well over its budget.
+QUERY_BUDGETS = {
+    "home": 90,
+    "paper_info": 16,
+    "journal_info": 10,
+    "author_info": 20,
+    "project_home": 15,
+    "paper_table": 15,
+}
+
+
+"""
+Seeding
+-------
+"""
+
+
+def seed_graph(n, seed=0):
+    """Store n synthetic works and a reader, returning the reader"""
+    ingest.add_works(synthetic.works(n, seed))
+
+    user = get_user_model().objects.create_user(USERNAME)
+    reader = aux.create_reader(user)
+    project = reader.project_set.get(primary=True)
+
+    r = random.Random(seed)
+    papers = Paper.objects.filter(doi__startswith=synthetic.DOI_PREFIX)
+    pks = list(papers.values_list('pk', flat=True))
+    for pk in r.sample(pks, min(PERUSALS, len(pks))):
+        perusal = Perusal.objects.create(paper_id=pk, reader=reader,
+                                         project=project)
+        for tag in r.sample(TAGS, r.randint(0, 2)):
+            perusal.add_tag(tag)
+    return reader
+
+
+def urls(reader):
+    """{view name: url} for the benchmarked views on the seeded graph"""
+    paper = Paper.objects.order_by('-cited_by_count', 'pk').first()
+    journal = Journal.objects.annotate(n=Count('publication')).order_by(
+        '-n', 'pk').first()
+    author = Author.objects.annotate(n=Count('authorship')).order_by(
+        '-n', 'pk').first()
+    project = reader.project_set.get(primary=True)
+
+    return {
+        "home": reverse(views.home),
+        "paper_info": reverse(views.paper_info, args=[paper.pk]),
+        "journal_info": reverse(views.journal_info, args=[journal.pk]),
+        "author_info": reverse(views.author_info, args=[author.pk]),
+        "project_home": reverse(views.project_home, args=[project.pk]),
+        "paper_table": reverse(views.paper_table),
+    }
+
+
+"""
+Running
+-------
+"""
+
+
+def measure_view(client, url, repeat=REPEAT):
+    """Request url `repeat` times, returning latencies and query counts"""
+    latencies, queries = [], []
+
+    def count(execute, sql, params, many, context):
+        queries[-1] += 1
+        return execute(sql, params, many, context)
+
+    # Warm up caches and lazy imports
+    client.get(url)
+
+    with connection.execute_wrapper(count):
+        for _ in range(repeat):
+            queries.append(0)
+            t0 = time.perf_counter()
+            response = client.get(url)
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                raise ValueError(f"{url} returned {response.status_code}")
+
+    return latencies, queries
+
+
+def run(n=PAPERS, repeat=REPEAT, seed=0, budgets=QUERY_BUDGETS):
+    """Seed a graph of n papers and benchmark each view on it"""
+    results = []
+    setup_test_environment()
+    try:
+        with rolled_back():
+            reader = seed_graph(n, seed)
+            client = Client()
+            client.force_login(reader.user)
+
+            for name, url in urls(reader).items():
+                logger.info("Benchmarking %s: %s", name, url)
+                latencies, queries = measure_view(client, url, repeat)
+                budget = budgets.get(name)
+                results.append({
+                    "view": name,
+                    "url": url,
+                    "papers": n,
+                    "p50_ms": round(np.percentile(latencies, 50) * 1000, 2),
+                    "p95_ms": round(np.percentile(latencies, 95) * 1000, 2),
+                    "queries": max(queries),
+                    "budget": budget,
+                    "ok": budget is None or max(queries) <= budget,
+                })
+    finally:
+        teardown_test_environment()
+    return results
@@ -0,0 +1,156 @@
+"""
+Blobs
+-----
+Append-only segment files of compressed payloads
+
+Payloads are compressed individually with zlib and appended to numbered
+segment files, which roll over at PAPERNET_BLOB_SEGMENT_SIZE bytes.
+A payload is addressed by (segment, offset, length), which
+papernet.models.Blob indexes by content hash. Appends are serialized
+across processes with an exclusive lock file; readers memory-map
+segments and never take the lock.
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+BLOB_DIR = getattr(settings, 'PAPERNET_BLOB_DIR', os.path.join(
+    getattr(settings, 'MEDIA_ROOT', ''), 'papernet', 'blobs'))
+
+SEGMENT_SIZE = getattr(settings, 'PAPERNET_BLOB_SEGMENT_SIZE', 64 * 2 ** 20)
+
+COMPRESS_LEVEL = 6
+READ_CHUNKSIZE = 64 * 2 ** 10
+
+SEGMENT_NAME = "{:06d}.seg"
+SEGMENT_REGEX = re.compile(r"(\d{6})\.seg")
+LOCK_NAME = "LOCK"
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def digest(payload):
+    """Content address of a payload"""
+    return hashlib.sha256(payload).hexdigest()
+
+
+def compress(payload):
+    return zlib.compress(payload, COMPRESS_LEVEL)
+
+
+"""
+Store
+-----
+"""
+
+
+class SegmentStore():
+    """Compressed payloads in append-only segment files"""
+
+    def __init__(self, directory=BLOB_DIR, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+
+    def path(self, segment):
+        return os.path.join(self.directory, SEGMENT_NAME.format(segment))
+
+    def segments(self):
+        """Numbers of the segments on disk, in order"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(m.group(1)) for m in map(
+            SEGMENT_REGEX.fullmatch, os.listdir(self.directory)) if m)
+
+    @contextmanager
+    def locked(self):
+        """Hold the store's write lock (across processes)"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_NAME), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, data):
+        """Append bytes to the last segment, returning (segment, offset)
+
+        Call while holding `locked()`.
+        """
+        segments = self.segments()
+        segment = segments[-1] if segments else 1
+        path = self.path(segment)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+        if offset and offset + len(data) > self.segment_size:
+            segment, offset = segment + 1, 0
+            path = self.path(segment)
+            logger.info("Starting blob segment %s", path)
+
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        return segment, offset
+
+    def view(self, segment, offset, length):
+        """Memoryview of stored (compressed) bytes, without copying"""
+        with self._maps_lock:
+            mapped = self._maps.get(segment)
+            # Segments grow after they are mapped
+            if mapped is None or len(mapped) < offset + length:
+                with open(self.path(segment), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = mapped
+        return memoryview(mapped)[offset:offset + length]
+
+    def stream(self, segment, offset, length, chunksize=READ_CHUNKSIZE):
+        """Yield the decompressed payload in chunks"""
+        data = self.view(segment, offset, length)
+        decompressor = zlib.decompressobj()
+        for start in range(0, length, chunksize):
+            chunk = decompressor.decompress(data[start:start + chunksize])
+            if chunk:
+                yield chunk
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+    def read(self, segment, offset, length):
+        """The decompressed payload"""
+        return zlib.decompress(self.view(segment, offset, length))
+
+
+_store = None
+
+
+def get_store():
+    """Return the process-wide segment store"""
+    global _store
+    if _store is None:
+        _store = SegmentStore()
+    return _store
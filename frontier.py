@@ -0,0 +1,241 @@
+"""
+Crawl frontier
+--------------
+Missing papers cited by stored papers, fetched most valuable first
+
+Each DOI cited by a Reference with no stored paper has one
+FrontierEntry, whose priority is higher the more stored papers cite it
+(log scaled), the more of those are in readers' projects, and the
+longer it has been waiting.
+
+`add` queues the DOIs cited by papers as they are stored, `refresh`
+recounts every entry from References, and `drain` fetches the entries
+with the highest priority, up to PAPERNET_FRONTIER_BUDGET requests at a
+time, storing them with ingest.add_works. Their own references join the
+frontier in turn.
+"""
+
+import logging
+import math
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.utils import timezone as tz
+
+from papernet import graph, ingest, sources
+from papernet.models import FrontierEntry, Paper, Reference
+from papernet.sources.ratelimit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+# Crossref requests made by each drain
+BUDGET = getattr(settings, 'PAPERNET_FRONTIER_BUDGET', 200)
+
+# Priority added for each citing paper in a reader's project, and for
+# each day an entry has been waiting
+PROJECT_WEIGHT = getattr(settings, 'PAPERNET_FRONTIER_PROJECT_WEIGHT', 2.0)
+AGE_WEIGHT = getattr(settings, 'PAPERNET_FRONTIER_AGE_WEIGHT', 0.1)
+
+# Failed fetches before an entry is given up on
+MAX_ATTEMPTS = 3
+
+# Claimed entries not fetched within this time are queued again
+CLAIM_TIMEOUT = tz.timedelta(hours=1)
+
+# DOIs requested concurrently, and per query
+FETCH_CHUNKSIZE = 50
+BATCHSIZE = 500
+
+EPOCH = tz.datetime(2020, 1, 1, tzinfo=tz.utc)
+
+
+"""
+Scoring
+-------
+"""
+
+
+def priority(in_degree, in_projects, first_seen):
+    """Priority of an entry; higher is fetched first
+
+    Every entry ages at the same rate, so rather than adding
+    AGE_WEIGHT * age, which would need updating, AGE_WEIGHT * days from
+    first_seen to EPOCH is added. This orders entries the same way.
+    """
+    days = (EPOCH - first_seen).total_seconds() / 86400
+    return (math.log1p(in_degree) + PROJECT_WEIGHT * in_projects +
+            AGE_WEIGHT * days)
+
+
+def _counts(dois=None):
+    """In-degree and project citations of unstored cited DOIs"""
+    refs = Reference.objects.filter(cited_paper__isnull=True)
+    if dois is not None:
+        refs = refs.filter(cited_doi__in=dois)
+    return refs.values('cited_doi').order_by('cited_doi').annotate(
+        in_degree=Count('citing_doi', distinct=True),
+        in_projects=Count('citing_paper', distinct=True,
+                          filter=Q(citing_paper__perusal__isnull=False)))
+
+
+def _upsert(counts, now):
+    """Create or rescore entries from _counts rows"""
+    counts = list(counts)
+    existing = FrontierEntry.objects.in_bulk(
+        [row['cited_doi'] for row in counts], field_name='doi')
+
+    created, updated = [], []
+    for row in counts:
+        entry = existing.get(row['cited_doi'])
+        if entry is None:
+            entry = FrontierEntry(doi=row['cited_doi'], first_seen=now)
+            created.append(entry)
+        else:
+            updated.append(entry)
+        entry.in_degree = row['in_degree']
+        entry.in_projects = row['in_projects']
+        entry.priority = priority(entry.in_degree, entry.in_projects,
+                                  entry.first_seen)
+        entry.seen = now
+
+    # Entries created meanwhile by another worker are left to it
+    FrontierEntry.objects.bulk_create(created, ignore_conflicts=True)
+    FrontierEntry.objects.bulk_update(
+        updated, ['in_degree', 'in_projects', 'priority', 'seen'])
+    return len(created)
+
+
+def add(dois):
+    """Queue unstored DOIs, rescoring those already queued
+
+    Returns the number of new entries.
+    """
+    now, created = tz.now(), 0
+    for chunk in ingest.chunked(set(dois), BATCHSIZE):
+        created += _upsert(_counts(chunk), now)
+    return created
+
+
+def refresh():
+    """Recount every entry from References
+
+    Entries no longer cited by an unlinked Reference were stored some
+    other way, and are marked done. Stale claims are released.
+    """
+    now = tz.now()
+    created = 0
+    for chunk in ingest.chunked(_counts().iterator(), BATCHSIZE):
+        created += _upsert(chunk, now)
+
+    resolved = FrontierEntry.objects.filter(
+        status="queued", seen__lt=now).update(status="done", error="")
+    released = FrontierEntry.objects.filter(
+        status="claimed", claimed__lt=now - CLAIM_TIMEOUT).update(
+            status="queued", claimed=None)
+    logger.info("Frontier refreshed: %s new, %s resolved, %s released",
+                created, resolved, released)
+    return {"created": created, "resolved": resolved, "released": released}
+
+
+"""
+Draining
+--------
+"""
+
+
+def claim(n):
+    """Take the n highest priority queued entries"""
+    with transaction.atomic():
+        pks = list(FrontierEntry.objects.select_for_update(
+            skip_locked=True).filter(status="queued").order_by(
+                '-priority').values_list('pk', flat=True)[:n])
+        FrontierEntry.objects.filter(pk__in=pks).update(
+            status="claimed", claimed=tz.now())
+    return list(FrontierEntry.objects.filter(pk__in=pks).order_by(
+        '-priority'))
+
+
+def _link(dois):
+    """Link References to papers already stored for dois"""
+    dangling = Reference.objects.filter(cited_paper__isnull=True,
+                                        cited_doi__in=dois)
+    cited = list(dangling.values_list('cited_doi', flat=True).distinct())
+    graph.relinked(dangling.update(cited_paper=Subquery(
+        Paper.objects.filter(doi=OuterRef('cited_doi')).values('pk')[:1])))
+    Paper.refresh_counts(Paper.objects.filter(doi__in=cited))
+
+
+def _fetch(entries, tally):
+    """Fetch and store a chunk of entries, returning False if rate limited"""
+    results = sources.get_work_many([entry.doi for entry in entries])
+    now, works, limited = tz.now(), [], False
+    for entry, result in zip(entries, results):
+        if isinstance(result, RateLimited):
+            entry.status = "queued"
+            entry.claimed = None
+            limited = True
+        elif isinstance(result, Exception):
+            entry.attempts += 1
+            entry.error = str(result)
+            entry.status = ("failed" if entry.attempts >= MAX_ATTEMPTS
+                            else "queued")
+            entry.claimed = None
+            tally['failed'] += 1
+        else:
+            works.append(result.data)
+            entry.status = "done"
+            entry.error = ""
+            entry.fetched = now
+            tally['fetched'] += 1
+
+    tally.update(ingest.add_works(works))
+    FrontierEntry.objects.bulk_update(
+        entries, ['status', 'attempts', 'error', 'claimed', 'fetched'])
+    tally['queued'] += add(ref['DOI'] for work in works
+                           for ref in work.get('reference', [])
+                           if ref.get('DOI'))
+    return not limited
+
+
+def drain(budget=BUDGET):
+    """Fetch up to `budget` of the highest priority entries
+
+    Stops early if crossref rate limits the requests; the entries not
+    fetched are queued again. Returns a Counter of entries fetched,
+    failed and queued, and rows stored.
+    """
+    tally = Counter()
+    entries = claim(budget)
+
+    # Papers stored since they were queued cost no request
+    stored = set(Paper.objects.filter(
+        doi__in=[entry.doi for entry in entries],
+        retrieved__isnull=False).values_list('doi', flat=True))
+    if stored:
+        _link(stored)
+        FrontierEntry.objects.filter(doi__in=stored).update(
+            status="done", error="")
+        tally['skipped'] = len(stored)
+    entries = [entry for entry in entries if entry.doi not in stored]
+
+    for i, chunk in enumerate(ingest.chunked(entries, FETCH_CHUNKSIZE)):
+        tally['requests'] += len(chunk)
+        if not _fetch(chunk, tally):
+            rest = entries[(i + 1) * FETCH_CHUNKSIZE:]
+            FrontierEntry.objects.filter(
+                pk__in=[entry.pk for entry in rest]).update(
+                    status="queued", claimed=None)
+            logger.warning("Frontier drain rate limited after %s requests",
+                           tally['requests'])
+            break
+
+    logger.info("Frontier drained: %s", dict(tally))
+    return tally
@@ -0,0 +1,477 @@
+"""
+Citation Graph
+--------------
+Hold the Reference table as sparse adjacency arrays for fast traversal
+
+Snapshots of the graph are saved as .npy files and memory-mapped by each
+process, so gunicorn and Celery workers share the same pages. Every
+snapshot records the highest Reference pk it contains, and processes
+apply only newer edges on top of it.
+
+Snapshots are built by tasks.save_citation_graph, never in a web
+request. Until the first one is saved get_graph raises GraphNotReady.
+Links made to existing References, once the papers they cite are
+stored, aren't newer edges, so enough of them queue a new snapshot.
+"""
+
+import itertools
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone as tz
+
+from papernet.models import Reference
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+# Seconds between checks for new edges and snapshots
+GRAPH_MAX_AGE = getattr(settings, 'PAPERNET_GRAPH_MAX_AGE', 60 * 10)
+
+GRAPH_DIR = getattr(settings, 'PAPERNET_GRAPH_DIR', os.path.join(
+    getattr(settings, 'MEDIA_ROOT', ''), 'papernet', 'graph'))
+
+# Snapshots kept on disk, including the current one
+GRAPH_KEEP = 2
+
+ARRAYS = ("fwd_indptr", "fwd_indices", "rev_indptr", "rev_indices")
+CURRENT = "CURRENT"
+
+EDGE_CHUNKSIZE = 10000
+
+# References linked to stored papers after they were created that
+# queue a new snapshot
+GRAPH_RELINK_LIMIT = getattr(settings, 'PAPERNET_GRAPH_RELINK_LIMIT', 10000)
+
+# A build queued this long ago without finishing may be queued again
+BUILD_TIMEOUT = 60 * 60
+
+BUILDING_KEY = "papernet:graph:building"
+RELINKED_KEY = "papernet:graph:relinked"
+
+
+class GraphNotReady(Exception):
+    """No graph snapshot has been saved yet; one has been queued"""
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def _compress(rows, cols, n_nodes):
+    """Compressed sparse row arrays for edges rows -> cols
+
+    Nodes are indexed directly by Paper pk, so row `i` of the result
+    holds the neighbours of the paper with pk `i`.
+    """
+    order = np.argsort(rows, kind='stable')
+    indices = cols[order]
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_nodes), out=indptr[1:])
+    return indptr, indices
+
+
+def _gather(indptr, indices, nodes):
+    """Concatenate the neighbours of every node in `nodes`"""
+    nodes = nodes[nodes < len(indptr) - 1]
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    total = int(lengths.sum())
+
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Offset of each output position from its row start
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[shift + np.arange(total)]
+
+
+def _as_nodes(pks):
+    """Unique int64 array from an iterable of pks"""
+    return np.unique(np.fromiter(pks, dtype=np.int64))
+
+
+def load_edges(refs=None):
+    """Return (citing, cited) pk arrays for linked References"""
+    if refs is None:
+        refs = Reference.objects.all()
+
+    refs = refs.filter(citing_paper__isnull=False, cited_paper__isnull=False)
+    rows = refs.values_list('citing_paper_id', 'cited_paper_id')
+    flat = itertools.chain.from_iterable(
+        rows.iterator(chunk_size=EDGE_CHUNKSIZE))
+    edges = np.fromiter(flat, dtype=np.int64).reshape(-1, 2)
+
+    return edges[:, 0], edges[:, 1]
+
+
+def max_reference_pk():
+    """Current high-water mark of the Reference table"""
+    return Reference.objects.aggregate(Max('pk'))['pk__max'] or 0
+
+
+"""
+Graph
+-----
+"""
+
+
+class CitationGraph():
+    """Forward and reverse adjacency of the citation graph
+
+    `fwd` rows list the papers each paper cites (CSR), `rev` rows list
+    the papers citing each paper (CSC of the same matrix). Edges added
+    after `mark` are held in a small in-memory `delta` graph.
+
+    References linked to a paper after they were created (e.g. by
+    `Paper.retrieve_citations`) only appear once a new snapshot is saved.
+    """
+
+    def __init__(self, fwd_indptr, fwd_indices, rev_indptr, rev_indices,
+                 mark=0, path=None):
+        self.fwd_indptr = fwd_indptr
+        self.fwd_indices = fwd_indices
+        self.rev_indptr = rev_indptr
+        self.rev_indices = rev_indices
+        self.mark = mark
+        self.path = path
+        self.delta = None
+        self._delta_edges = (np.empty(0, dtype=np.int64),
+                             np.empty(0, dtype=np.int64))
+
+    def __repr__(self):
+        return (f"<CitationGraph: {self.n_nodes} nodes, {self.n_edges} "
+                f"edges, mark={self.mark}>")
+
+    @property
+    def n_nodes(self):
+        n_nodes = len(self.fwd_indptr) - 1
+        if self.delta is not None:
+            n_nodes = max(n_nodes, self.delta.n_nodes)
+        return n_nodes
+
+    @property
+    def n_edges(self):
+        return len(self.fwd_indices) + len(self._delta_edges[0])
+
+    @classmethod
+    def from_edges(cls, citing, cited, mark=0):
+        """Build a graph from parallel arrays of edges"""
+        citing = np.asarray(citing, dtype=np.int64)
+        cited = np.asarray(cited, dtype=np.int64)
+
+        n_nodes = 0
+        if len(citing):
+            n_nodes = int(max(citing.max(), cited.max())) + 1
+
+        fwd = _compress(citing, cited, n_nodes)
+        rev = _compress(cited, citing, n_nodes)
+        return cls(*fwd, *rev, mark=mark)
+
+    @classmethod
+    def from_db(cls):
+        """Build the graph from the Reference table"""
+        t0 = time.monotonic()
+        mark = max_reference_pk()
+        refs = Reference.objects.filter(pk__lte=mark)
+        graph = cls.from_edges(*load_edges(refs), mark=mark)
+        logger.info("Built %r in %.1fs", graph, time.monotonic() - t0)
+        return graph
+
+    """
+    Snapshots
+    ---------
+    """
+
+    def save(self, directory=GRAPH_DIR):
+        """Write the graph as a snapshot and make it current"""
+        if self.delta is not None:
+            raise ValueError("Cannot save a graph with unsaved edges")
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, str(self.mark))
+
+        if not os.path.exists(path):
+            # Write to a private dir then rename so readers never see
+            # a partial snapshot
+            tmp_path = f"{path}.tmp-{os.getpid()}"
+            os.makedirs(tmp_path)
+            for name in ARRAYS:
+                np.save(os.path.join(tmp_path, name), getattr(self, name))
+
+            meta = {"mark": self.mark, "n_nodes": self.n_nodes,
+                    "n_edges": self.n_edges, "created": tz.now().isoformat()}
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump(meta, f)
+
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another process saved the same mark first
+                for name in os.listdir(tmp_path):
+                    os.remove(os.path.join(tmp_path, name))
+                os.rmdir(tmp_path)
+
+        tmp_current = os.path.join(directory, f"{CURRENT}.tmp-{os.getpid()}")
+        with open(tmp_current, "w") as f:
+            f.write(str(self.mark))
+        os.replace(tmp_current, os.path.join(directory, CURRENT))
+
+        self.path = path
+        logger.info("Saved %r to %s", self, path)
+        prune_snapshots(directory)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a saved snapshot"""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                  for name in ARRAYS]
+        graph = cls(*arrays, mark=meta['mark'], path=path)
+        logger.debug("Mapped %r from %s", graph, path)
+        return graph
+
+    def update(self):
+        """Apply References added since the snapshot's mark"""
+        mark = max_reference_pk()
+        last = self.delta.mark if self.delta is not None else self.mark
+
+        if mark <= last:
+            return 0
+
+        refs = Reference.objects.filter(pk__gt=last, pk__lte=mark)
+        citing, cited = load_edges(refs)
+        old_citing, old_cited = self._delta_edges
+        self._delta_edges = (np.concatenate([old_citing, citing]),
+                             np.concatenate([old_cited, cited]))
+        self.delta = self.__class__.from_edges(*self._delta_edges, mark=mark)
+
+        logger.debug("Applied %s edges up to Reference %s to %r",
+                     len(citing), mark, self)
+        return len(citing)
+
+    """
+    Traversal
+    ---------
+    """
+
+    def _references(self, nodes):
+        found = _gather(self.fwd_indptr, self.fwd_indices, nodes)
+        if self.delta is not None:
+            found = np.concatenate([found, self.delta._references(nodes)])
+        return found
+
+    def _citations(self, nodes):
+        found = _gather(self.rev_indptr, self.rev_indices, nodes)
+        if self.delta is not None:
+            found = np.concatenate([found, self.delta._citations(nodes)])
+        return found
+
+    def references(self, pks):
+        """Papers cited by any of `pks` (with repeats)"""
+        return self._references(_as_nodes(pks))
+
+    def citations(self, pks):
+        """Papers citing any of `pks` (with repeats)"""
+        return self._citations(_as_nodes(pks))
+
+    def cocitation(self, pks):
+        """Times each paper is cited alongside `pks`, indexed by pk"""
+        citing = np.unique(self.citations(pks))
+        return np.bincount(self._references(citing), minlength=self.n_nodes)
+
+    def coupling(self, pks):
+        """References each paper shares with `pks`, indexed by pk"""
+        cited = np.unique(self.references(pks))
+        return np.bincount(self._citations(cited), minlength=self.n_nodes)
+
+    def neighbourhood(self, pks, k=1, direction="both"):
+        """Papers within `k` hops of `pks`
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            Paper pks and their hop distance. Seeds have distance 0.
+        """
+        dist = np.full(self.n_nodes, -1, dtype=np.int64)
+        frontier = _as_nodes(pks)
+        frontier = frontier[frontier < self.n_nodes]
+        dist[frontier] = 0
+
+        for hop in range(1, k + 1):
+            found = []
+            if direction in ("both", "references"):
+                found.append(self._references(frontier))
+            if direction in ("both", "citations"):
+                found.append(self._citations(frontier))
+            frontier = np.unique(np.concatenate(found))
+            frontier = frontier[dist[frontier] < 0]
+
+            if not len(frontier):
+                break
+            dist[frontier] = hop
+
+        nodes = np.flatnonzero(dist >= 0)
+        return nodes, dist[nodes]
+
+    def similarity(self, pks):
+        """Co-citation plus bibliographic coupling with `pks`"""
+        return self.cocitation(pks) + self.coupling(pks)
+
+    def most_similar(self, pks, n=5, exclude_seeds=True):
+        """Top `n` (pk, score) pairs by similarity to `pks`"""
+        scores = self.similarity(pks)
+
+        if exclude_seeds:
+            seeds = _as_nodes(pks)
+            scores[seeds[seeds < self.n_nodes]] = 0
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > n:
+            top = np.argpartition(-scores[candidates], n - 1)[:n]
+            candidates = candidates[top]
+
+        # Highest score first, ties broken by pk
+        order = np.lexsort((candidates, -scores[candidates]))
+        return [(int(pk), int(scores[pk])) for pk in candidates[order]]
+
+
+"""
+Snapshot files
+--------------
+"""
+
+
+def current_snapshot(directory=GRAPH_DIR):
+    """Path of the current snapshot, or None"""
+    try:
+        with open(os.path.join(directory, CURRENT)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+
+    path = os.path.join(directory, name)
+    return path if os.path.isdir(path) else None
+
+
+def prune_snapshots(directory=GRAPH_DIR, keep=GRAPH_KEEP):
+    """Delete all but the newest `keep` snapshots
+
+    Processes still mapping a deleted snapshot keep their pages until
+    they switch to a newer one.
+    """
+    marks = sorted(int(name) for name in os.listdir(directory)
+                   if name.isdigit())
+    for mark in marks[:-keep]:
+        path = os.path.join(directory, str(mark))
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+        logger.debug("Removed graph snapshot %s", path)
+
+
+def save_graph(directory=GRAPH_DIR):
+    """Rebuild the graph from the db and save it as the current snapshot"""
+    cache.set(RELINKED_KEY, 0, timeout=None)
+    graph = CitationGraph.from_db()
+    graph.save(directory)
+    cache.delete(BUILDING_KEY)
+    return graph
+
+
+def load_graph(directory=GRAPH_DIR):
+    """Map the current snapshot and bring it up to date
+
+    Raises GraphNotReady, and queues a build, when no snapshot exists
+    yet.
+    """
+    path = current_snapshot(directory)
+
+    if path is None:
+        schedule_build()
+        raise GraphNotReady(f"No graph snapshot in {directory}")
+
+    graph = CitationGraph.load(path)
+    graph.update()
+    return graph
+
+
+"""
+Rebuilds
+--------
+"""
+
+
+def schedule_build():
+    """Queue a snapshot build, unless one is already queued
+
+    Returns True if a build was queued.
+    """
+    from papernet import tasks
+
+    if not cache.add(BUILDING_KEY, 1, timeout=BUILD_TIMEOUT):
+        return False
+    logger.info("Queueing a citation graph build")
+    transaction.on_commit(tasks.save_citation_graph.delay)
+    return True
+
+
+def relinked(n):
+    """Count References linked to papers, queueing a build after many"""
+    if not n:
+        return
+    cache.add(RELINKED_KEY, 0, timeout=None)
+    if cache.incr(RELINKED_KEY, n) >= GRAPH_RELINK_LIMIT:
+        cache.set(RELINKED_KEY, 0, timeout=None)
+        schedule_build()
+
+
+"""
+Shared instance
+---------------
+"""
+
+_graph = None
+_checked = 0
+
+
+def get_graph(max_age=GRAPH_MAX_AGE):
+    """Return the process-wide graph, refreshing it when stale
+
+    Raises GraphNotReady until the first snapshot has been saved.
+    """
+    global _graph, _checked
+
+    if _graph is not None and time.monotonic() - _checked < max_age:
+        return _graph
+
+    if _graph is None or current_snapshot() != _graph.path:
+        try:
+            _graph = load_graph()
+        except GraphNotReady:
+            # Keep serving the graph already mapped
+            if _graph is None:
+                raise
+            _graph.update()
+    else:
+        _graph.update()
+
+    _checked = time.monotonic()
+    return _graph
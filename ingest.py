@@ -0,0 +1,351 @@
+"""
+Ingest
+------
+Store crossref works in bulk
+
+Works are taken in chunks. Each chunk resolves its existing papers,
+authors, journals and references with a handful of IN queries, inserts
+what is missing with bulk_create and commits in one transaction, so the
+number of queries doesn't grow with the number of works.
+"""
+
+import logging
+import time
+from collections import Counter, defaultdict
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+
+from papernet import aux, graph, search
+from papernet.data import cleaning
+from papernet.models import (Affiliation, Author, Authorship, Institution,
+                             Journal, Paper, Publication, Reference)
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+CHUNKSIZE = 500
+
+# Most parameters in a single IN lookup
+BATCHSIZE = 900
+
+PAPER_FIELDS = ["title", "short_title", "article_type",
+                "is_referenced_by_count", "references_count", "abstract",
+                "retrieved", "updated"]
+
+PUBLICATION_FIELDS = ["published", "published_online", "published_print",
+                      "issued", "volume", "issue", "pages", "source"]
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def chunked(iterable, n):
+    """Yield lists of up to n items from iterable"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, n))
+
+
+def _filter_in(queryset, field, values):
+    """Yield rows of queryset matching values, in batches of IN lookups"""
+    for batch in chunked(values, BATCHSIZE):
+        yield from queryset.filter(**{f"{field}__in": batch})
+
+
+"""
+Resolvers
+---------
+Each takes the works in a chunk and creates any missing rows
+"""
+
+
+def _papers(works, force=False):
+    """Return {doi: Paper} for works that need to be (re)stored"""
+    dois = list(works)
+    existing = Paper.objects.in_bulk(dois, field_name='doi')
+
+    Paper.objects.bulk_create(
+        [Paper(doi=doi) for doi in dois if doi not in existing],
+        ignore_conflicts=True)
+
+    todo = [doi for doi in dois
+            if force or doi not in existing or not existing[doi].retrieved]
+    papers = Paper.objects.in_bulk(todo, field_name='doi')
+
+    for doi, paper in papers.items():
+        paper.from_crossref(works[doi], save=False)
+    Paper.objects.bulk_update(papers.values(), PAPER_FIELDS)
+
+    return papers
+
+
+def _authors(papers, works):
+    """Create authors, authorships and affiliations for papers"""
+    entries = {doi: [(entry.get('given', ''), entry.get('family', ''),
+                      entry.get('sequence', ''),
+                      entry.get('affiliation', []))
+                     for entry in works[doi].get('author', [])]
+               for doi in papers}
+
+    # Authors, matched exactly on names
+    names = {(e[0], e[1]) for doi_entries in entries.values()
+             for e in doi_entries}
+
+    def resolve():
+        found = {}
+        candidates = Author.objects.order_by('-pk').values_list(
+            'pk', 'first_name', 'last_name')
+        for pk, first, last in _filter_in(
+                candidates, 'last_name', {last for first, last in names}):
+            found[(first, last)] = pk
+        return found
+
+    # Authors created meanwhile by another worker are found by resolve
+    authors = resolve()
+    missing = names.difference(authors)
+    if missing:
+        Author.objects.bulk_create(
+            [Author(first_name=first, last_name=last)
+             for first, last in missing], ignore_conflicts=True)
+        authors = resolve()
+
+    # Authorships, skipping authors already linked to the paper
+    paper_pks = [paper.pk for paper in papers.values()]
+    existing = set(Authorship.objects.filter(paper__in=paper_pks).values_list(
+        'paper', 'author'))
+
+    ships, affiliations = [], {}
+    for doi, paper in papers.items():
+        for first, last, position, affs in entries[doi]:
+            key = (paper.pk, authors[(first, last)])
+            if key in existing:
+                continue
+            existing.add(key)
+            ships.append(Authorship(paper_id=key[0], author_id=key[1],
+                                    position=position))
+            affiliations[key] = {aff['name'] for aff in affs
+                                 if aff.get('name') is not None}
+    Authorship.objects.bulk_create(ships)
+
+    _affiliations(paper_pks, affiliations)
+    return len(missing), len(ships)
+
+
+def _affiliations(paper_pks, affiliations):
+    """Create affiliations for new authorships
+
+    Parameters
+    ----------
+    paper_pks : list of int
+        Papers the authorships belong to.
+    affiliations : dict
+        Institution names keyed by (paper pk, author pk).
+    """
+    names = set().union(*affiliations.values())
+    if not names:
+        return
+
+    def resolve():
+        found = {}
+        institutions = Institution.objects.order_by('-pk').values_list(
+            'pk', 'raw')
+        for pk, raw in _filter_in(institutions, 'raw', names):
+            found[raw] = pk
+        return found
+
+    institutions = resolve()
+    missing = names.difference(institutions)
+    if missing:
+        Institution.objects.bulk_create(
+            [Institution(raw=name) for name in missing])
+        institutions = resolve()
+
+    ships = Authorship.objects.filter(paper__in=paper_pks).order_by(
+        'pk').values_list('pk', 'paper', 'author')
+    ship_pks = {(paper, author): pk for pk, paper, author in ships}
+
+    Affiliation.objects.bulk_create(
+        [Affiliation(authorship_id=ship_pks[key],
+                     institution_id=institutions[name])
+         for key, names in affiliations.items() for name in names])
+
+
+def _journals(works):
+    """Return {issn: Journal} for the works' journals, creating missing ones"""
+    issns = {}
+    for doi, work in works.items():
+        issn = cleaning.get_issn(work)
+        if issn['issn']:
+            issns.setdefault(issn['issn'], (issn, work))
+        else:
+            logger.error("Could not create Journal for "
+                         "%s: No issn available: %s", doi, issn)
+
+    if not issns:
+        return {}
+
+    def resolve():
+        found = defaultdict(dict)
+        values = list(issns)
+        query = (Q(issn__in=values) | Q(electronic_issn__in=values) |
+                 Q(print_issn__in=values))
+        for journal in Journal.objects.filter(query):
+            for value in (journal.issn, journal.electronic_issn,
+                          journal.print_issn):
+                if value in issns:
+                    found[value][journal.pk] = journal
+        return found
+
+    found = resolve()
+
+    # Several journals sharing an issn are merged as in aux.add_work
+    duplicated = [issn for issn, journals in found.items()
+                  if len(journals) > 1]
+    for issn in duplicated:
+        aux.get_journal_by_issn(issn)
+    if duplicated:
+        found = resolve()
+
+    created = []
+    for key in set(issns).difference(found):
+        issn, work = issns[key]
+        journal = Journal(**issn)
+        journal.from_crossref(work, save=False)
+        created.append(journal)
+    Journal.objects.bulk_create(created, ignore_conflicts=True)
+
+    journals = {issn: min(journals.values(), key=lambda j: j.pk)
+                for issn, journals in found.items()}
+    if created:
+        new = Journal.objects.in_bulk([j.issn for j in created],
+                                      field_name='issn')
+        logger.info("Created %s new journals", len(new))
+        journals.update(new)
+
+    return journals
+
+
+def _publications(papers, works, journals):
+    """Create or update the publication of each paper"""
+    paper_pks = [paper.pk for paper in papers.values()]
+    existing = {}
+    for publication in Publication.objects.filter(
+            paper__in=paper_pks).order_by('-pk'):
+        existing[(publication.paper_id, publication.journal_id)] = publication
+
+    created, updated = [], []
+    for doi, paper in papers.items():
+        journal = journals.get(cleaning.get_issn(works[doi])['issn'])
+        key = (paper.pk, journal.pk if journal else None)
+
+        publication = existing.get(key)
+        if publication is None:
+            publication = Publication(paper=paper, journal=journal)
+            created.append(publication)
+        else:
+            updated.append(publication)
+        publication.from_crossref(works[doi], save=False)
+
+    Publication.objects.bulk_create(created)
+    Publication.objects.bulk_update(updated, PUBLICATION_FIELDS)
+
+
+def _references(papers, works):
+    """Store the references listed in works, returning cited paper pks"""
+    tally, references = Reference.bulk_from_crossref(
+        [(paper, works[doi]) for doi, paper in papers.items()])
+    logger.debug(dict(tally))
+    return [ref.cited_paper_id for ref in references if ref.cited_paper_id]
+
+
+"""
+Public API
+----------
+"""
+
+
+@transaction.atomic
+def add_chunk(works, force=False, citations=True):
+    """Store one chunk of crossref works in a single transaction
+
+    Returns a Counter of the rows created.
+    """
+    by_doi = {}
+    for work in works:
+        if work.get('DOI') is None:
+            logger.error("Skipping work without DOI: %s", work.get('title'))
+            continue
+        try:
+            doi = cleaning.clean_doi(work['DOI'])
+        except ValueError:
+            logger.error("Skipping work with invalid DOI: %s", work['DOI'])
+            continue
+        by_doi[doi] = work
+
+    tally = Counter(works=len(by_doi))
+    papers = _papers(by_doi, force=force)
+    tally['stored'] = len(papers)
+    if not papers:
+        return tally
+
+    tally['authors'], tally['authorships'] = _authors(papers, by_doi)
+    journals = _journals({doi: by_doi[doi] for doi in papers})
+    _publications(papers, by_doi, journals)
+
+    # Link references stored before their cited paper existed
+    dangling = Reference.objects.filter(cited_paper__isnull=True,
+                                        cited_doi__in=list(papers))
+    tally['linked'] = dangling.update(cited_paper=Subquery(
+        Paper.objects.filter(doi=OuterRef('cited_doi')).values('pk')[:1]))
+    graph.relinked(tally['linked'])
+
+    pks = [paper.pk for paper in papers.values()]
+    cited = _references(papers, by_doi) if citations else []
+    for batch in chunked(set(pks).union(cited), BATCHSIZE):
+        Paper.refresh_counts(batch)
+
+    search.index_papers(pks)
+    return tally
+
+
+def add_works(works, chunksize=CHUNKSIZE, force=False, citations=True):
+    """Store crossref works in the database in bulk
+
+    The bulk equivalent of `aux.add_work`. Papers that have already
+    been retrieved are skipped unless `force`. References listed in the
+    works are stored when `citations` is True; COCI citations are not
+    requested, use `aux.get_cited_by` for those.
+
+    Parameters
+    ----------
+    works : iterable of dict
+        Crossref work messages. Generators are consumed a chunk at a time.
+    chunksize : int
+        Works stored per transaction.
+
+    Returns
+    -------
+    collections.Counter
+        Works seen, papers stored, authors and authorships created and
+        earlier references linked to the stored papers.
+    """
+    tally = Counter()
+    for chunk in chunked(works, chunksize):
+        t0 = time.monotonic()
+        counts = add_chunk(chunk, force=force, citations=citations)
+        tally.update(counts)
+        logger.info("Stored %s of %s works in %.1fs", counts['stored'],
+                    counts['works'], time.monotonic() - t0)
+    return tally
@@ -0,0 +1,63 @@
+"""
+Benchmark storing synthetic crossref works
+"""
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+
+from papernet.bench import ingest
+from papernet.bench.measure import environment
+
+
+class Command(BaseCommand):
+    help = ("Time storing synthetic crossref works and report works/sec, "
+            "queries per work and peak RSS as JSON. Every target runs in a "
+            "transaction that is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=ingest.SIZES,
+            help="Numbers of works to store")
+        parser.add_argument(
+            '--targets', nargs='+', choices=list(ingest.TARGETS),
+            default=list(ingest.TARGETS), help="Functions to benchmark")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--output', help="Write JSON here instead of stdout")
+        parser.add_argument(
+            '--baseline', help="JSON from an earlier run to compare with")
+
+    def handle(self, *args, **options):
+        # Logging from the functions benchmarked would dominate timings
+        if options['verbosity'] < 2:
+            logging.disable(logging.ERROR)
+
+        results = []
+        for n in options['sizes']:
+            for name in options['targets']:
+                result = ingest.run_target(name, n, options['seed'])
+                results.append(result)
+                self.stderr.write(
+                    f"{name} x{n}: {result['works_per_sec']} works/s, "
+                    f"{result['queries_per_work']} queries/work, "
+                    f"{result['peak_rss_mb']}MB")
+
+        report = {"environment": environment(), "seed": options['seed'],
+                  "results": results}
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+            for name, n, speedup, queries in ingest.compare(results,
+                                                            baseline):
+                speedup = f"{speedup:.2f}x" if speedup else "-"
+                queries = f"{queries:.2f}x" if queries else "-"
+                self.stderr.write(f"{name} x{n}: {speedup} works/s, "
+                                  f"{queries} queries/work vs baseline")
@@ -0,0 +1,62 @@
+"""
+Benchmark the slowest views against query budgets
+"""
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from papernet.bench import views
+from papernet.bench.measure import environment
+
+
+class Command(BaseCommand):
+    help = ("Render the slowest views on a synthetic graph, reporting "
+            "p50/p95 latency and query counts as JSON. Fails if a view "
+            "makes more queries than its budget. Everything is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--papers', type=int, default=views.PAPERS,
+            help="Number of synthetic papers to seed")
+        parser.add_argument(
+            '--repeat', type=int, default=views.REPEAT,
+            help="Requests per view")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--budget', action='append', default=[], metavar="VIEW=N",
+            help="Override a view's query budget")
+        parser.add_argument(
+            '--output', help="Write JSON here instead of stdout")
+
+    def handle(self, *args, **options):
+        if options['verbosity'] < 2:
+            logging.disable(logging.ERROR)
+
+        budgets = dict(views.QUERY_BUDGETS)
+        for budget in options['budget']:
+            name, _, value = budget.partition("=")
+            if name not in budgets or not value.isdigit():
+                raise CommandError(f"Bad budget: {budget}")
+            budgets[name] = int(value)
+
+        results = views.run(options['papers'], options['repeat'],
+                            options['seed'], budgets)
+        for result in results:
+            self.stderr.write(
+                f"{result['view']}: p50 {result['p50_ms']}ms, "
+                f"p95 {result['p95_ms']}ms, {result['queries']} queries "
+                f"(budget {result['budget']})")
+
+        report = {"environment": environment(), "seed": options['seed'],
+                  "results": results}
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        over = [r['view'] for r in results if not r['ok']]
+        if over:
+            raise CommandError("Over query budget: " + ", ".join(over))
@@ -0,0 +1,19 @@
+"""
+Save a fresh snapshot of the citation graph
+"""
+from django.core.management.base import BaseCommand
+
+from papernet import graph
+
+
+class Command(BaseCommand):
+    help = "Rebuild the citation graph from Reference and save a snapshot"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--directory', default=graph.GRAPH_DIR,
+            help="Snapshot directory (default PAPERNET_GRAPH_DIR)")
+
+    def handle(self, *args, **options):
+        citation_graph = graph.save_graph(options['directory'])
+        self.stdout.write(f"Saved {citation_graph!r} to {citation_graph.path}")
@@ -0,0 +1,33 @@
+"""
+Rebuild the denormalized citation counters on Paper from Reference
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from papernet.models import Paper
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Recount cited_by_count and citations_count for every Paper"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help="Number of paper pks to update per statement")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        max_pk = Paper.objects.aggregate(Max('pk'))['pk__max'] or 0
+
+        updated = 0
+        for start in range(0, max_pk + 1, chunk_size):
+            papers = Paper.objects.filter(pk__gte=start,
+                                          pk__lt=start + chunk_size)
+            updated += Paper.refresh_counts(papers)
+            logger.debug("Recounted papers up to pk %s", start + chunk_size)
+
+        self.stdout.write(f"Rebuilt citation counts for {updated} papers")
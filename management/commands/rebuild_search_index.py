@@ -0,0 +1,21 @@
+"""
+Rebuild the full-text search index for papers
+"""
+from django.core.management.base import BaseCommand
+
+from papernet import search
+
+
+class Command(BaseCommand):
+    help = "Clear and reindex every Paper in the full-text search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=search.INDEX_CHUNKSIZE,
+            help="Number of paper pks to index per batch")
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        backend.rebuild(chunksize=options['chunk_size'])
+        name = backend.__class__.__name__
+        self.stdout.write(f"Rebuilt search index with {name}")
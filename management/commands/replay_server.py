@@ -0,0 +1,52 @@
+"""
+Serve a recorded cassette as a local stand-in for the source APIs
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from papernet.sources.cassette import Cassette, ReplayServer
+
+
+class Command(BaseCommand):
+    help = ("Serve responses recorded with PAPERNET_CASSETTE_MODE='record' "
+            "over HTTP, at /<host>/<path>")
+
+    def add_arguments(self, parser):
+        parser.add_argument('cassette', help="Path to the cassette file")
+        parser.add_argument('--host', default="127.0.0.1")
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help="Seconds added to every response")
+        parser.add_argument(
+            '--jitter', type=float, default=0,
+            help="Up to this many more seconds, at random")
+        parser.add_argument(
+            '--error-rate', type=float, default=0,
+            help="Fraction of requests answered with 429")
+        parser.add_argument(
+            '--rate-limit', type=int, default=None,
+            help="Requests per second advertised in X-Rate-Limit headers")
+
+    def handle(self, *args, **options):
+        cassette = Cassette(options['cassette'])
+        try:
+            count = len(cassette)
+        except FileNotFoundError:
+            raise CommandError(f"No cassette at {options['cassette']}")
+
+        server = ReplayServer(
+            (options['host'], options['port']), cassette,
+            latency=options['latency'], jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            rate_limit=options['rate_limit'])
+
+        self.stdout.write(f"Serving {count} responses at {server.url}")
+        self.stdout.write("Set PAPERNET_CROSSREF_URL to "
+                          f"{server.url}api.crossref.org/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Requests: {server.counts}")
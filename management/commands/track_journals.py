@@ -0,0 +1,37 @@
+"""
+Track journals to keep their works in sync with crossref
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from papernet.models import Journal
+
+
+class Command(BaseCommand):
+    help = ("Mark journals as tracked, so that works created or updated on "
+            "crossref are synced by the sync_tracked_journals task")
+
+    def add_arguments(self, parser):
+        parser.add_argument('issns', nargs='*', help="ISSNs of journals")
+        parser.add_argument(
+            '--untrack', action='store_true',
+            help="Stop tracking the journals instead")
+        parser.add_argument(
+            '--list', action='store_true', help="List tracked journals")
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for journal in Journal.objects.filter(tracked=True):
+                self.stdout.write(f"{journal.issn}\t{journal.title}\t"
+                                  f"last synced {journal.last_updated}")
+            return
+
+        journals = Journal.objects.filter(issn__in=options['issns'])
+        missing = set(options['issns']).difference(
+            journals.values_list('issn', flat=True))
+        if missing:
+            raise CommandError("No journals with ISSN: " +
+                               ", ".join(sorted(missing)))
+
+        n = journals.update(tracked=not options['untrack'])
+        verb = "Untracked" if options['untrack'] else "Tracked"
+        self.stdout.write(f"{verb} {n} journals")
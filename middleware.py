@@ -0,0 +1,75 @@
+"""
+Middleware
+----------
+Per-view timing and query instrumentation
+
+Add "papernet.middleware.ViewLogMiddleware" to MIDDLEWARE to record a
+ViewLog for every papernet view: wall time, time in the database,
+query and duplicate query counts, and source response cache hits.
+Logs are sampled with PAPERNET_VIEW_LOG_SAMPLE_RATE and saved in bulk
+from a background thread. See the monitor/views/ page.
+"""
+
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.db import connections
+from django.utils import timezone as tz
+
+from papernet.models import pipeline
+from papernet.sources import cache as response_cache
+
+
+class QueryStats():
+    """Execute wrapper counting and timing queries"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+        self.seen = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - t0
+            self.count += 1
+            self.seen[(sql, repr(params))] += 1
+
+    @property
+    def duplicates(self):
+        """Queries that repeated an earlier one exactly"""
+        return self.count - len(self.seen)
+
+
+class ViewLogMiddleware():
+    """Record a ViewLog for each request handled by a papernet view"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        cache_counts = response_cache.thread_counts().copy()
+        start_time = tz.now()
+        t0 = time.perf_counter()
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+
+        view = getattr(request, 'papernet_view', None)
+        if view is not None:
+            cache_counts = response_cache.thread_counts() - cache_counts
+            pipeline.log_view(view, request, response, start_time,
+                              time.perf_counter() - t0, stats, cache_counts)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        module = getattr(view_func, '__module__', '') or ''
+        if module.startswith('papernet.'):
+            name = getattr(view_func, '__name__', type(view_func).__name__)
+            request.papernet_view = f"{module}.{name}"
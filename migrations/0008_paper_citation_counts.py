@@ -0,0 +1,42 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_counts(apps, schema_editor):
+    """Fill the new counters from existing References"""
+    Paper = apps.get_model('papernet', 'Paper')
+    Reference = apps.get_model('papernet', 'Reference')
+
+    refs = Reference.objects.order_by()
+    cited_by = refs.filter(cited_paper=OuterRef('pk')).values(
+        'cited_paper').annotate(n=Count('pk')).values('n')
+    citations = refs.filter(citing_paper=OuterRef('pk')).values(
+        'citing_paper').annotate(n=Count('pk')).values('n')
+
+    Paper.objects.update(
+        cited_by_count=Coalesce(Subquery(cited_by), 0),
+        citations_count=Coalesce(Subquery(citations), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0007_auto_20220608_0921'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paper',
+            name='cited_by_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='paper',
+            name='citations_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(populate_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2.4 on 2026-10-18 11:40
+
+from django.db import migrations
+
+
+SQLITE_CREATE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS papernet_paper_fts USING fts5(
+    title, subtitle, abstract, keywords, authors, journal,
+    tokenize = 'porter unicode61'
+)
+"""
+
+POSTGRES_CREATE = [
+    """
+    CREATE TABLE IF NOT EXISTS papernet_paper_search (
+        paper_id integer PRIMARY KEY
+            REFERENCES papernet_paper (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        document tsvector NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS papernet_paper_search_document_gin
+        ON papernet_paper_search USING gin (document)
+    """,
+]
+
+
+def create_index(apps, schema_editor):
+    """Create the full-text index table for the database vendor"""
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(SQLITE_CREATE)
+    elif vendor == "postgresql":
+        for sql in POSTGRES_CREATE:
+            schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS papernet_paper_fts")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP TABLE IF EXISTS papernet_paper_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0008_paper_citation_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
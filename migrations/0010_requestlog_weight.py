@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0009_paper_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='weight',
+            field=models.FloatField(default=1),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.4 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0011_blob_sourcelog_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(max_length=200)),
+                ('path', models.CharField(max_length=512)),
+                ('method', models.CharField(max_length=8)),
+                ('status', models.IntegerField(default=0)),
+                ('start_time', models.DateTimeField(db_index=True)),
+                ('wall', models.FloatField(default=0)),
+                ('db_time', models.FloatField(default=0)),
+                ('queries', models.IntegerField(default=0)),
+                ('duplicates', models.IntegerField(default=0)),
+                ('cache_hits', models.IntegerField(default=0)),
+                ('cache_misses', models.IntegerField(default=0)),
+                ('weight', models.FloatField(default=1)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-18 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0012_viewlog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='requestlog',
+            name='end_time',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.4 on 2026-10-18 18:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0013_requestlog_end_time_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RequestRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('host', models.CharField(max_length=200)),
+                ('route', models.CharField(blank=True, max_length=200)),
+                ('requests', models.FloatField(default=0)),
+                ('logged', models.IntegerField(default=0)),
+                ('delta', models.FloatField(default=0)),
+                ('wait', models.FloatField(default=0)),
+                ('histogram', models.JSONField(default=list)),
+                ('codes', models.JSONField(default=dict)),
+            ],
+            options={
+                'unique_together': {('period', 'start', 'host', 'route')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CreationRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('model', models.CharField(max_length=64)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('period', 'start', 'model')},
+            },
+        ),
+    ]
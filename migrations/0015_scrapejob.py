@@ -0,0 +1,38 @@
+# Generated by Django 3.2.4 on 2026-10-18 19:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0014_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('journal', 'Journal'), ('author', 'Author')], max_length=16)),
+                ('key', models.CharField(db_index=True, max_length=256)),
+                ('year', models.IntegerField(blank=True, default=None, null=True)),
+                ('params', models.JSONField(default=dict)),
+                ('limit', models.IntegerField(blank=True, default=None, null=True)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('IN PROGRESS', 'In progress'), ('SUCCESS', 'Success'), ('FAILURE', 'Failure')], db_index=True, default='PENDING', max_length=16)),
+                ('task_id', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('cursor', models.TextField(default='*')),
+                ('total', models.IntegerField(blank=True, default=None, null=True)),
+                ('works', models.IntegerField(default=0)),
+                ('stored', models.IntegerField(default=0)),
+                ('rejected', models.IntegerField(default=0)),
+                ('last_doi', models.CharField(blank=True, max_length=256)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(blank=True, default=None, null=True)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='subjobs', to='papernet.scrapejob')),
+            ],
+        ),
+    ]
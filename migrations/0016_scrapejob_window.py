@@ -0,0 +1,27 @@
+# Generated by Django 3.2.4 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0015_scrapejob'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='scrapejob',
+            name='year',
+        ),
+        migrations.AddField(
+            model_name='scrapejob',
+            name='from_date',
+            field=models.DateField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='scrapejob',
+            name='until_date',
+            field=models.DateField(blank=True, default=None, null=True),
+        ),
+    ]
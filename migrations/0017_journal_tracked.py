@@ -0,0 +1,28 @@
+# Generated by Django 3.2.4 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0016_scrapejob_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journal',
+            name='tracked',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='scrapejob',
+            name='since',
+            field=models.DateField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='scrapejob',
+            name='kind',
+            field=models.CharField(choices=[('journal', 'Journal'), ('sync', 'Journal sync'), ('author', 'Author')], max_length=16),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.4 on 2026-10-18 21:35
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0017_journal_tracked'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FrontierEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doi', models.CharField(max_length=128, unique=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('claimed', 'Claimed'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=8)),
+                ('in_degree', models.IntegerField(default=0)),
+                ('in_projects', models.IntegerField(default=0)),
+                ('priority', models.FloatField(default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('first_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('claimed', models.DateTimeField(blank=True, default=None, null=True)),
+                ('fetched', models.DateTimeField(blank=True, default=None, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='frontierentry',
+            index=models.Index(fields=['status', '-priority'], name='papernet_fr_status_43b734_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-18 22:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0018_frontierentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publication',
+            name='issued',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.4 on 2026-10-18 23:05
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicates(apps, schema_editor):
+    """Merge authors with the same names into the oldest of them"""
+    Author = apps.get_model('papernet', 'Author')
+    Authorship = apps.get_model('papernet', 'Authorship')
+    Affiliation = apps.get_model('papernet', 'Affiliation')
+
+    groups = Author.objects.values('first_name', 'last_name').annotate(
+        n=Count('pk'), keep=Min('pk')).filter(n__gt=1).order_by()
+    for group in groups:
+        duplicates = Author.objects.filter(
+            first_name=group['first_name'],
+            last_name=group['last_name']).exclude(pk=group['keep'])
+
+        # Authorships of papers the kept author is already linked to are
+        # dropped, moving their affiliations over
+        kept = dict(Authorship.objects.filter(
+            author=group['keep']).values_list('paper', 'pk'))
+        for ship in Authorship.objects.filter(author__in=duplicates):
+            if ship.paper_id in kept:
+                Affiliation.objects.filter(authorship=ship).update(
+                    authorship=kept[ship.paper_id])
+                ship.delete()
+            else:
+                ship.author_id = group['keep']
+                ship.save()
+                kept[ship.paper_id] = ship.pk
+        duplicates.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papernet', '0019_publication_issued'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='author',
+            unique_together={('first_name', 'last_name')},
+        ),
+    ]
@@ -8,8 +8,9 @@ import logging
 from datetime import datetime as dt
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Q, Count, Sum, Max, Min
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q, F, Count, Sum, Max, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone as tz
 
 from papernet import sources
@@ -34,6 +35,12 @@ PREP_REGEX = re.compile(" | ".join(PREPOSITIONS), re.I)
 PUNCT_REGEX = re.compile("[.:(-] ")
 NUM_REGEX = re.compile("[1-9]+")
 
+# Denormalized Reference counts, maintained by Paper.increment_counts
+COUNT_FIELDS = ("cited_by_count", "citations_count")
+
+# Times to retry a References insert that races another process
+INSERT_ATTEMPTS = 3
+
 """
 Helper function
 ---------------
@@ -110,6 +117,33 @@ def extract_dates(data):
     return dates
 
 
+def extract_titles(data):
+    """Return (title, short_title) from crossref data, or Nones"""
+    title = data.get('title')
+    short_title = data.get('short-title')
+    if isinstance(short_title, list) and short_title:
+        short_title = short_title[0]
+
+    if not title:
+        return None, None
+
+    title = truncate_title(title[0], 200, 20)
+    short_title = truncate_title(short_title or title, 50, 10)
+    return title, short_title
+
+
+def format_ref(author_names, year=None):
+    """Author (year) representation"""
+    if len(author_names) < 3:
+        author_string = " & ".join(author_names)
+    else:
+        author_string = f"{author_names[0]} et al."
+
+    if year:
+        author_string += f" ({year})"
+    return author_string
+
+
 def truncate_title(title, max_len=50, min_len=10):
     title = re.sub("\s+", " ", title)
     if len(title) < max_len:
@@ -159,6 +193,14 @@ class Author(models.Model):
     scholar = models.URLField(blank=True)
     created = models.DateTimeField(auto_now_add=True)
 
+    # Counts attached in bulk by papernet.serializers
+    _paper_count = None
+    _citation_count = None
+
+    class Meta:
+        """Authors are matched exactly on their names"""
+        unique_together = ['first_name', 'last_name']
+
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
 
@@ -171,36 +213,43 @@ class Author(models.Model):
     @property
     def paper_count(self):
         """Number of published papers"""
+        if self._paper_count is not None:
+            return self._paper_count
         return self.authorship_set.count()
 
     def citation_count(self):
         """Total citations (with optional filters)"""
-        papers = self.get_papers(n=None)
-        result = papers.aggregate(Sum('citations__count'))
-        return result['citations__count__sum']
+        if self._paper_count is not None:
+            return self._citation_count
+        papers = self.get_papers(n=None, order=None)
+        result = papers.aggregate(Sum('citations_count'))
+        return result['citations_count__sum']
 
-    def get_papers(self, n=5, order='-citations__count'):
+    def get_papers(self, n=5, order='-citations_count'):
         """Get papers written by the author"""
         papers = Paper.objects.filter(authorship__in=self.authorship_set.all())
         if order is not None:
-            papers = papers.annotate(Count('citations'))
             papers = papers.order_by(order)
         return papers[:n]
 
     def get_coauthors(self, n=5, order='-coauthorships'):
         """Get coauthors"""
+        from papernet import serializers
+
         papers = self.get_papers(n=None)
         aships = Authorship.objects.filter(paper__in=papers)
         authors = Author.objects.filter(authorship__in=aships).exclude(pk=self.pk)
         if order is not None:
             authors = authors.annotate(coauthorships=Count('authorship', Q(pk__in=aships)))
             authors = authors.order_by(order)
-        authors = authors[:n]
+        authors = serializers.prefetch_authors(authors[:n])
+        top_papers = [author.get_papers(n=1).first() for author in authors]
+        serializers.prefetch_papers(top_papers)
         out = []
-        for author in authors:
+        for author, top_paper in zip(authors, top_papers):
             data = author.preview
             data['coauthorships'] = author.coauthorships
-            data['top_paper'] = str(author.get_papers(n=1).first())
+            data['top_paper'] = str(top_paper)
             out.append(data)
         return out
 
@@ -217,15 +266,9 @@ class Author(models.Model):
     @property
     def data(self):
         """Get data about author objects"""
-        out = {"first_name": self.first_name,
-               "last_name": self.last_name,
-               "name": str(self),
-               "pk": self.pk,
-               "paper_count": self.paper_count,
-               "citation_count": self.citation_count()}
-        out['papers'] = [p.data for p in self.get_papers()]
-        out['coauthors'] = self.get_coauthors(n=5)
-        return out
+        from papernet import serializers
+
+        return serializers.author_data([self])[0]
 
     def create_authorship(self, paper, position):
         """Create authorship relationship"""
@@ -250,6 +293,10 @@ class Paper(models.Model):
     references_count = models.IntegerField(default=0)
     is_referenced_by_count = models.IntegerField(default=0)
 
+    # Number of local References to and from the paper
+    cited_by_count = models.IntegerField(default=0, db_index=True)
+    citations_count = models.IntegerField(default=0, db_index=True)
+
     retrieved = models.DateTimeField(blank=True, default=None, null=True)
     updated = models.DateTimeField(blank=True, default=None, null=True)
     created = models.DateTimeField(auto_now_add=True)
@@ -257,41 +304,48 @@ class Paper(models.Model):
     def __str__(self):
         return self.ref or self.short_title or self.doi
 
+    def save(self, *args, **kwargs):
+        """Save, leaving the citation counters to the database"""
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            fields = [f.name for f in self._meta.concrete_fields
+                      if not f.primary_key and f.name not in COUNT_FIELDS]
+            kwargs['update_fields'] = fields
+        super().save(*args, **kwargs)
+
     @property
     def ref(self):
         """Author (year) representation"""
         author_names = [a.last_name for a in self.authors if a.last_name]
-        if len(author_names) < 3:
-            author_string = " & ".join(author_names)
-        else:
-            author_string = f"{author_names[0]} et al."
-
-        if self.year:
-            author_string += f" ({self.year})"
-        return author_string
+        return format_ref(author_names, self.year)
 
     @property
     def authors(self):
         """Return Author objects associated with Paper"""
         # TODO: ensure author ordering
-        authorships = Authorship.objects.filter(paper=self.pk)
+        authorships = self.authorship_set.all()
         paper_authors = [a.author for a in authorships]
         return paper_authors
 
     @property
     def publication(self):
         """Paper's publication"""
-        publications = self.publication_set.all()
+        publications = list(self.publication_set.all())
 
-        if publications.count() != 1 and self.retrieved:
+        if len(publications) != 1 and self.retrieved:
             logger.error("Paper id(%s) has %s publications.",
-                         self.pk, publications.count())
+                         self.pk, len(publications))
 
-        if publications.count() == 0 and self.retrieved:
+        if not publications and self.retrieved:
             publication = Publication.objects.create(paper=self)
+            # Drop any prefetched publications so the new one is seen
+            getattr(self, '_prefetched_objects_cache', {}).pop(
+                'publication_set', None)
             return publication
 
-        return publications.last()
+        if not publications:
+            return None
+
+        return max(publications, key=lambda p: p.pk)
 
     @property
     def year(self):
@@ -349,48 +403,75 @@ class Paper(models.Model):
         }
         return out
 
-    def cited_papers(self, n=5, order='-citations__count'):
+    def cited_papers(self, n=5, order='-citations_count'):
         """List of papers which this paper cites"""
         papers = Paper.objects.filter(cited_by__in=self.citations.all())
         if order is not None:
-            papers = papers.annotate(models.Count('citations'))
             papers = papers.order_by(order)
         return papers[:n]
 
-    def citing_papers(self, n=5, order='-citations__count'):
+    def citing_papers(self, n=5, order='-citations_count'):
         """List of papers which cite this paper"""
         papers = Paper.objects.filter(citations__in=self.cited_by.all())
         if order is not None:
-            papers = papers.annotate(models.Count('citations'))
             papers = papers.order_by(order)
         return papers[:n]
 
     @property
     def citation_count(self):
         """Number of citations the paper has received"""
-        return self.cited_by.count()
+        return self.cited_by_count
 
     @property
     def reference_count(self):
         """Number of citations the paper contains"""
-        return self.citations.count()
-
-    def from_crossref(self, data, citations=False):
+        return self.citations_count
+
+    @classmethod
+    def increment_counts(cls, field, pks):
+        """Add one to `field` for every occurrence of a pk in `pks`"""
+        if field not in COUNT_FIELDS:
+            raise ValueError("Not a citation counter: %s" % field)
+
+        tally = Counter(pk for pk in pks if pk is not None)
+
+        # One UPDATE per distinct increment
+        groups = {}
+        for pk, n in tally.items():
+            groups.setdefault(n, []).append(pk)
+
+        for n, group in groups.items():
+            papers = cls.objects.filter(pk__in=group)
+            papers.update(**{field: F(field) + n})
+
+    @classmethod
+    def refresh_counts(cls, papers=None):
+        """Recount References for papers (default all) in one UPDATE"""
+        refs = Reference.objects.order_by()
+        cited_by = refs.filter(cited_paper=OuterRef('pk')).values(
+            'cited_paper').annotate(n=Count('pk')).values('n')
+        citations = refs.filter(citing_paper=OuterRef('pk')).values(
+            'citing_paper').annotate(n=Count('pk')).values('n')
+
+        if papers is None:
+            papers = cls.objects.all()
+        elif not isinstance(papers, models.QuerySet):
+            papers = cls.objects.filter(pk__in=list(papers))
+
+        return papers.update(
+            cited_by_count=Coalesce(Subquery(cited_by), 0),
+            citations_count=Coalesce(Subquery(citations), 0))
+
+    def from_crossref(self, data, citations=False, save=True):
         """Retrieve metadata from crossref"""
-        title = data.get('title')
-        short_title = data.get('short-title')
-        if isinstance(short_title, list) and short_title:
-            short_title = short_title[0]
+        title, short_title = extract_titles(data)
         # Warn if title retrieve fails
         if not title:
             logger.warning("title not found for doi: %s", self.doi)
             # TODO: Take short title?
         else:
-            title = title[0]
-            title = truncate_title(title, 200, 20)
             self.title = title
-            short_title = short_title or title
-            self.short_title = truncate_title(short_title, 50, 10)
+            self.short_title = short_title
 
         # filter out keys
         update_data = {}
@@ -404,6 +485,7 @@ class Paper(models.Model):
         # safe update
         _safe_update(self, update_data, overwrite=True)
 
+        # Cited papers are queued to be fetched, not stored here
         if citations:
             self.retrieve_citations()
 
@@ -412,7 +494,12 @@ class Paper(models.Model):
         # Store update info
         self.retrieved = tz.now()
         self.updated = tz.now()
-        self.save()
+
+        if save:
+            from papernet import search
+
+            self.save()
+            search.index_papers([self.pk])
 
         return self
 
@@ -444,61 +531,42 @@ class Paper(models.Model):
         return authorships
 
     def retrieve_citations(self):
-        """Retrieve and save citations as papers"""
-        logger.info("Retrieving citations for %s", self)
-        c, t0 = Counter(), tz.now()
-
-        citations = Reference.objects.filter(citing_doi=self.doi)
-        logger.debug("Identified %s citations", citations.count())
-
-        for ref in citations:
-            if self.__class__.objects.filter(doi=ref.cited_doi).first() is None:
-                ref_p = self.__class__(doi=ref.cited_doi)
-                ref_p.save()
-                ref_p.retrieve()
-                ref.cited_paper = ref_p
-                ref.save()
-                c['added'] += 1
-            else:
-                c['duplicate'] += 1
+        """Queue the papers cited that aren't stored to be fetched
 
-        delta = (tz.now()-t0).total_seconds()
-        logger.info("Retrieval complete in %ss. %s added and %s duplicates",
-                    delta, c['added'], c['duplicate'])
+        They are fetched by tasks.drain_frontier, most cited first.
+        """
+        from papernet import frontier
+
+        dois = Reference.objects.filter(
+            citing_doi=self.doi, cited_paper__isnull=True).values_list(
+                'cited_doi', flat=True)
+        queued = frontier.add(list(dois))
+        logger.info("Queued %s citations of %s", queued, self)
+        return queued
 
     def add_citations(self, data):
         """Add citations"""
-        references = data.get('reference', [])
-        tally = Counter()
-        logger.debug("Adding %s citations for %s", len(references), self)
-        for ref in references:
-            ref_doi = ref.get("DOI")
-
-            if ref_doi is None:
-                # logger.debug("Missing citation: %s", ref)
-                tally['missing doi'] += 1
-                continue
+        logger.debug("Adding %s citations for %s",
+                     len(data.get('reference', [])), self)
+        tally, references = Reference.bulk_from_crossref([(self, data)])
 
-            cited = self.__class__.objects.filter(doi=ref_doi).first()
-            reference, c = Reference.objects.get_or_create(
-                citing_doi=self.doi,
-                cited_doi=ref_doi,
-                defaults={"citing_paper": self,
-                          "cited_paper": cited}
-                )
-            if c:
-                reference.from_crossref(ref)
-                reference.save()
-                tally['added'] += 1
-            else:
-                tally['duplicates'] += 1
+        # Keep denormalized counters in step with new References
+        self.__class__.increment_counts(
+            'cited_by_count', [ref.cited_paper_id for ref in references])
+        self.__class__.increment_counts(
+            'citations_count', [self.pk] * len(references))
+        self.refresh_from_db(fields=COUNT_FIELDS)
 
         logger.debug(dict(tally))
 
         return tally
 
     def retrieve(self, citations=True, force=False):
-        """Fetch metadata from crossref using API"""
+        """Fetch metadata from crossref using API
+
+        With `citations`, cited papers that aren't stored are queued on
+        the crawl frontier (see retrieve_citations).
+        """
         logger.debug('Retrieving %s; citations=%s, force=%s',
                      self, citations, force)
 
@@ -508,7 +576,7 @@ class Paper(models.Model):
             if not force:
                 return None
 
-        result = sources.get_work(self.doi)
+        result = sources.get_work(self.doi, force=force)
         data = result.data
         self.from_crossref(data, citations=citations)
 
@@ -547,6 +615,10 @@ class Journal(models.Model):
     total_doi = models.IntegerField(default=0)
     publisher = models.CharField(blank=True, default="", max_length=128)
 
+    # Tracked journals' works are synced with crossref by
+    # tasks.sync_tracked_journals. last_updated is the time the last
+    # sync started, from which the next one carries on.
+    tracked = models.BooleanField(default=False, db_index=True)
     last_updated = models.DateTimeField(blank=True, null=True, default=None)
     last_retrieved = models.DateTimeField(blank=True, null=True, default=None)
     created = models.DateTimeField(auto_now_add=True)
@@ -598,7 +670,7 @@ class Journal(models.Model):
 
     def get_authors(self, n=5, order='-journal_papers'):
         """Get authors who have published in journal"""
-        papers = self.get_papers(n=None)
+        papers = self.get_papers(n=None, order=None)
         authors = Author.objects.filter(authorship__paper__in=papers)
 
         if order is not None:
@@ -735,6 +807,79 @@ class Reference(models.Model):
     publication_year = models.CharField(max_length=128, blank=True)
     cit_key = models.CharField(max_length=128, blank=True)
 
+    @classmethod
+    def bulk_from_crossref(cls, works, batch_size=900):
+        """Store the references listed in crossref works
+
+        Existing references and cited papers are found with one query
+        each (per `batch_size` DOIs), new references are inserted
+        together. If another process stores one of them meanwhile, the
+        existing references are looked up again and the insert retried,
+        so only the references actually inserted are returned.
+
+        Parameters
+        ----------
+        works : list of (Paper, dict)
+            Citing papers and their crossref data.
+
+        Returns
+        -------
+        (collections.Counter, list of Reference)
+            Tally of added, duplicate and missing doi references, and
+            the references added.
+        """
+        missing = 0
+        entries = []
+        for paper, data in works:
+            for ref in data.get('reference', []):
+                if ref.get('DOI') is None:
+                    missing += 1
+                else:
+                    entries.append((paper, ref))
+
+        citing_dois = list({paper.doi for paper, data in works})
+        cited_dois = list({ref['DOI'] for paper, ref in entries})
+        cited = {}
+        for i in range(0, len(cited_dois), batch_size):
+            cited.update(Paper.objects.filter(
+                doi__in=cited_dois[i:i + batch_size]).values_list('doi', 'pk'))
+
+        for attempt in range(INSERT_ATTEMPTS):
+            existing = set()
+            for i in range(0, len(citing_dois), batch_size):
+                existing.update(cls.objects.filter(
+                    citing_doi__in=citing_dois[i:i + batch_size]).values_list(
+                        'citing_doi', 'cited_doi'))
+
+            tally = Counter({'missing doi': missing} if missing else {})
+            references = []
+            for paper, ref in entries:
+                key = (paper.doi, ref['DOI'])
+                if key in existing:
+                    tally['duplicates'] += 1
+                    continue
+                existing.add(key)
+
+                reference = cls(citing_doi=key[0], cited_doi=key[1],
+                                citing_paper=paper,
+                                cited_paper_id=cited.get(key[1]))
+                reference.from_crossref(ref)
+                references.append(reference)
+
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(references)
+            except IntegrityError:
+                if attempt == INSERT_ATTEMPTS - 1:
+                    raise
+                logger.info("References for %s stored meanwhile, retrying",
+                            citing_dois[:3])
+                continue
+            break
+
+        tally['added'] = len(references)
+        return tally, references
+
     def from_crossref(self, data):
         """Extract data from crossref dict format"""
         self.author = data.get('author', '')
@@ -760,6 +905,8 @@ class Publication(models.Model):
     published = models.DateField(blank=True, null=True)
     published_online = models.DateField(blank=True, null=True)
     published_print = models.DateField(blank=True, null=True)
+    # Crossref's own publication date, by which it filters and counts
+    issued = models.DateField(blank=True, null=True)
 
     volume = models.CharField(max_length=128, blank=True)
     issue = models.CharField(max_length=128, blank=True)
@@ -774,14 +921,16 @@ class Publication(models.Model):
     def __str__(self):
         return f"{str(self.paper)} - {str(self.journal)} ({self.pk})"
 
-    def from_crossref(self, data):
+    def from_crossref(self, data, save=True):
         """Retrieve publication from data"""
         dates = extract_dates(data) or extract_dates(
-            data.get('journal-issue'), {})
+            data.get('journal-issue', {}))
+        dates = {key: date for key, date in dates.items() if date}
 
-        if any(dates):
-            self.published_online = dates.get("published_online")
-            self.published_print = dates.get("published_online")
+        if dates:
+            self.published_online = dates.get("published-online")
+            self.published_print = dates.get("published-print")
+            self.issued = dates.get("issued")
 
             self.published = min(dates.values())
 
@@ -790,7 +939,9 @@ class Publication(models.Model):
         self.issue = data.get('issue', '')
         self.pages = data.get('pages', '')
         self.source = data.get('source', '')
-        self.save()
+
+        if save:
+            self.save()
 
 
 class Topic(models.Model):
@@ -874,9 +1025,11 @@ class Reader(models.Model):
     @property
     def data(self):
         """Serializable Perusal data"""
-        papers = [p.preview for p in self.get_perusals()]
+        from papernet import serializers
 
-        projects = [p.preview for p in self.get_projects()]
+        papers = serializers.perusal_previews(self.get_perusals())
+
+        projects = serializers.project_previews(self.get_projects())
 
         out = {"username": self.user.username,
                "created": self.created,
@@ -903,9 +1056,14 @@ class Project(models.Model):
     primary = models.BooleanField(default=False)
     last_active = models.DateTimeField(default=tz.now)
 
+    # Count attached in bulk by papernet.serializers
+    _paper_count = None
+
     def paper_count(self):
         """No of papers in project"""
         # TODO: distinct papers? Multiple authors
+        if self._paper_count is not None:
+            return self._paper_count
         return self.perusal_set.count()
 
     def get_papers(self):
@@ -915,19 +1073,15 @@ class Project(models.Model):
 
     def get_statuses(self):
         """Get a list of all Perusal statuses"""
-        # TODO: Make more performant
         papers = self.get_papers()
-        statuses = set([p.status for p in papers])
+        statuses = set(papers.values_list('status', flat=True))
         statuses.update(DEFAULT_STATUSES)
         return list(statuses)
 
     def get_tags(self):
         """Get a list of all Perusal tags"""
-        # TODO: Make more performant
-        papers = self.get_papers()
-        c = Counter()
-        [c.update(p.tags) for p in papers]
-        return c.most_common()
+        tags = Tag.objects.filter(perusal__project=self)
+        return Counter(tags.values_list('content', flat=True)).most_common()
 
     @property
     def preview(self):
@@ -976,6 +1130,8 @@ class Perusal(models.Model):
 
     @property
     def tags(self):
+        if self.pk is None:
+            return []
         return [t.content for t in self.tag_set.all()]
 
     def add_tag(self, content):
@@ -2,19 +2,22 @@
 Data Pipeline Models
 """
 
-import os
+import atexit
 import json
 import logging
+import random
+import threading
 import time
-import urllib
 
-from django.db import models
+from django.conf import settings
+from django.db import connections, models, router, transaction
 from django.utils import timezone as tz
 from django.core.mail import mail_admins
-from django.core.files.base import ContentFile
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
+from papernet.data import blobs
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -22,11 +25,29 @@ logger.setLevel(logging.DEBUG)
 """
 Log timing constants
 """
-MAX_REQUEST_LENGTH = 4
 MAX_REQUEST_DELTA = tz.timedelta(seconds=2)
-WAIT_INTERVAL = 2
 EMAIL_REQUEST_LENGTH = 8
 
+"""
+Request log buffering
+"""
+# Flush buffered RequestLogs after this many records or seconds
+LOG_BUFFER_SIZE = getattr(settings, 'PAPERNET_REQUEST_LOG_BUFFER_SIZE', 100)
+LOG_FLUSH_INTERVAL = getattr(settings, 'PAPERNET_REQUEST_LOG_FLUSH_INTERVAL',
+                             30)
+
+# Fraction of fast, successful requests logged. Errors and slow
+# requests are always logged.
+LOG_SAMPLE_RATE = getattr(settings, 'PAPERNET_REQUEST_LOG_SAMPLE_RATE', 1.0)
+
+"""
+View log settings
+"""
+# Fraction of fast, successful views logged by ViewLogMiddleware. Errors
+# and views slower than VIEW_LOG_SLOW seconds are always logged.
+VIEW_LOG_SAMPLE_RATE = getattr(settings, 'PAPERNET_VIEW_LOG_SAMPLE_RATE', 1.0)
+VIEW_LOG_SLOW = getattr(settings, 'PAPERNET_VIEW_LOG_SLOW', 1.0)
+
 # TODO: Associate with models, as views of data
 
 
@@ -36,15 +57,243 @@ class RequestLog(models.Model):
     ua_header = models.TextField()
     params = models.TextField()
     start_time = models.DateTimeField(blank=True, null=True, default=None)
-    end_time = models.DateTimeField(blank=True, null=True, default=None)
+    end_time = models.DateTimeField(blank=True, null=True, default=None,
+                                    db_index=True)
     delta = models.FloatField(default=0)
     response_code = models.IntegerField(default=0)
     wait = models.FloatField(default=0)
+    # Requests this log stands for when sampled
+    weight = models.FloatField(default=1)
 
     def __str__(self):
         return f"{self.url} [{self.response_code}] ({self.delta}s)>"
 
 
+class ViewLog(models.Model):
+    """Timing and queries of a view, recorded by ViewLogMiddleware"""
+    view = models.CharField(max_length=200)
+    path = models.CharField(max_length=512)
+    method = models.CharField(max_length=8)
+    status = models.IntegerField(default=0)
+    start_time = models.DateTimeField(db_index=True)
+    # Seconds spent in the view and in the database
+    wall = models.FloatField(default=0)
+    db_time = models.FloatField(default=0)
+    queries = models.IntegerField(default=0)
+    # Queries repeating an earlier query's SQL and params
+    duplicates = models.IntegerField(default=0)
+    cache_hits = models.IntegerField(default=0)
+    cache_misses = models.IntegerField(default=0)
+    # Views this log stands for when sampled
+    weight = models.FloatField(default=1)
+
+    def __str__(self):
+        return f"{self.view} [{self.status}] ({self.wall:.3f}s)"
+
+
+"""
+Rollups
+-------
+Hourly and daily totals kept by papernet.rollups
+"""
+
+ROLLUP_PERIODS = [("hour", "Hour"), ("day", "Day")]
+
+
+class RequestRollup(models.Model):
+    """RequestLogs to a host and route in an hour or day"""
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIODS)
+    start = models.DateTimeField()
+    host = models.CharField(max_length=200)
+    route = models.CharField(max_length=200, blank=True)
+    # Weighted by RequestLog.weight, except `logged`
+    requests = models.FloatField(default=0)
+    logged = models.IntegerField(default=0)
+    delta = models.FloatField(default=0)
+    wait = models.FloatField(default=0)
+    # Requests in each of rollups.LATENCY_BINS and by response code
+    histogram = models.JSONField(default=list)
+    codes = models.JSONField(default=dict)
+
+    class Meta:
+        unique_together = [("period", "start", "host", "route")]
+
+    def __str__(self):
+        return f"{self.host}/{self.route} {self.period} {self.start}"
+
+
+class CreationRollup(models.Model):
+    """Rows of a model created in an hour or day"""
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIODS)
+    start = models.DateTimeField()
+    model = models.CharField(max_length=64)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [("period", "start", "model")]
+
+    def __str__(self):
+        return f"{self.model} {self.period} {self.start}"
+
+
+class RollupCheckpoint(models.Model):
+    """The last pk of a table counted into rollups"""
+    name = models.CharField(max_length=64, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.last_id}"
+
+
+class ScrapeJob(models.Model):
+    """A crossref scrape of a journal or author, checkpointed by page
+
+    See papernet.scrape. A journal job may be split into sub-jobs, each
+    scraping a window of issued dates, which are run in parallel. A sync
+    job scrapes a tracked journal's works updated since its last sync.
+    """
+    KINDS = [("journal", "Journal"), ("sync", "Journal sync"),
+             ("author", "Author")]
+    # Named like celery task states, for get_progress
+    STATUSES = [("PENDING", "Pending"), ("IN PROGRESS", "In progress"),
+                ("SUCCESS", "Success"), ("FAILURE", "Failure")]
+
+    kind = models.CharField(max_length=16, choices=KINDS)
+    # ISSN or author name
+    key = models.CharField(max_length=256, db_index=True)
+    # Issued dates (inclusive) scraped by a journal sub-job
+    from_date = models.DateField(blank=True, null=True, default=None)
+    until_date = models.DateField(blank=True, null=True, default=None)
+    # Only works updated on crossref since this date, for syncs
+    since = models.DateField(blank=True, null=True, default=None)
+    # The author's {"given": ..., "family": ...} names
+    params = models.JSONField(default=dict)
+    limit = models.IntegerField(blank=True, null=True, default=None)
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, blank=True,
+                               null=True, related_name="subjobs")
+    status = models.CharField(max_length=16, choices=STATUSES,
+                              default="PENDING", db_index=True)
+    task_id = models.CharField(max_length=64, blank=True, db_index=True)
+
+    # Checkpoint, saved after each page is stored
+    cursor = models.TextField(default="*")
+    total = models.IntegerField(blank=True, null=True, default=None)
+    works = models.IntegerField(default=0)
+    stored = models.IntegerField(default=0)
+    rejected = models.IntegerField(default=0)
+    last_doi = models.CharField(max_length=256, blank=True)
+
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(blank=True, null=True, default=None)
+
+    def __str__(self):
+        label = self.key
+        if self.from_date:
+            label += f" {self.from_date}..{self.until_date}"
+        return f"{self.kind} {label} [{self.status}] ({self.works} works)"
+
+    def progress(self):
+        """Counts for get_progress, summed over sub-jobs if there are any"""
+        subjobs = list(self.subjobs.all())
+        jobs = subjobs or [self]
+        totals = [job.total for job in jobs]
+        info = {
+            "status": self.status,
+            "current": sum(job.works for job in jobs),
+            "total": (sum(totals) if None not in totals else None),
+            "stored": sum(job.stored for job in jobs),
+            "rejected": sum(job.rejected for job in jobs),
+        }
+        if self.limit is not None and info['total'] is not None:
+            info['total'] = min(info['total'], self.limit)
+        if subjobs:
+            info['subjobs'] = len(subjobs)
+            info['finished'] = sum(job.status == "SUCCESS" for job in subjobs)
+            info['failed'] = sum(job.status == "FAILURE" for job in subjobs)
+        return info
+
+
+class FrontierEntry(models.Model):
+    """A DOI cited by stored papers but not stored, to be fetched
+
+    See papernet.frontier.
+    """
+    STATUSES = [("queued", "Queued"), ("claimed", "Claimed"),
+                ("done", "Done"), ("failed", "Failed")]
+
+    doi = models.CharField(max_length=128, unique=True)
+    status = models.CharField(max_length=8, choices=STATUSES,
+                              default="queued")
+    # Stored papers citing the DOI, and those of them in readers' projects
+    in_degree = models.IntegerField(default=0)
+    in_projects = models.IntegerField(default=0)
+    # Entries with higher priority are fetched first (frontier.priority)
+    priority = models.FloatField(default=0)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    first_seen = models.DateTimeField(default=tz.now)
+    # Last counted by frontier.add or frontier.refresh
+    seen = models.DateTimeField(default=tz.now)
+    claimed = models.DateTimeField(blank=True, null=True, default=None)
+    fetched = models.DateTimeField(blank=True, null=True, default=None)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "-priority"])]
+
+    def __str__(self):
+        return f"{self.doi} [{self.status}] ({self.priority:.2f})"
+
+
+class Blob(models.Model):
+    """A compressed payload in the blob store, addressed by content hash"""
+    digest = models.CharField(max_length=64, unique=True)
+    segment = models.IntegerField()
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+    size = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.digest[:12]} ({self.size}B)"
+
+    @classmethod
+    def store(cls, payload):
+        """Return the Blob for payload (bytes), storing it if new"""
+        digest = blobs.digest(payload)
+        blob = cls.objects.filter(digest=digest).first()
+        if blob is not None:
+            return blob
+
+        compressed = blobs.compress(payload)
+        store = blobs.get_store()
+        with store.locked():
+            # Another process may have stored it meanwhile
+            blob = cls.objects.filter(digest=digest).first()
+            if blob is None:
+                segment, offset = store.append(compressed)
+                blob = cls.objects.create(
+                    digest=digest, segment=segment, offset=offset,
+                    length=len(compressed), size=len(payload))
+        return blob
+
+    def read(self):
+        """The payload as bytes"""
+        return blobs.get_store().read(self.segment, self.offset, self.length)
+
+    def stream(self, chunksize=blobs.READ_CHUNKSIZE):
+        """Yield the payload in chunks"""
+        return blobs.get_store().stream(self.segment, self.offset,
+                                        self.length, chunksize)
+
+    def view(self):
+        """Memory-mapped view of the compressed payload"""
+        return blobs.get_store().view(self.segment, self.offset, self.length)
+
+
 class SourceLog(models.Model):
     """Store data from every query"""
     request = models.ForeignKey(
@@ -52,43 +301,45 @@ class SourceLog(models.Model):
         on_delete=models.CASCADE
     )
     created = models.DateTimeField(auto_now_add=True)
+    # Superseded by blob, kept for older logs
     file = models.FileField(upload_to='papernet/sources/',
                             blank=True, null=True, default=None)
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        blank=True, null=True, default=None
+    )
     file_type = models.CharField(max_length=128, default="raw")
 
     _data = None
 
+    @property
+    def raw(self):
+        """The stored payload as bytes"""
+        if self.blob is not None:
+            return self.blob.read()
+        return self.file.read()
+
     @property
     def data(self):
+        """The stored payload, parsed if it is JSON"""
         if self._data is None:
-            self._data = json.loads(self.file.read())
+            raw = self.raw
+            self._data = json.loads(raw) if self.file_type == "json" else raw
 
         return self._data
 
-    def generate_filepath(self, file_type=None):
-        """Generate filename to save data"""
-        upload_dir = self.file.field.upload_to
-
-        path = urllib.parse.urlsplit(self.request.url).path
-        timestamp = tz.now().strftime("%Y-%m%-d-%H-%S")
+    def store_data(self, data, file_type=None, save=True):
+        """Store data (str or bytes) in the blob store"""
+        if isinstance(data, str):
+            data = data.encode()
 
-        # Update file_type
         self.file_type = file_type or self.file_type
+        self.blob = Blob.store(data)
+        self._data = None
 
-        filepath = upload_dir + path + timestamp + "." + file_type
-
-        # filepath = os.path.join(upload_dir, self.pk, self.file_type)
-        return filepath
-
-    def store_data(self, data, file_type=None):
-        """Store data in file field"""
-        self.data = data
-
-        filepath = self.generate_filepath(file_type)
-
-        file = ContentFile(data)
-
-        self.file.save(filepath, file, True)
+        if save:
+            self.save()
 
 
 class Attribution(models.Model):
@@ -109,30 +360,149 @@ class Attribution(models.Model):
     updated = models.DateTimeField(default=tz.now)
 
 
+class LogBuffer():
+    """Hold model instances in memory and save them with bulk_create
+
+    The buffer is flushed when it holds `size` instances, by a timer
+    `interval` seconds after an instance is added to an empty buffer,
+    and at exit. Celery workers also flush after each task (see
+    papernet.tasks). With `background`, full buffers are saved in a
+    separate thread so the caller isn't held up.
+    """
+
+    def __init__(self, model, size=LOG_BUFFER_SIZE,
+                 interval=LOG_FLUSH_INTERVAL, background=False):
+        self.model = model
+        self.size = size
+        self.interval = interval
+        self.background = background
+        self.items = []
+        self.lock = threading.Lock()
+        # Held while instances are written, so save() can't insert an
+        # instance that a flush is saving
+        self.writing = threading.Lock()
+        self.flushed = time.monotonic()
+        self.timer = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, obj):
+        """Buffer obj, flushing if the buffer is full or old"""
+        with self.lock:
+            self.items.append(obj)
+            due = (len(self.items) >= self.size or
+                   time.monotonic() - self.flushed > self.interval)
+            if not due:
+                self._schedule()
+        if due and self.background:
+            threading.Thread(target=self._flush_in_thread,
+                             daemon=True).start()
+        elif due:
+            self.flush()
+
+    def _schedule(self):
+        """Start a timer to flush the buffer, unless one is running
+
+        Called with `lock` held. The timer is a daemon thread, and a
+        forked process (e.g. a Celery worker) sees it as stopped.
+        """
+        if self.timer is not None and self.timer.is_alive():
+            return
+        self.timer = threading.Timer(self.interval, self._flush_in_thread)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def save(self, obj):
+        """Save obj now (e.g. when its pk is needed)
+
+        An instance already flushed has its pk, and isn't saved again.
+        """
+        with self.writing:
+            with self.lock:
+                if obj in self.items:
+                    self.items.remove(obj)
+            if obj.pk is None:
+                obj.save()
+        return obj
+
+    def _bulk_create(self, items):
+        """bulk_create items, setting pks the database doesn't return"""
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            self.model.objects.using(using).bulk_create(items)
+            if (items[-1].pk is not None or
+                    connections[using].vendor != 'sqlite'):
+                return
+            # SQLite returns no pks, but holds a write lock until the
+            # transaction ends, so the newest rows are these, in order
+            pks = self.model.objects.using(using).order_by(
+                '-pk').values_list('pk', flat=True)[:len(items)]
+            for obj, pk in zip(items, reversed(pks)):
+                obj.pk = pk
+                obj._state.adding = False
+
+    def flush(self):
+        """Save every buffered instance"""
+        with self.writing:
+            with self.lock:
+                items, self.items = self.items, []
+                self.flushed = time.monotonic()
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not items:
+                return 0
+
+            try:
+                self._bulk_create(items)
+            except Exception as e:
+                logger.exception("Failed to save %s %s records: %s",
+                                 len(items), self.model.__name__, e)
+                return 0
+        return len(items)
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            # Connections are per thread; don't leave this one open
+            connections.close_all()
+
+
+request_logs = LogBuffer(RequestLog)
+atexit.register(request_logs.flush)
+
+view_logs = LogBuffer(ViewLog, background=True)
+atexit.register(view_logs.flush)
+
+
 def log_source(response, requestlog, request=None):
     """Log source data"""
-    source = SourceLog(request=requestlog)
+    source = SourceLog(request=request_logs.save(requestlog))
 
     # TODO: get content-type
 
     try:
-        data = json.loads(response.content)
+        json.loads(response.content)
     except json.JSONDecodeError as e:
         logger.exception(e)
-        data = response.content
         file_type = "raw"
     else:
         file_type = "json"
 
-    source.store_data(data, file_type)
-
-    source.save()
+    # Stored as received; SourceLog.data parses it on demand
+    source.store_data(response.content, file_type)
 
     return source
 
 
 def log_request(url, params, start_time, end_time, response, wait):
-    """Create RequestLog"""
+    """Create RequestLog
+
+    Logs are buffered and saved in bulk, so the returned log may not
+    have a pk yet. Pass it to `request_logs.save` if one is needed.
+    """
     params = json.dumps(params)
     delta = end_time - start_time
     delta_secs = delta.total_seconds()
@@ -144,43 +514,58 @@ def log_request(url, params, start_time, end_time, response, wait):
     log = RequestLog(url=url, params=params, start_time=start_time,
                      end_time=end_time, delta=delta_secs,
                      response_code=response.status_code, wait=wait)
-    log.save()
-
-    return log
-
-
-def rate_limit_warn_email(request):
-    """Email admins to warn of long request wait"""
-    subject = f"API request took {request.delta}"
-    message = f"Request {request} to {request.url}"
-    mail_admins(subject, message)
 
+    # Sample fast successful requests, weighting those kept. Those
+    # left out are counted by the weights, so count for nothing if a
+    # caller saves them anyway.
+    if response.status_code < 400 and delta <= MAX_REQUEST_DELTA:
+        if random.random() >= LOG_SAMPLE_RATE:
+            log.weight = 0
+            return log
+        log.weight = 1 / LOG_SAMPLE_RATE
 
-def rate_limit(url=None, params=None):
-    """Check last response time and sleep if need be"""
+    request_logs.add(log)
 
     # TODO: Send email as task
-    # TODO: Different rate limits for different routes
+    if delta_secs > EMAIL_REQUEST_LENGTH:
+        rate_limit_warn_email(log)
 
-    last_request = RequestLog.objects.last()
-    delta = last_request.delta if last_request else 0
-
-    if delta > EMAIL_REQUEST_LENGTH:
-        rate_limit_warn_email(last_request)
-
-    if delta > MAX_REQUEST_LENGTH:
+    return log
 
-        wait = max(WAIT_INTERVAL, delta * 2)
-        # wait = WAIT_INTERVAL
 
-        elapsed = (tz.now() - last_request.end_time).total_seconds()
-        remaining = wait - elapsed
+def log_view(view, request, response, start_time, wall, stats,
+             cache_counts):
+    """Buffer a ViewLog for a view's response
+
+    Parameters
+    ----------
+    view : str
+        Dotted path of the view function.
+    stats : papernet.middleware.QueryStats
+        Queries made while the view ran.
+    cache_counts : collections.Counter
+        Source response cache lookups made while the view ran.
+    """
+    log = ViewLog(view=view, path=request.path[:512], method=request.method,
+                  status=response.status_code, start_time=start_time,
+                  wall=wall, db_time=stats.time, queries=stats.count,
+                  duplicates=stats.duplicates,
+                  cache_hits=cache_counts['hits'] + cache_counts['revalidated'],
+                  cache_misses=cache_counts['misses'])
+
+    # Sample fast successful views, weighting those kept
+    if response.status_code < 400 and wall <= VIEW_LOG_SLOW:
+        if random.random() >= VIEW_LOG_SAMPLE_RATE:
+            log.weight = 0
+            return log
+        log.weight = 1 / VIEW_LOG_SAMPLE_RATE
+
+    view_logs.add(log)
+    return log
 
-        if remaining > 0:
-            logger.warning("Last Request (%s) took took too long. "
-                           "Waiting %.1fs (%.1fs remaining)",
-                           last_request, wait, remaining)
-            time.sleep(remaining)
-        return wait
-    return 0
 
+def rate_limit_warn_email(request):
+    """Email admins to warn of long request wait"""
+    subject = f"API request took {request.delta}"
+    message = f"Request {request} to {request.url}"
+    mail_admins(subject, message)
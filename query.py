@@ -4,12 +4,11 @@ Querying
 Access models and perform complex queries
 """
 
-from collections import Counter
-
 from django.db.models import Count, Q, F, Func
 
-from papernet import models
-from papernet.models import (Paper, Perusal, Reader, Journal, Author)
+from papernet import models, graph
+from papernet.models import (Paper, Perusal, Reader, Journal, Author,
+                             Reference)
 
 
 """
@@ -84,23 +83,22 @@ Scrape Prioritising
 
 
 def most_cited_missing_dois(n=10, citing_dois=None):
-    """Get the n most cited dois that do not exist in the db"""
-    fieldname = 'cited_doi'
+    """The n most cited dois that are not in the db, with their counts"""
     refs = Reference.objects.filter(cited_paper=None)
 
     if citing_dois is not None:
         refs = refs.filter(citing_doi__in=citing_dois)
 
-    refs = refs.values(fieldname).order_by(fieldname)
-    refs = refs.annotate(the_count=Count(fieldname))
-    top_dois = refs.order_by('-the_count')[:10]
-    return top_dois
+    refs = refs.values('cited_doi').order_by('cited_doi')
+    refs = refs.annotate(the_count=Count('citing_doi', distinct=True))
+    top_dois = refs.order_by('-the_count', 'cited_doi')[:n]
+    return [(ref['cited_doi'], ref['the_count']) for ref in top_dois]
 
 
 def most_cited_missing_for_project(project=None, n=10):
     """Get the n most cited missing dois for a project"""
     proj_dois = list(project.perusal_set.values_list('paper__doi', flat=True))
-    missing_dois = most_cited_missing_dois(n=n, citing_dois=proj_dois)
+    return most_cited_missing_dois(n=n, citing_dois=proj_dois)
 
 
 """
@@ -111,37 +109,17 @@ Similarity
 # TODO: Improve model similarity
 # - Class which stores ratio info etc
 # - Relative similarity (not just raw cites!)
-# - Cache
-
-
-def get_shared_refs(papers):
-    """Get a counter of shared refs by papers"""
-    tally = Counter()
-    for paper in papers:
-        tally.update(paper.cited_papers(n=None, order=None))
-    return tally
-
-
-def get_shared_cites(papers):
-    """Get a counter of shared refs by papers"""
-    tally = Counter()
-    for paper in papers:
-        tally.update(paper.citing_papers(n=None, order=None))
-    return tally
-
-
-def _get_similar_papers(refs, cites):
-    """Get a counter of papers which share refs and cites"""
-    ref_cites = get_shared_cites(refs)
-    cite_refs = get_shared_refs(cites)
-    total = ref_cites + cite_refs
-    return total
 
 
 def get_similar_papers(papers, n=5):
-    """Return most similar papers"""
-    refs = get_shared_refs(papers)
-    cites = get_shared_cites(papers)
-    similar = _get_similar_papers(refs, cites)
+    """Return the n papers most similar to `papers` with their scores
+
+    Similarity is co-citation plus bibliographic coupling, computed on
+    the in-memory citation graph. Raises graph.GraphNotReady until its
+    first snapshot has been built.
+    """
+    pks = [paper.pk for paper in papers]
+    similar = graph.get_graph().most_similar(pks, n=n)
 
-    return similar.most_common(n)
+    found = Paper.objects.in_bulk([pk for pk, score in similar])
+    return [(found[pk], score) for pk, score in similar if pk in found]
@@ -0,0 +1,358 @@
+"""
+Rollups
+-------
+Hourly and daily monitoring totals, maintained incrementally
+
+RequestLogs are summed into RequestRollups per host and route: request
+counts, total latency and wait, response codes and a latency histogram
+from which p50/p95/p99 are estimated. Rows of the models in
+PAPERNET_ROLLUP_MODELS are counted into CreationRollups.
+
+Each table has a RollupCheckpoint holding the last pk counted, so an
+update only reads newer rows. Rows younger than SETTLE are left for the
+next update, as rows buffered by other processes may still be on their
+way in with lower pks. Once counted, RequestLogs older than
+PAPERNET_REQUEST_LOG_RETENTION_DAYS can be pruned.
+"""
+
+import bisect
+import logging
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone as tz
+
+from papernet import models
+from papernet.models import (CreationRollup, RequestLog, RequestRollup,
+                             RollupCheckpoint)
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+PERIODS = ("hour", "day")
+
+# Upper bounds (seconds) of the latency histogram bins. A last bin holds
+# anything slower.
+LATENCY_BINS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+ROLLUP_MODELS = getattr(settings, 'PAPERNET_ROLLUP_MODELS', [
+    "Paper", "Author", "Journal", "Publication", "Reference", "Institution",
+    "SourceLog"])
+
+RETENTION_DAYS = getattr(settings, 'PAPERNET_REQUEST_LOG_RETENTION_DAYS', 30)
+
+SETTLE = tz.timedelta(minutes=5)
+BATCHSIZE = 10000
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def period_start(dt, period):
+    """Start of the hour or day (in the current timezone) containing dt"""
+    dt = tz.localtime(dt).replace(minute=0, second=0, microsecond=0)
+    if period == "day":
+        dt = dt.replace(hour=0)
+    return dt
+
+
+def host_route(url):
+    """Host and first path segment of url"""
+    parts = urlsplit(url)
+    segments = [s for s in parts.path.split("/") if s]
+    return parts.netloc, segments[0] if segments else ""
+
+
+def latency_bin(seconds):
+    return bisect.bisect_left(LATENCY_BINS, seconds)
+
+
+def histogram_quantile(histogram, q):
+    """Estimate a quantile from binned counts, interpolating within a bin"""
+    total = sum(histogram)
+    if not total:
+        return None
+    target = q * total
+    cumulative = 0
+    for i, count in enumerate(histogram):
+        if count and cumulative + count >= target:
+            low = LATENCY_BINS[i - 1] if i else 0
+            if i >= len(LATENCY_BINS):
+                return low
+            return low + (LATENCY_BINS[i] - low) * (target - cumulative) / count
+        cumulative += count
+    return LATENCY_BINS[-1]
+
+
+def _checkpoint(name):
+    checkpoint, _ = RollupCheckpoint.objects.select_for_update(
+    ).get_or_create(name=name)
+    return checkpoint
+
+
+def _settled(rows, now):
+    """Rows up to the first that is too recent to count yet
+
+    `rows` are (pk, time, ...) tuples in pk order.
+    """
+    cutoff = now - SETTLE
+    for row in rows:
+        if row[1] is not None and row[1] >= cutoff:
+            return
+        yield row
+
+
+"""
+Updates
+-------
+"""
+
+
+def _merge(model, totals, fields):
+    """Add totals keyed by unique fields into model's rows"""
+    if not totals:
+        return 0
+    keys = list(totals)
+    existing = {}
+    for period in PERIODS:
+        starts = {key[1] for key in keys if key[0] == period}
+        if not starts:
+            continue
+        for row in model.objects.filter(period=period, start__in=starts):
+            existing[tuple(getattr(row, f) for f in fields)] = row
+
+    created, updated = [], []
+    for key, add in totals.items():
+        row = existing.get(key)
+        if row is None:
+            row = model(**dict(zip(fields, key)))
+            created.append(row)
+        else:
+            updated.append(row)
+        add(row)
+
+    model.objects.bulk_create(created)
+    if updated:
+        update_fields = [f.name for f in model._meta.concrete_fields
+                         if f.name not in fields and not f.primary_key]
+        model.objects.bulk_update(updated, update_fields)
+    return len(created) + len(updated)
+
+
+class _RequestTotals():
+    """Sums of RequestLogs for one rollup"""
+
+    def __init__(self):
+        self.requests = self.delta = self.wait = 0
+        self.logged = 0
+        self.histogram = [0] * (len(LATENCY_BINS) + 1)
+        self.codes = Counter()
+
+    def add_log(self, delta, wait, code, weight):
+        self.requests += weight
+        self.logged += 1
+        self.delta += delta * weight
+        self.wait += wait * weight
+        self.histogram[latency_bin(delta)] += weight
+        self.codes[str(code)] += weight
+
+    def __call__(self, rollup):
+        """Add to a RequestRollup"""
+        rollup.requests += self.requests
+        rollup.logged += self.logged
+        rollup.delta += self.delta
+        rollup.wait += self.wait
+        histogram = rollup.histogram or [0] * len(self.histogram)
+        rollup.histogram = [a + b for a, b in zip(histogram, self.histogram)]
+        codes = Counter(rollup.codes)
+        codes.update(self.codes)
+        rollup.codes = dict(codes)
+
+
+@transaction.atomic
+def update_requests(batchsize=BATCHSIZE, now=None):
+    """Count RequestLogs since the checkpoint, returning the number read"""
+    now = now or tz.now()
+    checkpoint = _checkpoint("RequestLog")
+    rows = RequestLog.objects.filter(pk__gt=checkpoint.last_id).order_by(
+        'pk').values_list('pk', 'end_time', 'url', 'delta', 'wait',
+                          'response_code', 'weight')[:batchsize]
+
+    totals = defaultdict(_RequestTotals)
+    last_id, read = checkpoint.last_id, 0
+    for pk, end_time, url, delta, wait, code, weight in _settled(rows, now):
+        last_id, read = pk, read + 1
+        if end_time is None:
+            continue
+        host, route = host_route(url)
+        for period in PERIODS:
+            key = (period, period_start(end_time, period), host, route)
+            totals[key].add_log(delta, wait, code, weight)
+
+    _merge(RequestRollup, totals, ("period", "start", "host", "route"))
+    checkpoint.last_id = last_id
+    checkpoint.save()
+    return read
+
+
+@transaction.atomic
+def update_creations(model_name, batchsize=BATCHSIZE, now=None):
+    """Count new rows of a model since its checkpoint"""
+    now = now or tz.now()
+    model = getattr(models, model_name)
+    checkpoint = _checkpoint(f"created:{model_name}")
+    rows = model.objects.filter(pk__gt=checkpoint.last_id).order_by(
+        'pk').values_list('pk', 'created')[:batchsize]
+
+    counts = Counter()
+    last_id, read = checkpoint.last_id, 0
+    for pk, created in _settled(rows, now):
+        last_id, read = pk, read + 1
+        for period in PERIODS:
+            counts[(period, period_start(created, period), model_name)] += 1
+
+    def adder(n):
+        def add(rollup):
+            rollup.count += n
+        return add
+
+    _merge(CreationRollup, {k: adder(n) for k, n in counts.items()},
+           ("period", "start", "model"))
+    checkpoint.last_id = last_id
+    checkpoint.save()
+    return read
+
+
+def update(batchsize=BATCHSIZE):
+    """Bring every rollup up to date, returning rows read per table"""
+    tally = Counter()
+    while True:
+        read = update_requests(batchsize)
+        tally['RequestLog'] += read
+        if read < batchsize:
+            break
+    for model_name in ROLLUP_MODELS:
+        while True:
+            read = update_creations(model_name, batchsize)
+            tally[model_name] += read
+            if read < batchsize:
+                break
+    return tally
+
+
+def prune(days=RETENTION_DAYS, batchsize=BATCHSIZE):
+    """Delete RequestLogs older than `days` that have been rolled up
+
+    Logs with a SourceLog are kept, as deleting them would delete the
+    stored response. Returns the number deleted.
+    """
+    checkpoint = RollupCheckpoint.objects.filter(name="RequestLog").first()
+    if checkpoint is None:
+        return 0
+
+    old = RequestLog.objects.filter(
+        pk__lte=checkpoint.last_id,
+        end_time__lt=tz.now() - tz.timedelta(days=days),
+        sourcelog__isnull=True)
+    deleted = 0
+    while True:
+        pks = list(old.values_list('pk', flat=True)[:batchsize])
+        if not pks:
+            break
+        deleted += RequestLog.objects.filter(pk__in=pks).delete()[0]
+    logger.info("Pruned %s RequestLogs older than %s days", deleted, days)
+    return deleted
+
+
+"""
+Summaries
+---------
+Rows for the monitor pages
+"""
+
+
+def _group_start(start, interval):
+    """Start of the week or month containing a day rollup's start"""
+    start = tz.localtime(start)
+    if interval == "W":
+        return start - tz.timedelta(days=start.weekday())
+    if interval == "M":
+        return start.replace(day=1)
+    return start
+
+
+def request_summary(rollups, key):
+    """Rows summarizing RequestRollups grouped by key(rollup)"""
+    groups = defaultdict(list)
+    for rollup in rollups:
+        groups[key(rollup)].append(rollup)
+
+    rows = []
+    for group, members in sorted(groups.items()):
+        requests = sum(r.requests for r in members)
+        histogram = [sum(counts) for counts in zip(
+            *[r.histogram for r in members])]
+        codes = Counter()
+        for r in members:
+            codes.update(r.codes)
+        errors = sum(n for code, n in codes.items() if int(code) >= 400)
+        quantiles = [histogram_quantile(histogram, q)
+                     for q in (0.5, 0.95, 0.99)]
+        rows.append(list(group) + [
+            round(requests), sum(r.logged for r in members),
+            round(sum(r.delta for r in members) / requests, 3)
+            if requests else None,
+            *[round(v, 3) if v is not None else None for v in quantiles],
+            round(sum(r.wait for r in members) / requests, 3)
+            if requests else None,
+            round(errors)])
+    return rows
+
+
+REQUEST_COLUMNS = ["requests", "logged", "delta", "p50", "p95", "p99",
+                   "wait", "errors"]
+
+
+def request_tables(interval="H", days=None):
+    """Monitor tables of requests by period and by host/route"""
+    period = "hour" if interval == "H" else "day"
+    rollups = RequestRollup.objects.filter(period=period).order_by('start')
+    if days is not None:
+        rollups = rollups.filter(
+            start__gte=tz.now() - tz.timedelta(days=days))
+    rollups = list(rollups)
+
+    by_time = request_summary(
+        rollups, lambda r: (_group_start(r.start, interval),))
+    by_route = request_summary(rollups, lambda r: (r.host, r.route))
+    return [
+        {"title": "Requests", "colnames": ["end_time"] + REQUEST_COLUMNS,
+         "data": by_time},
+        {"title": "By host and route",
+         "colnames": ["host", "route"] + REQUEST_COLUMNS, "data": by_route},
+    ]
+
+
+def creation_table(model_name, interval="H", days=None):
+    """Monitor table of rows of a model created per period"""
+    period = "hour" if interval == "H" else "day"
+    rollups = CreationRollup.objects.filter(period=period, model=model_name)
+    if days is not None:
+        rollups = rollups.filter(
+            start__gte=tz.now() - tz.timedelta(days=days))
+
+    counts = Counter()
+    for start, count in rollups.values_list('start', 'count'):
+        counts[_group_start(start, interval)] += count
+    return {"title": "", "colnames": ["created", "count"],
+            "data": sorted([k, v] for k, v in counts.items())}
@@ -0,0 +1,307 @@
+"""
+Scrape jobs
+-----------
+Resumable crossref scrapes of journals and authors
+
+A ScrapeJob pages through crossref works with a deep-paging cursor.
+After each page is stored its checkpoint is saved: the next cursor,
+the works seen and stored so far and the last DOI seen. A job that is
+interrupted, by a rate limit or by its worker dying, carries on from
+its checkpoint when it is run again.
+
+Crossref cursors expire CURSOR_TTL after they were last used, so an
+older checkpoint restarts from the first page and skips the works
+already seen. Pages fetched ahead but not stored are lost to a live
+cursor, so a job resumed from one that ends short of crossref's total
+goes over the results once more from the start. Works that are already
+stored are skipped by ingest either way.
+
+Journal jobs can be split into sub-jobs for windows of issued dates,
+which separate workers run in parallel (see tasks.run_scrape_job and
+storage.JournalData.coverage).
+
+Sync jobs keep tracked journals up to date. Each fetches only the works
+created or updated on crossref since the journal's last sync
+(Journal.last_updated), filtered by SYNC_FILTER, and stores them over
+the works already stored. The watermark is moved on to the time the job
+was created once it finishes, so works updated while it ran are picked
+up by the next sync.
+"""
+
+import logging
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone as tz
+
+from papernet import ingest
+from papernet.data import cleaning
+from papernet.models import Journal, ScrapeJob
+from papernet.sources import crossref
+from papernet.sources.base import prefetch
+from papernet.sources.ratelimit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+# Works requested per page
+ROWS = 100
+
+# Works searched for by an author job
+AUTHOR_LIMIT = 200
+
+# How long crossref keeps an unused cursor
+CURSOR_TTL = tz.timedelta(minutes=5)
+
+# Jobs not checkpointed for this long are assumed to have lost their
+# worker, and are restarted by tasks.resume_scrape_jobs
+STALLED = tz.timedelta(
+    minutes=getattr(settings, 'PAPERNET_SCRAPE_STALLED_MINUTES', 30))
+
+UNFINISHED = ("PENDING", "IN PROGRESS")
+
+# Crossref filter selecting works changed since the last sync.
+# "from-index-date" also catches changes crossref makes itself, such as
+# citation counts, so matches many more works.
+SYNC_FILTER = getattr(settings, 'PAPERNET_SYNC_FILTER', "from-update-date")
+
+
+"""
+Creating jobs
+-------------
+"""
+
+
+def journal_job(issn, window=(None, None), limit=None, parent=None):
+    """The unfinished job scraping a journal, or a new one
+
+    `window` is a pair of dates limiting the works scraped to those
+    issued between them (inclusive). Jobs split into sub-jobs by
+    window_jobs are never returned, as they are run by their sub-jobs.
+    """
+    from_date, until_date = window
+    job = ScrapeJob.objects.filter(
+        kind="journal", key=issn, from_date=from_date, until_date=until_date,
+        parent=parent, status__in=UNFINISHED, subjobs__isnull=True).order_by(
+            '-updated').first()
+    if job is None:
+        job = ScrapeJob.objects.create(
+            kind="journal", key=issn, from_date=from_date,
+            until_date=until_date, limit=limit, parent=parent)
+    return job
+
+
+def sync_job(journal):
+    """The unfinished job syncing a journal, or a new one
+
+    A journal that has never been synced has all of its works scraped.
+    """
+    job = ScrapeJob.objects.filter(
+        kind="sync", key=journal.issn, status__in=UNFINISHED).order_by(
+            '-updated').first()
+    if job is None:
+        since = journal.last_updated
+        job = ScrapeJob.objects.create(
+            kind="sync", key=journal.issn,
+            since=tz.localdate(since) if since else None)
+    return job
+
+
+def author_job(author, limit=AUTHOR_LIMIT):
+    """The unfinished job searching for an author's works, or a new one"""
+    name = " ".join([author.get('given', ''), author.get('family', '')])
+    if not name.strip():
+        raise ValueError("Length of author names must be > 1")
+
+    job = ScrapeJob.objects.filter(
+        kind="author", key=name, status__in=UNFINISHED).order_by(
+            '-updated').first()
+    if job is None:
+        job = ScrapeJob.objects.create(kind="author", key=name, params=author,
+                                       limit=limit)
+    return job
+
+
+def window_jobs(issn, windows):
+    """A job for a journal split into a sub-job for each date window"""
+    parent = ScrapeJob.objects.create(kind="journal", key=issn,
+                                      status="IN PROGRESS")
+    for window in windows:
+        journal_job(issn, window, parent=parent)
+    _update_parent(parent)
+    return parent
+
+
+"""
+Running jobs
+------------
+"""
+
+
+def journal_filters(issn, window=(None, None), since=None):
+    """Crossref filters for a journal's works issued in a date window
+
+    With `since`, only works updated since that date are matched.
+    """
+    filters = f"issn:{issn}"
+    from_date, until_date = window
+    if from_date is not None:
+        filters += f",from-issued-date:{from_date.isoformat()}"
+    if until_date is not None:
+        filters += f",until-issued-date:{until_date.isoformat()}"
+    if since is not None:
+        filters += f",{SYNC_FILTER}:{since.isoformat()}"
+    return filters
+
+
+def _pages(job, cursor, limit):
+    """Crossref pages of the job's works, starting at cursor"""
+    if job.kind == "author":
+        query = {"query.author": job.key}
+        return crossref.iter_pages(sort=None, order=None, rows=ROWS,
+                                   limit=limit, query=query, cursor=cursor)
+
+    filters = journal_filters(job.key, (job.from_date, job.until_date),
+                              job.since)
+    return crossref.iter_pages(filters, rows=ROWS, limit=limit,
+                               cursor=cursor)
+
+
+def _store(job, items):
+    """Store works seen by the job, returning the number stored"""
+    if job.kind == "author":
+        matched = [work for work in items if cleaning.match_authors(
+            job.params, work.get('author', []))]
+        job.rejected += len(items) - len(matched)
+        items = matched
+    # Works updated since the last sync replace those stored
+    force = job.kind == "sync" and job.since is not None
+    return ingest.add_works(items, force=force)['stored']
+
+
+def _scrape(job, on_page, prefetch_pages):
+    """Page through the job's works from its checkpoint
+
+    Returns True if a live cursor was carried on from.
+    """
+    live = job.cursor != "*" and job.updated > tz.now() - CURSOR_TTL
+    if live:
+        cursor, skip = job.cursor, 0
+        limit = job.limit - job.works if job.limit is not None else None
+    else:
+        cursor, skip, limit = "*", job.works, job.limit
+        if skip:
+            logger.info("Cursor for %s has expired, skipping %s works seen",
+                        job, skip)
+
+    job.status = "IN PROGRESS"
+    job.error = ""
+    job.save()
+
+    for page in prefetch(_pages(job, cursor, limit), prefetch_pages):
+        items = page.items
+        if skip:
+            seen, items = items[:skip], items[skip:]
+            skip -= len(seen)
+            if not skip and seen[-1].get('DOI') != job.last_doi:
+                logger.info("Results for %s have shifted since %s",
+                            job, job.last_doi)
+
+        if items:
+            job.stored += _store(job, items)
+            job.works += len(items)
+            job.last_doi = items[-1].get('DOI', "")
+        job.cursor = page.cursor or job.cursor
+        job.total = page.total
+        job.save()
+        if on_page is not None:
+            on_page(job)
+
+    return live
+
+
+def _expected(job):
+    """Works the job should see when finished"""
+    if job.total is None:
+        return 0
+    return min(job.total, job.limit) if job.limit is not None else job.total
+
+
+def _update_parent(parent):
+    """Finish a job once all of its sub-jobs have"""
+    statuses = set(parent.subjobs.values_list('status', flat=True))
+    if statuses & set(UNFINISHED):
+        return
+    parent.status = "FAILURE" if "FAILURE" in statuses else "SUCCESS"
+    parent.finished = tz.now()
+    parent.save()
+
+
+def run(job, on_page=None, prefetch_pages=crossref.PREFETCH_PAGES):
+    """Run a job from its checkpoint until it is finished
+
+    `on_page(job)` is called after each checkpoint. A RateLimited error
+    leaves the job in progress to be run again; other errors fail it.
+    """
+    if job.status == "SUCCESS":
+        return job
+    if job.subjobs.exists():
+        raise ValueError(f"{job} is run by its sub-jobs")
+
+    try:
+        live = _scrape(job, on_page, prefetch_pages)
+        if live and job.works < _expected(job):
+            logger.warning("%s resumed short of %s works, starting over",
+                           job, job.total)
+            job.cursor = "*"
+            job.works = job.stored = job.rejected = 0
+            _scrape(job, on_page, prefetch_pages)
+    except RateLimited:
+        raise
+    except Exception as e:
+        job.status = "FAILURE"
+        job.error = repr(e)
+        job.save()
+        if job.parent_id:
+            _update_parent(job.parent)
+        raise
+
+    job.status = "SUCCESS"
+    job.finished = tz.now()
+    job.save()
+    logger.info("Finished %s: stored %s", job, job.stored)
+    if job.kind == "sync":
+        Journal.objects.filter(issn=job.key).update(last_updated=job.created)
+    if job.parent_id:
+        _update_parent(job.parent)
+    return job
+
+
+def stalled(age=STALLED):
+    """Jobs that haven't been checkpointed for `age`
+
+    Either in progress, or queued to a task that never started them.
+    """
+    return ScrapeJob.objects.filter(
+        Q(status="IN PROGRESS") | Q(status="PENDING") & ~Q(task_id=""),
+        subjobs__isnull=True, updated__lt=tz.now() - age)
+
+
+def claim(job, task_id):
+    """Take a job for a task to run, unless another task has it
+
+    The job is claimed with a conditional update, so that if a task is
+    redelivered after resume_scrape_jobs queued its job again, only one
+    of them runs it. Returns True if the job was claimed.
+    """
+    claimed = ScrapeJob.objects.filter(
+        pk=job.pk, task_id__in=[task_id, ""]).exclude(
+            status="SUCCESS").update(task_id=task_id)
+    if claimed:
+        job.task_id = task_id
+    return bool(claimed)
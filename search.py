@@ -0,0 +1,322 @@
+"""
+Search
+------
+Full-text search over papers using the database's own text index
+
+SQLite uses an FTS5 table ranked with BM25, PostgreSQL a tsvector
+column with a GIN index ranked with ts_rank_cd. Other databases fall
+back to substring matching on titles. Text relevance is combined with
+the paper's local citation count.
+"""
+
+import logging
+import math
+import re
+
+from django.db import connection
+from django.db.models import Max
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.db.models.expressions import RawSQL
+
+from papernet.models import Authorship, Paper, Publication
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+FTS_TABLE = "papernet_paper_fts"
+TSV_TABLE = "papernet_paper_search"
+
+# Columns in the order they are stored in the index
+FIELDS = ("title", "subtitle", "abstract", "keywords", "authors", "journal")
+
+# BM25 column weights, in FIELDS order
+FTS_WEIGHTS = (10.0, 5.0, 1.0, 2.0, 3.0, 1.0)
+
+# tsvector weight labels, in FIELDS order
+TSV_WEIGHTS = ("A", "B", "D", "C", "B", "C")
+
+# Text matches re-ranked by citations for every result returned
+CANDIDATE_FACTOR = 10
+MIN_CANDIDATES = 100
+
+# Strength of the citation boost relative to text relevance
+CITATION_WEIGHT = 0.5
+
+INDEX_CHUNKSIZE = 500
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def tokenize(query):
+    """Split a user query into plain word tokens"""
+    return re.findall(r"\w+", query or "")
+
+
+def documents(pks):
+    """Return {pk: {field: text}} for papers, using three queries"""
+    papers = Paper.objects.filter(pk__in=pks)
+    docs = {row['pk']: dict(row, authors=[], journal=[])
+            for row in papers.values('pk', *FIELDS[:4])}
+
+    ships = Authorship.objects.filter(paper__in=pks).order_by('pk')
+    for paper, first, last in ships.values_list(
+            'paper', 'author__first_name', 'author__last_name'):
+        docs[paper]['authors'].append(f"{first} {last}")
+
+    pubs = Publication.objects.filter(paper__in=pks, journal__isnull=False)
+    for paper, title, abbreviation in pubs.values_list(
+            'paper', 'journal__title', 'journal__abbreviation'):
+        docs[paper]['journal'] += [title, abbreviation]
+
+    for doc in docs.values():
+        doc['authors'] = ", ".join(doc['authors'])
+        doc['journal'] = " ".join(t for t in doc['journal'] if t)
+
+    return docs
+
+
+def rerank(ranked, n):
+    """Combine text relevance with citation counts
+
+    Parameters
+    ----------
+    ranked : list of (int, float)
+        Paper pks and a positive text relevance score.
+    n : int
+        Number of results to return.
+    """
+    pks = [pk for pk, score in ranked]
+    cites = dict(Paper.objects.filter(pk__in=pks).values_list(
+        'pk', 'cited_by_count'))
+
+    scored = [(pk, score * (1 + CITATION_WEIGHT * math.log1p(cites[pk])))
+              for pk, score in ranked if pk in cites]
+    scored.sort(key=lambda x: -x[1])
+    return scored[:n]
+
+
+"""
+Backends
+--------
+"""
+
+
+class SearchBackend():
+    """Substring search on titles, for databases without an index"""
+
+    def search(self, query, n=20):
+        """Return up to n (pk, score) pairs, best first"""
+        papers = Paper.objects.filter(title__icontains=query)
+        papers = papers.order_by('-cited_by_count')[:n]
+        return [(pk, cites) for pk, cites in papers.values_list(
+            'pk', 'cited_by_count')]
+
+    def filter(self, papers, query):
+        """Filter a Paper queryset to every match, in the database"""
+        return papers.filter(title__icontains=query)
+
+    def index(self, pks):
+        """Add or replace index entries for papers"""
+        pass
+
+    def remove(self, pks):
+        """Remove index entries for papers"""
+        pass
+
+    def clear(self):
+        """Remove every entry from the index"""
+        pass
+
+    def rebuild(self, chunksize=INDEX_CHUNKSIZE):
+        """Reindex every paper"""
+        self.clear()
+        max_pk = Paper.objects.aggregate(Max('pk'))['pk__max'] or 0
+        for start in range(0, max_pk + 1, chunksize):
+            self.index(range(start, start + chunksize))
+
+
+class SQLiteBackend(SearchBackend):
+    """SQLite FTS5 index ranked by BM25"""
+
+    @staticmethod
+    def match_expression(query):
+        """FTS5 query matching every token, the last as a prefix"""
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        terms = [f'"{token}"' for token in tokens]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(self, query, n=20):
+        match = self.match_expression(query)
+        if match is None:
+            return []
+
+        weights = ", ".join(str(w) for w in FTS_WEIGHTS)
+        sql = (f"SELECT rowid, bm25({FTS_TABLE}, {weights}) FROM {FTS_TABLE} "
+               f"WHERE {FTS_TABLE} MATCH %s ORDER BY 2 LIMIT %s")
+        limit = max(n * CANDIDATE_FACTOR, MIN_CANDIDATES)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [match, limit])
+            # bm25() is negative, lower is better
+            ranked = [(pk, -rank) for pk, rank in cursor.fetchall()]
+
+        return rerank(ranked, n)
+
+    def filter(self, papers, query):
+        match = self.match_expression(query)
+        if match is None:
+            return papers.none()
+        matches = RawSQL(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+            [match])
+        return papers.filter(pk__in=matches)
+
+    def index(self, pks):
+        pks = list(pks)
+        if not pks:
+            return
+        docs = documents(pks)
+        columns = ", ".join(FIELDS)
+        params = ", ".join(["%s"] * (len(FIELDS) + 1))
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN "
+                f"({', '.join(['%s'] * len(pks))})", pks)
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, {columns}) "
+                f"VALUES ({params})",
+                [[pk] + [doc[f] for f in FIELDS] for pk, doc in docs.items()])
+
+    def remove(self, pks):
+        pks = list(pks)
+        if not pks:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN "
+                f"({', '.join(['%s'] * len(pks))})", pks)
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+
+class PostgresBackend(SearchBackend):
+    """PostgreSQL tsvector index with a GIN index
+
+    Postgres has no built-in BM25, so matches are ranked with
+    ts_rank_cd normalized by document length. Rows are removed with
+    their paper by the foreign key's ON DELETE CASCADE.
+    """
+
+    CONFIG = "english"
+
+    @staticmethod
+    def tsquery(query):
+        """to_tsquery input matching every token, the last as a prefix"""
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        tokens[-1] += ":*"
+        return " & ".join(tokens)
+
+    def search(self, query, n=20):
+        tsquery = self.tsquery(query)
+        if tsquery is None:
+            return []
+
+        sql = (f"SELECT paper_id, ts_rank_cd(document, query, 32) "
+               f"FROM {TSV_TABLE}, to_tsquery(%s, %s) query "
+               f"WHERE document @@ query ORDER BY 2 DESC LIMIT %s")
+        limit = max(n * CANDIDATE_FACTOR, MIN_CANDIDATES)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.CONFIG, tsquery, limit])
+            ranked = cursor.fetchall()
+
+        return rerank(ranked, n)
+
+    def filter(self, papers, query):
+        tsquery = self.tsquery(query)
+        if tsquery is None:
+            return papers.none()
+        matches = RawSQL(
+            f"SELECT paper_id FROM {TSV_TABLE} "
+            f"WHERE document @@ to_tsquery(%s, %s)", [self.CONFIG, tsquery])
+        return papers.filter(pk__in=matches)
+
+    def index(self, pks):
+        docs = documents(list(pks))
+        vector = " || ".join(
+            f"setweight(to_tsvector('{self.CONFIG}', %s), '{weight}')"
+            for weight in TSV_WEIGHTS)
+
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {TSV_TABLE} (paper_id, document) "
+                f"VALUES (%s, {vector}) ON CONFLICT (paper_id) "
+                f"DO UPDATE SET document = EXCLUDED.document",
+                [[pk] + [doc[f] for f in FIELDS] for pk, doc in docs.items()])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {TSV_TABLE}")
+
+
+BACKENDS = {
+    "sqlite": SQLiteBackend,
+    "postgresql": PostgresBackend,
+}
+
+
+def get_backend():
+    """Return the search backend for the database vendor"""
+    return BACKENDS.get(connection.vendor, SearchBackend)()
+
+
+"""
+Public API
+----------
+"""
+
+
+def search_papers(query, n=20):
+    """Return pks of the n best matching papers, best first"""
+    results = get_backend().search(query, n=n)
+    logger.debug("Search '%s' matched %s papers", query, len(results))
+    return [pk for pk, score in results]
+
+
+def filter_papers(papers, query):
+    """Filter a Paper queryset to those matching query, unranked"""
+    return get_backend().filter(papers, query)
+
+
+def index_papers(pks):
+    """Update the search index for papers"""
+    get_backend().index(pks)
+
+
+def remove_papers(pks):
+    """Remove papers from the search index"""
+    get_backend().remove(pks)
+
+
+@receiver(post_delete, sender=Paper)
+def remove_deleted_paper(sender, instance, **kwargs):
+    """Remove a deleted paper from the search index"""
+    remove_papers([instance.pk])
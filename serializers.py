@@ -0,0 +1,207 @@
+"""
+Serializers
+-----------
+Serialize collections of models with a fixed number of queries
+"""
+
+from django.db.models import Count, Prefetch, Sum, prefetch_related_objects
+
+from papernet.data import cleaning
+from papernet.models import (Authorship, Paper, Perusal, Publication,
+                             extract_dates, extract_titles, format_ref)
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def _count_by(queryset, field):
+    """Return a dict mapping values of `field` to the number of rows"""
+    rows = queryset.values(field).annotate(n=Count('pk')).order_by()
+    return {row[field]: row['n'] for row in rows}
+
+
+def prefetch_papers(papers):
+    """Attach authors and publications to papers
+
+    Parameters
+    ----------
+    papers : iterable of papernet.models.Paper
+        A queryset or a list of papers. Querysets are evaluated once.
+
+    Returns
+    -------
+    list of papernet.models.Paper
+        The papers in their original order, ready to be serialized
+        without further queries.
+    """
+    papers = [paper for paper in papers if paper is not None]
+    if not papers:
+        return papers
+
+    authorships = Authorship.objects.select_related('author').order_by('pk')
+    publications = Publication.objects.select_related('journal')
+    prefetch_related_objects(
+        papers,
+        Prefetch('authorship_set', queryset=authorships),
+        Prefetch('publication_set', queryset=publications.order_by('pk')))
+
+    return papers
+
+
+def prefetch_authors(authors):
+    """Attach paper and citation counts to authors"""
+    authors = list(authors)
+    pks = set(author.pk for author in authors)
+
+    ships = Authorship.objects.filter(author__in=pks)
+    paper_counts = _count_by(ships, 'author')
+
+    papers = Paper.objects.filter(authorship__author__in=pks)
+    sums = papers.values('authorship__author').annotate(
+        n=Sum('citations_count')).order_by()
+    citation_counts = {row['authorship__author']: row['n'] for row in sums}
+
+    for author in authors:
+        author._paper_count = paper_counts.get(author.pk, 0)
+        # Mirror Sum(): authors without papers have no citation count
+        if author._paper_count:
+            author._citation_count = citation_counts.get(author.pk, 0)
+        else:
+            author._citation_count = None
+
+    return authors
+
+
+"""
+Papers
+------
+"""
+
+
+def paper_previews(papers):
+    """Return `Paper.preview` for each paper"""
+    return [paper.preview for paper in prefetch_papers(papers)]
+
+
+def paper_data(papers):
+    """Return `Paper.data` for each paper"""
+    papers = prefetch_papers(papers)
+    prefetch_authors([a.author for paper in papers
+                      for a in paper.authorship_set.all()])
+    return [paper.data for paper in papers]
+
+
+def crossref_previews(works):
+    """Return `Paper.preview`-shaped dicts straight from crossref works
+
+    Papers are reserved by DOI (without retrieving them) so that each
+    preview has a pk, using two queries for the whole batch.
+    """
+    dois = {}
+    for work in works:
+        try:
+            dois[work['DOI']] = cleaning.clean_doi(work['DOI'])
+        except ValueError:
+            continue
+    Paper.objects.bulk_create([Paper(doi=doi) for doi in dois.values()],
+                              ignore_conflicts=True)
+    papers = Paper.objects.filter(doi__in=dois.values()).values_list(
+        'doi', 'pk', 'cited_by_count')
+    found = {doi: (pk, cites) for doi, pk, cites in papers}
+
+    out = []
+    for work in works:
+        title, short_title = extract_titles(work)
+        dates = [d for d in extract_dates(work).values() if d]
+        year = min(dates).year if dates else None
+        names = [a['family'] for a in work.get('author', [])
+                 if a.get('family')]
+        doi = dois.get(work['DOI'], work['DOI'])
+        pk, cites = found.get(doi, (None, 0))
+
+        out.append({
+            "title": title or "",
+            "short_title": short_title or "",
+            "ref": format_ref(names, year),
+            "doi": doi,
+            "cites": cites,
+            "pk": pk,
+            "year": year,
+        })
+    return out
+
+
+"""
+Authors
+-------
+"""
+
+
+def author_data(authors):
+    """Return `Author.data` for each author
+
+    Each author's top papers and coauthors take a query or two per
+    author; their details are fetched for every author together.
+    """
+    authors = prefetch_authors(authors)
+    papers = {author.pk: list(author.get_papers()) for author in authors}
+    found = {data['pk']: data for data in paper_data(
+        [paper for top in papers.values() for paper in top])}
+
+    out = []
+    for author in authors:
+        data = {"first_name": author.first_name,
+                "last_name": author.last_name,
+                "name": str(author),
+                "pk": author.pk,
+                "paper_count": author.paper_count,
+                "citation_count": author.citation_count()}
+        data['papers'] = [found[paper.pk] for paper in papers[author.pk]]
+        data['coauthors'] = author.get_coauthors(n=5)
+        out.append(data)
+    return out
+
+
+"""
+Readers
+-------
+"""
+
+
+def perusal_data(perusals):
+    """Return `Perusal.data` for each perusal
+
+    Perusals may be unsaved (see views.paper_view), and have no tags.
+    """
+    perusals = list(perusals)
+    prefetch_related_objects(
+        [perusal for perusal in perusals if perusal.pk is not None],
+        'project', 'tag_set')
+    prefetch_related_objects(perusals, 'paper')
+    papers = prefetch_papers([perusal.paper for perusal in perusals])
+    prefetch_authors([a.author for paper in papers
+                      for a in paper.authorship_set.all()])
+    return [perusal.data for perusal in perusals]
+
+
+def perusal_previews(perusals):
+    """Return `Perusal.preview` for each perusal"""
+    perusals = list(perusals)
+    prefetch_related_objects(perusals, 'paper')
+    prefetch_papers([perusal.paper for perusal in perusals])
+    return [perusal.preview for perusal in perusals]
+
+
+def project_previews(projects):
+    """Return `Project.preview` for each project"""
+    projects = list(projects)
+    pks = [project.pk for project in projects]
+    counts = _count_by(Perusal.objects.filter(project__in=pks), 'project')
+
+    for project in projects:
+        project._paper_count = counts.get(project.pk, 0)
+
+    return [project.preview for project in projects]
@@ -1 +1,2 @@
-from papernet.sources.sources import get_fulltext, get_work, search
+from papernet.sources.sources import (get_fulltext, get_journal, get_work,
+                                      get_work_many, search)
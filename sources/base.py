@@ -2,16 +2,23 @@
 Base Classes for sources
 ------------------------
 """
-from functools import wraps
+import asyncio
+import json
 import logging
-from inspect import signature
-from urllib.parse import urljoin, urlencode
+import threading
+from queue import Full, Queue
+from urllib.parse import urljoin, urlencode, urlsplit
 
+import httpx
 import requests
-from django.core.cache import cache
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
 from django.utils import timezone as tz
 
 from papernet.models import pipeline
+from papernet.sources import cache, cassette, ratelimit
+from papernet.sources.ratelimit import RateLimited
 
 """
 Constants
@@ -19,9 +26,13 @@ Constants
 """
 logger = logging.getLogger()
 
-SESSION = requests.Session()
+SESSION = cassette.install(requests.Session())
 
-CACHE_TIMEOUT = 60 * 60 * 24 * 30  # 1 month
+# Async sources: concurrent requests per host and pooled connections
+HTTP_CONCURRENCY = getattr(settings, 'PAPERNET_HTTP_CONCURRENCY', 8)
+HTTP_MAX_CONNECTIONS = getattr(settings, 'PAPERNET_HTTP_MAX_CONNECTIONS', 20)
+HTTP_TIMEOUT = getattr(settings, 'PAPERNET_HTTP_TIMEOUT', 30)
+HTTP_RETRIES = 3
 
 """
 Helper functions
@@ -53,61 +64,49 @@ def build_filter(from_date=None, until_date=None, abstract=None, **kwargs):
     return ",".join(filter_strings)
 
 
-"""
-Cache
------
-"""
-
-
-def check_cache(url):
-    """Return cached data if available"""
-    data = cache.get(url)
-    if data is not None:
-        logger.info("Retrieved %s from cache: %.20s", url, data)
-        return data
-    logger.debug("Cache %s not found", url)
+def prefetch(iterable, size=4):
+    """Iterate over iterable in a background thread
 
-
-def set_cache(url, data, timeout=CACHE_TIMEOUT):
-    """Cache `data` with key `url` for `timeout`"""
-    cache.set(url, data, timeout)
-    logger.debug("Cached response from %s for %r", url, timeout)
-
-
-def cache_response(func):
-    """Get and set results from inner in cache
-    ----
-    To be replaced with SourceLog system
+    Up to `size` items are fetched ahead of the consumer, so that
+    fetching the next page overlaps with processing the current one.
+    Exceptions raised by the iterable are raised to the consumer.
     """
-    @wraps(func)
-    def request(*args, **kwargs):
-
-        # ignore cache if force is True
-        force = kwargs.pop("force", False)
-
-        # Build URL and check cache
-        arguments = signature(func).bind(*args, **kwargs).arguments
-        url = arguments.get('url', "")
-        params = arguments.get('params', {})
-        full_url = encode_url(url, params)
-
-        if not force:
-            cached = check_cache(full_url)
-
-            if cached is not None:
-
-                # Return result
-                return cached
-
-        # Get fresh result
-        res = func(*args, **kwargs)
-
-        # Set cache with result if response is ok
-        if res.ok:
-            set_cache(full_url, res, CACHE_TIMEOUT)
-        return res
-
-    return request
+    queue = Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(message):
+        # Give up if the consumer has stopped listening
+        while not stop.is_set():
+            try:
+                queue.put(message, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+        finally:
+            connections.close_all()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            ok, value = queue.get()
+            if ok:
+                yield value
+            elif value is None:
+                return
+            else:
+                raise value
+    finally:
+        stop.set()
 
 
 """
@@ -122,6 +121,16 @@ Requests
 """
 
 
+def _update_cache(result, key, entry):
+    """Decode a result's JSON through the response cache"""
+    try:
+        result.payload, result.cached = cache.update(
+            key, entry, result.response)
+    except ValueError:
+        # Not JSON; left to the caller
+        pass
+
+
 class Data():
     """Store information about how source data is used"""
     def __init__(self, request, response, data):
@@ -140,13 +149,24 @@ class Data():
 
 
 class Result():
-    """Result of Data Source query"""
-    def __init__(self, request, response):
+    """Result of Data Source query
+
+    Results served from the response cache have no request or response.
+    """
+    def __init__(self, request, response, payload=None, cached=False):
         """Initialize result"""
         self.request = request
         self.response = response
+        self.payload = payload
+        self.cached = cached
         self.data = None
 
+    def json(self):
+        """The decoded JSON body"""
+        if self.payload is None:
+            self.payload = json.loads(self.response.content)
+        return self.payload
+
 
 class DataSource():
     """ABC for all data sources"""
@@ -155,20 +175,29 @@ class DataSource():
         self.session = session or SESSION
         self.history = []
 
-    # @cache_response
     def _get_url(self, url, params=None, **kwargs):
 
         # ignore cache if force is True
+        force = kwargs.pop("force", False)
         no_wait = kwargs.pop("no_wait", False)
 
         params = params or {}
 
+        key = cache.cache_key(url, params)
+        data, entry = cache.lookup(key, force=force)
+        if data is not None:
+            return Result(request=None, response=None, payload=data,
+                          cached=True)
+        if entry is not None:
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **entry.conditional_headers())
+
         # Initialize wait
         wait = 0
 
         # Rate Limit Request
         if not no_wait:
-            wait = pipeline.rate_limit(url=url, params=params)
+            wait = ratelimit.wait(url)
 
         # Log start time
         start_time = tz.now()
@@ -182,11 +211,92 @@ class DataSource():
             url=url, params=params, start_time=start_time,
             end_time=end_time, response=response, wait=wait)
 
+        ratelimit.check_response(
+            url, response, (end_time - start_time).total_seconds())
+
         result = Result(request=request, response=response)
+        _update_cache(result, key, entry)
 
         return result
 
 
+class AsyncDataSource():
+    """ABC for data sources queried concurrently with asyncio
+
+    Requests share one keep-alive connection pool and at most
+    `concurrency` requests are in flight to any one host. Use as an
+    async context manager, or pass in an open httpx.AsyncClient.
+    """
+    headers = {}
+
+    def __init__(self, client=None, concurrency=HTTP_CONCURRENCY):
+        self.client = client
+        self.concurrency = concurrency
+        self._own_client = client is None
+        self._semaphores = {}
+
+    async def __aenter__(self):
+        if self.client is None:
+            limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                  max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+            self.client = httpx.AsyncClient(
+                headers=self.headers, limits=limits, timeout=HTTP_TIMEOUT,
+                transport=cassette.async_transport(limits))
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._own_client:
+            await self.client.aclose()
+            self.client = None
+
+    def _semaphore(self, url):
+        """Semaphore limiting concurrent requests to the url's host"""
+        host = urlsplit(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[host]
+
+    async def _get_url(self, url, params=None, **kwargs):
+        force = kwargs.pop("force", False)
+        params = params or {}
+
+        key = cache.cache_key(url, params)
+        data, entry = cache.lookup(key, force=force)
+        if data is not None:
+            return Result(request=None, response=None, payload=data,
+                          cached=True)
+        if entry is not None:
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **entry.conditional_headers())
+
+        for attempt in range(HTTP_RETRIES + 1):
+            # Rate limit without blocking the event loop
+            wait = await sync_to_async(ratelimit.reserve)(
+                url, max_wait=HTTP_TIMEOUT)
+            await asyncio.sleep(wait)
+
+            async with self._semaphore(url):
+                start_time = tz.now()
+                response = await self.client.get(url, params=params, **kwargs)
+                end_time = tz.now()
+
+            # Store log
+            request = await sync_to_async(pipeline.log_request)(
+                url=url, params=params, start_time=start_time,
+                end_time=end_time, response=response, wait=wait)
+
+            try:
+                await sync_to_async(ratelimit.check_response)(
+                    url, response, (end_time - start_time).total_seconds())
+            except RateLimited:
+                if attempt == HTTP_RETRIES:
+                    raise
+            else:
+                result = Result(request=request, response=response)
+                _update_cache(result, key, entry)
+                return result
+
+
 class FulltextSource():
     """Base class for fulltext sources"""
     pass
@@ -0,0 +1,223 @@
+"""
+Response cache
+--------------
+Decoded JSON from source APIs, compressed in a size-bounded LRU
+
+Entries are keyed by the normalized url and query params. An entry is
+served without a request for PAPERNET_HTTP_CACHE_TTL seconds; after
+that it is revalidated with If-None-Match/If-Modified-Since and a 304
+keeps it. The least recently used entries are evicted once the cache
+holds more than PAPERNET_HTTP_CACHE_SIZE compressed bytes. Each
+process has its own cache; lookups are also counted per thread so a
+request's hits can be attributed to it.
+"""
+
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+CACHE_SIZE = getattr(settings, 'PAPERNET_HTTP_CACHE_SIZE', 64 * 2 ** 20)
+CACHE_TTL = getattr(settings, 'PAPERNET_HTTP_CACHE_TTL', 60 * 60 * 24)
+
+# Larger responses aren't cached
+MAX_ENTRY_FRACTION = 0.1
+
+COMPRESS_LEVEL = 6
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def cache_key(url, params=None):
+    """Normalized url: lowercase host, sorted params, no empty values"""
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    query += [(k, v) for k, v in (params or {}).items() if v is not None]
+    query = urlencode(sorted((str(k), str(v)) for k, v in query))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path, query, ""))
+
+
+def validators(headers):
+    """ETag and Last-Modified from response headers"""
+    return headers.get("ETag"), headers.get("Last-Modified")
+
+
+"""
+Cache
+-----
+"""
+
+
+class Entry():
+    """Compressed JSON with its validators"""
+    __slots__ = ("payload", "etag", "last_modified", "stored")
+
+    def __init__(self, payload, etag=None, last_modified=None):
+        self.payload = payload
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = time.monotonic()
+
+    def __len__(self):
+        return len(self.payload)
+
+    @property
+    def data(self):
+        return json.loads(zlib.decompress(self.payload))
+
+    def fresh(self, ttl=CACHE_TTL):
+        return time.monotonic() - self.stored < ttl
+
+    def conditional_headers(self):
+        """Headers to revalidate the entry"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache():
+    """LRU of entries bounded by their total compressed size"""
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the entry for key (fresh or not), or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, data, headers=None):
+        """Store JSON-serializable data for key"""
+        payload = zlib.compress(json.dumps(data).encode(), COMPRESS_LEVEL)
+        if len(payload) > self.max_size * MAX_ENTRY_FRACTION:
+            self.counts['too large'] += 1
+            return None
+
+        entry = Entry(payload, *validators(headers or {}))
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = entry
+            self.size += len(entry)
+            self.counts['stores'] += 1
+
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.counts['evictions'] += 1
+        return entry
+
+    def touch(self, entry):
+        """Mark a revalidated entry as fresh"""
+        entry.stored = time.monotonic()
+
+    def record(self, outcome):
+        """Count a lookup: 'hits', 'revalidated' or 'misses'"""
+        self.counts[outcome] += 1
+        thread_counts()[outcome] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Counts, hit rate and size"""
+        lookups = sum(self.counts[k] for k in ('hits', 'revalidated',
+                                               'misses'))
+        served = self.counts['hits'] + self.counts['revalidated']
+        return dict(self.counts, entries=len(self.entries), size=self.size,
+                    max_size=self.max_size, lookups=lookups,
+                    hit_rate=served / lookups if lookups else None)
+
+
+_cache = ResponseCache()
+_local = threading.local()
+
+
+def get_cache():
+    """Return the process-wide response cache"""
+    return _cache
+
+
+def stats():
+    return _cache.stats()
+
+
+def thread_counts():
+    """Counter of lookups made by the current thread"""
+    if not hasattr(_local, 'counts'):
+        _local.counts = Counter()
+    return _local.counts
+
+
+"""
+Requests
+--------
+Used by sources around each request
+"""
+
+
+def lookup(key, force=False):
+    """Return (data, entry) for a request about to be made
+
+    `data` is set when the cached entry is fresh and can be served
+    without a request. Otherwise `entry` is a stale entry (or None),
+    whose `conditional_headers()` should be sent with the request.
+    """
+    if force:
+        return None, None
+
+    entry = _cache.get(key)
+    if entry is not None and entry.fresh(_cache.ttl):
+        _cache.record('hits')
+        return entry.data, entry
+    return None, entry
+
+
+def update(key, entry, response):
+    """Return (data, cached) for a response, updating the cache
+
+    A 304 revalidates `entry`; a 200 is decoded and stored. Raises
+    ValueError if the response isn't JSON.
+    """
+    if entry is not None and response.status_code == 304:
+        _cache.touch(entry)
+        _cache.record('revalidated')
+        return entry.data, True
+
+    _cache.record('misses')
+    data = json.loads(response.content)
+    if response.status_code == 200:
+        _cache.set(key, data, response.headers)
+    return data, False
@@ -0,0 +1,355 @@
+"""
+Cassettes
+---------
+Record source API responses to a file and replay them offline
+
+With PAPERNET_CASSETTE_MODE = "record", every GET made through the
+source sessions and async clients is appended to the JSON lines file
+PAPERNET_CASSETTE. With "replay", responses are served from that file
+and nothing goes over the network.
+
+ReplayServer serves a cassette over HTTP instead, with added latency
+and injected 429s, as a stand-in for the live APIs. Point
+PAPERNET_CROSSREF_URL and PAPERNET_COCI_URL at it, prefixed with the
+original host, e.g. http://127.0.0.1:8001/api.crossref.org/
+"""
+
+import base64
+import fcntl
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from papernet.sources.cache import cache_key
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+CASSETTE = getattr(settings, 'PAPERNET_CASSETTE', None)
+CASSETTE_MODE = getattr(settings, 'PAPERNET_CASSETTE_MODE', None)
+
+# Location is kept so that recorded redirects (e.g. w3id.org for COCI)
+# are followed on replay
+RECORD_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Location",
+                  "X-Rate-Limit-Limit", "X-Rate-Limit-Interval")
+
+NOT_FOUND = b"Resource not found."
+
+
+def interaction_key(url):
+    """Normalized url without its scheme"""
+    return cache_key(url).split("://", 1)[-1]
+
+
+"""
+Cassette
+--------
+"""
+
+
+class Cassette():
+    """Recorded interactions in a JSON lines file, or in memory if no path"""
+
+    def __init__(self, path):
+        self.path = path
+        self._interactions = None if path else {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.interactions)
+
+    @property
+    def interactions(self):
+        """Interactions by key, loaded on first use"""
+        if self._interactions is None:
+            interactions = {}
+            with open(self.path) as f:
+                for line in f:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        interactions[interaction['key']] = interaction
+            self._interactions = interactions
+            logger.info("Loaded %s interactions from %s",
+                        len(interactions), self.path)
+        return self._interactions
+
+    def get(self, url):
+        """Return (status, headers, body) recorded for url, or None"""
+        interaction = self.interactions.get(interaction_key(url))
+        if interaction is None:
+            return None
+
+        body = interaction['body']
+        if interaction.get('encoding') == "base64":
+            body = base64.b64decode(body)
+        else:
+            body = body.encode()
+        return interaction['status'], interaction['headers'], body
+
+    def record(self, url, status, headers, body, elapsed=0):
+        """Append an interaction"""
+        interaction = {
+            "key": interaction_key(url),
+            "url": url,
+            "status": status,
+            "headers": {h: headers[h] for h in RECORD_HEADERS if h in headers},
+            "elapsed": elapsed,
+        }
+        try:
+            interaction['body'] = body.decode()
+        except UnicodeDecodeError:
+            interaction['body'] = base64.b64encode(body).decode()
+            interaction['encoding'] = "base64"
+
+        if self._interactions is not None:
+            self._interactions[interaction['key']] = interaction
+        if not self.path:
+            return
+
+        line = json.dumps(interaction) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+"""
+requests adapters
+-----------------
+"""
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Send requests as usual, recording each GET"""
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if request.method == "GET":
+            self.cassette.record(request.url, response.status_code,
+                                 response.headers, response.content,
+                                 response.elapsed.total_seconds())
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Serve requests from a cassette"""
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        status, headers, body = (self.cassette.get(request.url) or
+                                 (404, {}, NOT_FOUND))
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+"""
+httpx transports
+----------------
+"""
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Send requests with an inner transport, recording each GET"""
+
+    def __init__(self, cassette, transport):
+        self.cassette = cassette
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        start = time.monotonic()
+        response = await self.transport.handle_async_request(request)
+        body = await response.aread()
+        if request.method == "GET":
+            self.cassette.record(str(request.url), response.status_code,
+                                 response.headers, body,
+                                 time.monotonic() - start)
+        return httpx.Response(response.status_code, headers=response.headers,
+                              content=body, request=request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Serve requests from a cassette"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    async def handle_async_request(self, request):
+        status, headers, body = (self.cassette.get(str(request.url)) or
+                                 (404, {}, NOT_FOUND))
+        return httpx.Response(status, headers=headers, content=body,
+                              request=request)
+
+
+"""
+Installation
+------------
+"""
+
+_cassette = None
+
+
+def get_cassette():
+    """The configured cassette, or None"""
+    global _cassette
+    if _cassette is None and CASSETTE_MODE:
+        _cassette = Cassette(CASSETTE)
+    return _cassette
+
+
+def install(session):
+    """Mount the cassette adapter on a requests session, if configured"""
+    cassette = get_cassette()
+    if cassette is None:
+        return session
+
+    if CASSETTE_MODE == "record":
+        adapter = RecordingAdapter(cassette)
+    elif CASSETTE_MODE == "replay":
+        adapter = ReplayAdapter(cassette)
+    else:
+        raise ValueError("Unknown cassette mode: %s" % CASSETTE_MODE)
+
+    logger.info("Cassette %s mode: %s", CASSETTE_MODE, CASSETTE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def async_transport(limits):
+    """Transport for an httpx.AsyncClient, or None for the default"""
+    cassette = get_cassette()
+    if cassette is None:
+        return None
+    if CASSETTE_MODE == "record":
+        return RecordingTransport(
+            cassette, httpx.AsyncHTTPTransport(limits=limits))
+    return ReplayTransport(cassette)
+
+
+"""
+Replay server
+-------------
+"""
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Serve /<host>/<path> from the server's cassette"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send(self, status, headers, body):
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < server.error_rate:
+            server.count('429')
+            return self.send(429, {"Retry-After": "1"}, b"")
+
+        found = server.cassette.get("http://" + self.path.lstrip("/"))
+        if found is None:
+            server.count('404')
+            return self.send(404, {}, NOT_FOUND)
+
+        status, headers, body = found
+        headers = dict(headers)
+        if "Location" in headers:
+            # Redirect to the target's recording on this server
+            location = urljoin("http://" + self.path.lstrip("/"),
+                               headers["Location"])
+            headers["Location"] = server.url + location.split("://", 1)[-1]
+        if server.rate_limit:
+            headers["X-Rate-Limit-Limit"] = str(server.rate_limit)
+            headers["X-Rate-Limit-Interval"] = "1s"
+        self.send(status, headers, body)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """Local stand-in for source APIs, serving a cassette
+
+    Parameters
+    ----------
+    cassette : Cassette
+    latency, jitter : float
+        Seconds added to each response: latency plus up to jitter.
+    error_rate : float
+        Fraction of requests answered with 429 Too Many Requests.
+    rate_limit : int, optional
+        Requests per second advertised in X-Rate-Limit headers.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, cassette, latency=0, jitter=0,
+                 error_rate=0, rate_limit=None):
+        super().__init__(address, ReplayHandler)
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        """Serve in a daemon thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
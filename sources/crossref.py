@@ -1,16 +1,18 @@
 """Crossref API"""
 
-import json
+import asyncio
 import logging
 from urllib.parse import urljoin, urlencode
-from collections import Counter
+from collections import Counter, namedtuple
 
 import requests
 
+from django.conf import settings
 from django.utils import timezone as tz
-from django.core.cache import cache
 
-from papernet.sources.base import DataSource
+from papernet.sources import cache, cassette, ratelimit
+from papernet.sources.base import (AsyncDataSource, DataSource, HTTP_TIMEOUT,
+                                   prefetch)
 from papernet.data import cleaning
 
 logger = logging.getLogger(__name__)
@@ -24,18 +26,38 @@ SESSION = requests.Session()
 UA_HEADER = "Papernet/1.1 (https://camrobjones/papernet; "
 UA_HEADER += "mailto:crjones94@googlemail.com)"
 SESSION.headers.update({"User-Agent": UA_HEADER})
+cassette.install(SESSION)
 
 
-BASE_URL = "https://api.crossref.org/"
+BASE_URL = getattr(settings, 'PAPERNET_CROSSREF_URL',
+                   "https://api.crossref.org/")
 
 WORK_URL = urljoin(BASE_URL, "works/")
 JOURNAL_URL = urljoin(BASE_URL, "journals/")
 
+# Work fields read when storing works, requested with select=
+WORK_FIELDS = ["DOI", "title", "short-title", "type", "abstract", "author",
+               "is-referenced-by-count", "references-count", "reference",
+               "ISSN", "issn-type", "container-title", "short-container-title",
+               "issued", "created", "published-print", "published-online",
+               "volume", "issue"]
+
+# Most rows crossref returns per page
+MAX_ROWS = 1000
+
+# Pages of works fetched while earlier pages are being stored
+PREFETCH_PAGES = 4
+
+# A page of works from iter_pages. `cursor` continues after it, and is
+# None on the last page.
+Page = namedtuple("Page", ["items", "cursor", "total"])
+
 
 """
 OPEN CITATIONS
 """
-COCI_BASE_URL = "https://w3id.org/oc/index/coci/api/v1/"
+COCI_BASE_URL = getattr(settings, 'PAPERNET_COCI_URL',
+                        "https://w3id.org/oc/index/coci/api/v1/")
 REFERENCES_URL = urljoin(COCI_BASE_URL, 'references/')
 CITATIONS_URL = urljoin(COCI_BASE_URL, 'citations/')
 
@@ -45,13 +67,31 @@ Utils
 """
 
 
-def get_json(url, params=None):
-    """Request the url and parse the result to a JSON object."""
+def get_json(url, params=None, force=False, store=True):
+    """Request the url and parse the result to a JSON object.
+
+    Responses are cached unless `store` is False, e.g. for pages that
+    won't be requested again.
+    """
     # TODO: replace w/ generic functions like get_work
     url = urljoin(url, ("?" + urlencode(params) if params else ""))
-    response = requests.get(url)
 
-    data = json.loads(response.content)
+    key = cache.cache_key(url)
+    data, entry = cache.lookup(key, force=force or not store)
+    if data is not None:
+        return data
+
+    headers = entry.conditional_headers() if entry is not None else {}
+
+    ratelimit.wait(url)
+    start_time = tz.now()
+    response = SESSION.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    ratelimit.check_response(
+        url, response, (tz.now() - start_time).total_seconds())
+
+    if not store:
+        return response.json()
+    data, cached = cache.update(key, entry, response)
     return data
 
 """
@@ -71,9 +111,7 @@ class CrossRef(DataSource):
         url = urljoin(WORK_URL, doi)
         result = self._get_url(url, **kwargs)
 
-        data = json.loads(result.response.content)
-
-        result.data = data['message']
+        result.data = result.json()['message']
         return result
 
     def get_journal(self, issn):
@@ -85,6 +123,29 @@ class CrossRef(DataSource):
         return get_json(WORK_URL, {"query": query})['message']
 
 
+class AsyncCrossRef(AsyncDataSource):
+    """Concurrent requests to crossref, in the polite pool"""
+    headers = {"User-Agent": UA_HEADER}
+    work_url = WORK_URL
+
+    async def get_work(self, doi, **kwargs):
+        """Retrieve work at specified doi"""
+        result = await self._get_url(urljoin(self.work_url, doi), **kwargs)
+
+        result.data = result.json()['message']
+        return result
+
+    async def get_work_many(self, dois, **kwargs):
+        """Retrieve works concurrently
+
+        Returns a Result for each doi, in order, or the exception raised
+        retrieving it.
+        """
+        return await asyncio.gather(
+            *(self.get_work(doi, **kwargs) for doi in dois),
+            return_exceptions=True)
+
+
 def scrape_author(author, rows=200):
     """Search for papers by an author"""
     names = [author.get('given', ''), author.get('family', '')]
@@ -94,7 +155,8 @@ def scrape_author(author, rows=200):
         logger.error("Length of author names must be > 1")
         raise ValueError("Length of author names must be > 1")
 
-    params = {"query.author": query_string, "rows": rows}
+    params = {"query.author": query_string, "rows": rows,
+              "select": ",".join(WORK_FIELDS)}
 
     # Make request
     res = get_json(WORK_URL, params)['message']
@@ -114,64 +176,69 @@ def scrape_author(author, rows=200):
     logger.debug("Author query complete: %s", tally)
 
 
-def get_works(filters=None, sort='issued', chunksize=20, limit=None,
-              order='desc'):
-    """Get and papers matching query"""
-    logger.debug("Getting works with filters: %r", filters)
+def iter_pages(filters=None, sort='issued', order='desc', rows=100,
+               limit=None, select=WORK_FIELDS, query=None, cursor="*"):
+    """Yield Pages of works matching filters
+
+    Pages are followed with crossref's deep-paging cursor, which,
+    unlike offsets, isn't capped and doesn't slow down with depth.
+    Only the `select` fields of each work are requested. `query` holds
+    further parameters, e.g. {"query.author": name}, and `cursor` the
+    `next-cursor` of an earlier Page to carry on from.
+    """
+    params = {
+        "filter": filters,
+        "rows": min(rows, MAX_ROWS),
+        "sort": sort,
+        "order": order,
+        "select": ",".join(select) if select else None,
+        **(query or {}),
+        "cursor": cursor,
+    }
+    params = {k: v for k, v in params.items() if v is not None}
 
-    # Initialize variables
-    finished = False
-    offset = 0
     count = 0
-    total = "Unknown"
-
-    while not finished:
-        logger.debug("Getting results %s - %s of %s", offset,
-                     offset + chunksize, total)
-
-        # Query Params
-        params = {
-            "rows": chunksize,
-            "filter": filters,
-            "offset": offset,
-            "sort": sort,
-            "order": order
-        }
-
-        # filters = filters or {}
-        # filters['issn'] = issn
-        # filter_string = build_filter(**filters)
+    while limit is None or count < limit:
+        res = get_json(WORK_URL, params, store=False)['message']
+        if count == 0:
+            logger.info("%s total results returned. Limit set to %s.",
+                        res['total-results'], limit)
 
-        res = get_json(WORK_URL, params)['message']
-
-        # Update total
-        if res['total-results'] != total:
-            total = res['total-results']
-
-            if limit is None:
-                limit = total
+        items = res['items']
+        if limit is not None:
+            items = items[:limit - count]
+        last = len(res['items']) < params['rows'] or not res.get('next-cursor')
+        if items:
+            count += len(items)
+            yield Page(items, None if last else res['next-cursor'],
+                       res['total-results'])
 
-            logger.info("%s total results returned. Limit set to %s."
-                        "Scraping rows %s - %s of %s", total, limit,
-                        offset, offset + chunksize, total)
+        if last:
+            break
+        params['cursor'] = res['next-cursor']
 
-        items = res['items']
-        logger.debug("%s items returned", len(items))
+    logger.info("%s works retrieved", count)
 
-        for work in items:
 
-            yield work
+def get_works(filters=None, sort='issued', chunksize=100, limit=None,
+              order='desc', select=WORK_FIELDS, prefetch_pages=PREFETCH_PAGES):
+    """Get papers matching query
 
-            count += 1
+    Pages of `chunksize` works are fetched in a background thread, up
+    to `prefetch_pages` ahead, while the caller handles earlier works.
+    """
+    logger.debug("Getting works with filters: %r", filters)
+    pages = iter_pages(filters, sort=sort, order=order, rows=chunksize,
+                       limit=limit, select=select)
+    for page in prefetch(pages, prefetch_pages):
+        yield from page.items
 
-        if len(items) < chunksize or offset >= limit:
-            logger.info("Setting finished to true. len(items)=%s, chunksize=%s, offset=%s, limit=%s",
-                len(items), chunksize, offset, limit)
-            finished = True
 
-        offset += chunksize
+def count_works(filters):
+    """Number of works matching filters, without retrieving any"""
+    params = {"filter": filters, "rows": 0}
+    return get_json(WORK_URL, params, store=False)['message']['total-results']
 
-    logger.info("%s papers of %s retrieved", count, total)
 
 """
 Open citation functions
@@ -0,0 +1,274 @@
+"""
+Rate limiting
+-------------
+Token buckets for outbound requests, per host and per route
+
+Each bucket is a GCRA (generic cell rate algorithm) token bucket, held
+as a single "theoretical arrival time" so updates are one read and one
+write. Bucket state lives in the Django cache so that every worker
+shares it, or in-process when PAPERNET_RATELIMIT_BACKEND is "local".
+
+Limits come from PAPERNET_RATE_LIMITS and are replaced by the
+X-Rate-Limit-Limit/X-Rate-Limit-Interval headers that crossref sends.
+A request that would have to wait longer than `max_wait` raises
+RateLimited instead of sleeping, so that tasks can be retried later.
+"""
+
+import logging
+import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+# (requests, seconds) by host or host/route
+RATE_LIMITS = getattr(settings, 'PAPERNET_RATE_LIMITS', {
+    "api.crossref.org": (50, 1),
+})
+DEFAULT_RATE_LIMIT = getattr(settings, 'PAPERNET_DEFAULT_RATE_LIMIT', (10, 1))
+
+RATELIMIT_BACKEND = getattr(settings, 'PAPERNET_RATELIMIT_BACKEND', "cache")
+
+# Longest a caller sleeps before RateLimited is raised instead
+MAX_WAIT = getattr(settings, 'PAPERNET_RATELIMIT_MAX_WAIT', 1.0)
+
+# Back off a host after a slow response
+SLOW_REQUEST_LENGTH = 4
+SLOW_REQUEST_WAIT = 2
+
+CACHE_PREFIX = "papernet:ratelimit:"
+LIMIT_TIMEOUT = 60 * 60
+LOCK_TIMEOUT = 0.5
+
+
+class RateLimited(Exception):
+    """Request refused by a rate limit; retry after `wait` seconds"""
+
+    def __init__(self, url, wait):
+        super().__init__(f"Rate limited: {url} (retry in {wait:.1f}s)")
+        self.url = url
+        self.wait = wait
+
+
+"""
+Stores
+------
+"""
+
+
+class LocalStore():
+    """Bucket state for a single process"""
+
+    def __init__(self):
+        self.values = {}
+        # Reentrant, as reserve holds the locks of several buckets
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.values[key] = value
+
+    @contextmanager
+    def locked(self, key):
+        with self.lock:
+            yield
+
+
+class CacheStore():
+    """Bucket state shared between workers through the Django cache"""
+
+    def get(self, key):
+        return cache.get(CACHE_PREFIX + key)
+
+    def set(self, key, value, timeout=None):
+        cache.set(CACHE_PREFIX + key, value, timeout)
+
+    @contextmanager
+    def locked(self, key):
+        """Hold a short lock on key, using cache.add as the primitive"""
+        lock = CACHE_PREFIX + key + ":lock"
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while not cache.add(lock, 1, timeout=1):
+            if time.monotonic() > deadline:
+                raise RateLimited(key, LOCK_TIMEOUT)
+            time.sleep(0.001)
+        try:
+            yield
+        finally:
+            cache.delete(lock)
+
+
+STORES = {
+    "local": LocalStore,
+    "cache": CacheStore,
+}
+
+_store = None
+
+
+def get_store():
+    """Return the configured bucket store"""
+    global _store
+    if _store is None:
+        _store = STORES[RATELIMIT_BACKEND]()
+    return _store
+
+
+"""
+Buckets
+-------
+"""
+
+
+def bucket_names(url):
+    """Names of the buckets a request counts against: host and route"""
+    parts = urlsplit(url)
+    host = parts.netloc
+    segments = [s for s in parts.path.split("/") if s]
+    names = [host]
+    if segments and f"{host}/{segments[0]}" in RATE_LIMITS:
+        names.append(f"{host}/{segments[0]}")
+    return names
+
+
+def get_limit(name, store=None):
+    """(requests, seconds) for a bucket, preferring limits from headers"""
+    store = store or get_store()
+    return (store.get("limit:" + name) or RATE_LIMITS.get(name)
+            or DEFAULT_RATE_LIMIT)
+
+
+def _locked(names, store):
+    """Hold the locks of several buckets, in a fixed order"""
+    stack = ExitStack()
+    for name in sorted(names):
+        stack.enter_context(store.locked(name))
+    return stack
+
+
+def take(names, max_wait=MAX_WAIT, now=None, store=None):
+    """Take a token from each of a list of buckets
+
+    Returns the seconds the caller must wait before sending, at most
+    `max_wait`. Raises RateLimited, without taking any token, if the
+    wait for any bucket would be longer.
+    """
+    if isinstance(names, str):
+        names = [names]
+    store = store or get_store()
+
+    with _locked(names, store):
+        now = time.time() if now is None else now
+        tats, wait = {}, 0
+        for name in names:
+            limit, interval = get_limit(name, store)
+            emission = interval / limit
+            # Bursts of up to `limit` requests are allowed
+            tolerance = interval - emission
+            tat = max(store.get("tat:" + name) or now, now)
+            bucket_wait = max(tat - tolerance - now, 0)
+
+            if bucket_wait > max_wait:
+                raise RateLimited(name, bucket_wait)
+
+            wait = max(wait, bucket_wait)
+            tats[name] = (tat + emission, int(interval) + 60)
+
+        for name, (tat, timeout) in tats.items():
+            store.set("tat:" + name, tat, timeout=timeout)
+
+    return wait
+
+
+def reserve(url, max_wait=MAX_WAIT):
+    """Take a token from every bucket for url, returning the wait"""
+    return take(bucket_names(url), max_wait)
+
+
+def wait(url, max_wait=MAX_WAIT):
+    """Sleep until a request to url may be sent, returning the wait"""
+    seconds = reserve(url, max_wait)
+    if seconds:
+        logger.debug("Rate limited %s: waiting %.2fs", url, seconds)
+        time.sleep(seconds)
+    return seconds
+
+
+def backoff(url, seconds):
+    """Hold back every request to url's host for `seconds`"""
+    store = get_store()
+    name = bucket_names(url)[0]
+    with store.locked(name):
+        until = time.time() + seconds
+        if (store.get("tat:" + name) or 0) < until:
+            store.set("tat:" + name, until, timeout=int(seconds) + 60)
+
+
+"""
+Responses
+---------
+"""
+
+
+def parse_interval(value):
+    """Seconds in an interval header such as '1s' or '500ms'"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*", value or "")
+    if match is None:
+        return None
+    number, unit = float(match.group(1)), match.group(2) or "s"
+    return number * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+
+
+def update_limits(url, headers):
+    """Store a host's limit from X-Rate-Limit-* headers"""
+    try:
+        limit = int(headers.get("X-Rate-Limit-Limit"))
+    except (TypeError, ValueError):
+        return None
+    interval = parse_interval(headers.get("X-Rate-Limit-Interval")) or 1
+
+    if limit <= 0:
+        return None
+
+    name = bucket_names(url)[0]
+    store = get_store()
+    if store.get("limit:" + name) != (limit, interval):
+        logger.info("Rate limit for %s set to %s per %ss",
+                    name, limit, interval)
+        store.set("limit:" + name, (limit, interval), timeout=LIMIT_TIMEOUT)
+    return limit, interval
+
+
+def check_response(url, response, elapsed=0):
+    """Update limits from a response, backing off if needed
+
+    Raises RateLimited for 429 responses.
+    """
+    update_limits(url, response.headers)
+
+    if response.status_code == 429:
+        try:
+            retry_after = float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            retry_after = get_limit(bucket_names(url)[0])[1]
+        backoff(url, retry_after)
+        raise RateLimited(url, retry_after)
+
+    if elapsed > SLOW_REQUEST_LENGTH:
+        seconds = max(SLOW_REQUEST_WAIT, elapsed * 2)
+        logger.warning("Request to %s took too long (%.1fs). Backing off "
+                       "for %.1fs", url, elapsed, seconds)
+        backoff(url, seconds)
@@ -4,10 +4,11 @@ Sources Main
 Dispatch calls to correct source
 """
 
+import asyncio
 import logging
 
 from papernet.sources import wiley
-from papernet.sources.crossref import CrossRef
+from papernet.sources.crossref import AsyncCrossRef, CrossRef
 
 crossref = CrossRef()
 
@@ -32,6 +33,25 @@ def get_work(doi, **kwargs):
     return crossref.get_work(doi, **kwargs)
 
 
+def get_journal(issn):
+    """Retrieve a journal by issn."""
+    # Currently crossref is the only source
+    return crossref.get_journal(issn)
+
+
+def get_work_many(dois, **kwargs):
+    """Retrieve papers by doi concurrently
+
+    Returns a Result for each doi, in order, or the exception raised
+    retrieving it.
+    """
+    async def get_all():
+        async with AsyncCrossRef() as source:
+            return await source.get_work_many(dois, **kwargs)
+
+    return asyncio.run(get_all())
+
+
 def search(query):
     """Search for query in sources."""
     # Currently crossref is the only source
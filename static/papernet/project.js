@@ -14,6 +14,7 @@ var app = new Vue({
         papers: papers,
         query: "",
         results: [],
+        suggestions: [],
         resultShow: false,
     },
     methods: {
@@ -55,6 +56,23 @@ var app = new Vue({
                 this.paper = data.paper;
             });
         },
+        suggest: function() {
+            if (this.query.length < 2) {
+                this.suggestions = [];
+                return;
+            }
+            let data = {
+                params: {
+                    'query': this.query
+                }
+            };
+            axios.get('/papernet/suggest', data).then(response => {
+                this.suggestions = response.data.results;
+            });
+        },
+        openSuggestion: function(suggestion) {
+            window.location.href = '/papernet/' + suggestion.type + '/' + suggestion.pk + '/';
+        },
         search: function() {
             let data = {
                 params: {
@@ -6,12 +6,16 @@ Draws on data source APIs and manages storage in db models
 
 import json
 import logging
+from collections import namedtuple
+from datetime import date
 
 from django.utils import timezone as tz
 from django.db.models import Count, Q
+from django.db.models.functions import Coalesce, ExtractYear
 
-from papernet import models, aux, sources
-from papernet.models.pipeline import Attribution, SourceLog
+from papernet import models, aux, search, sources, scrape, tasks
+from papernet.sources import crossref
+from papernet.models.pipeline import Attribution, SourceLog, request_logs
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -62,7 +66,6 @@ Abstract base classes
 
 class DataManager():
     """ABC"""
-    sources = {}
     model = None
     obj = None
 
@@ -80,8 +83,7 @@ class DataManager():
     def log_source(self, result):
         """Create a sourcelog from a result"""
         logger.debug("Creating SourceLog for result: %r", result)
-        source = SourceLog(request=result.request)
-        source.save()
+        source = SourceLog(request=request_logs.save(result.request))
 
         data = json.dumps(result.data)
 
@@ -136,7 +138,8 @@ class PaperData(DataManager):
 
     def retrieve(self):
         """Retrieve data for the model from sources"""
-        result = sources.get_work(self.doi)
+        # Bypass the response cache so that every SourceLog has a request
+        result = sources.get_work(self.doi, force=True)
         return result
 
     def update_fulltext(self):
@@ -175,6 +178,7 @@ class PaperData(DataManager):
         }
         _safe_update(self.paper, paper_data)
         self.paper.save()
+        search.index_papers([self.paper.pk])
 
         # Add file
         if self.papertext.pdf.name != self.fulltext_source.filename:
@@ -194,13 +198,48 @@ Manage and update Journal Data
 """
 
 
+# Works fetched per request by scrape jobs. A window with no more works
+# than this costs as much to fetch as to count half of.
+WINDOW_ROWS = scrape.ROWS
+
+ONE_DAY = tz.timedelta(days=1)
+
+# Dates (inclusive) between which works are issued, with the number of
+# works on crossref and stored
+Window = namedtuple("Window", ["start", "end", "remote", "local"])
+
+
+def _merge_windows(windows):
+    """Join windows that follow on from each other"""
+    merged = []
+    for window in windows:
+        if merged and merged[-1].end + ONE_DAY == window.start:
+            last = merged[-1]
+            merged[-1] = Window(last.start, window.end,
+                                last.remote + window.remote,
+                                last.local + window.local)
+        else:
+            merged.append(window)
+    return merged
+
+
 class JournalData(DataManager):
     """Extract and store data for journals"""
 
     def __init__(self, journal):
         assert isinstance(journal, models.Journal)
+        self.obj = journal
         self.journal = journal
-        self.papers = journal.get_papers(n=None)
+        self.papers = journal.get_papers(n=None, order=None)
+        # Counted by issued date, as crossref counts them. Publications
+        # stored before it was kept fall back to their earliest date.
+        self.publications = journal.publication_set.annotate(
+            issued_date=Coalesce('issued', 'published'))
+        # Coverage, filled in by get_state
+        self.local = {}
+        self.states = {}
+        # Crossref requests made by coverage
+        self.requests = 0
 
     def get_volumes(self):
         """Get volumes """
@@ -215,20 +254,21 @@ class JournalData(DataManager):
         local = {}
         local['total_count'] = self.papers.count()
 
-        local['current_count'] = self.papers.filter(
-            publication__published__gte=TWO_YA).count()
+        local['current_count'] = self.publications.filter(
+            issued_date__gte=TWO_YA).count()
 
-        fname = "publication__published__year"
-        years = self.papers.values(fname).order_by(fname)
-        by_year = years.annotate(n=Count(fname))
+        fname = "issued_year"
+        years = self.publications.annotate(
+            **{fname: ExtractYear('issued_date')}).values(fname).order_by(fname)
+        by_year = years.annotate(n=Count('pk'))
         by_year = {y[fname]: y['n'] for y in by_year}
 
         local['by_year'] = by_year
 
         years = [year for year in by_year.keys() if year]
 
-        local['max_year'] = max(years)
-        local['min_year'] = min(years)
+        local['max_year'] = max(years, default=None)
+        local['min_year'] = min(years, default=None)
 
         self.local = local
 
@@ -248,45 +288,91 @@ class JournalData(DataManager):
 
         years = [year for year in by_year.keys() if year]
 
-        cr_state['min_year'] = min(years)
-        cr_state['max_year'] = max(years)
+        cr_state['min_year'] = min(years, default=None)
+        cr_state['max_year'] = max(years, default=None)
 
-        self.sources['crossref'] = cr_state
+        self.states['crossref'] = cr_state
 
     def missing_papers(self, year=None):
         """Return the number of missing papers"""
         if year is None:
-            cr_total = self.sources['crossref']['total_count']
+            cr_total = self.states['crossref']['total_count']
             local_total = self.local['total_count']
             return cr_total - local_total
 
-        cr = self.sources['crossref']['by_year'].get(year, 0)
+        cr = self.states['crossref']['by_year'].get(year, 0)
         loc = self.local['by_year'].get(year, 0)
 
         return cr - loc
 
-    def add_papers(self, since=TWO_YA, **kwargs):
-        """Add missing papers from sources"""
-        years = range(tz.now().year, since.year - 1, -1)
+    def local_count(self, start, end):
+        """Publications stored issued between start and end"""
+        return self.publications.filter(
+            issued_date__range=(start, end)).count()
 
-        for year in years:
-            missing = self.missing_papers(year=year)
+    def crossref_count(self, start, end):
+        """Works on crossref issued between start and end"""
+        self.requests += 1
+        filters = scrape.journal_filters(self.journal.issn, (start, end))
+        return crossref.count_works(filters)
 
-            if missing == 0:
-                logger.info("Skipping %s as there are no papers missing",
-                            year)
-                continue
-
-            # filters = f"from-pub-date:{year-1},until-pub-date:{year}"
-            filters = {"from_date": tz.datetime(year, 1, 1),
-                       "until_date": tz.datetime(year + 1, 1, 1)}
+    def narrow(self, start, end, remote, local):
+        """The smallest windows between start and end missing works
 
-            kwargs.update({"filters": filters})
+        `remote` and `local` are the numbers of works issued between
+        start and end on crossref and stored. The window is halved, and
+        its first half counted, until it has no works missing, fits in
+        a page or is a single day.
+        """
+        if remote <= local:
+            return []
+        if remote <= WINDOW_ROWS or start == end:
+            return [Window(start, end, remote, local)]
+
+        middle = start + (end - start) // 2
+        left_remote = self.crossref_count(start, middle)
+        left_local = self.local_count(start, middle)
+        return (self.narrow(start, middle, left_remote, left_local) +
+                self.narrow(middle + ONE_DAY, end, remote - left_remote,
+                            local - left_local))
+
+    def coverage(self, since=None):
+        """Windows of issued dates with works missing since year `since`
+
+        Years with fewer works stored than crossref's breakdown counts
+        are narrowed down to the windows missing works, and windows
+        next to each other joined. Works missing from a year that has
+        as many works stored as crossref counts (some stored under a
+        different date) aren't found.
+        """
+        if not self.states:
+            self.get_state()
 
-            for work in sources.scrape_journal(
-                    self.journal.issn, **kwargs):
+        windows = []
+        by_year = self.states['crossref']['by_year']
+        for year, remote in sorted(by_year.items()):
+            if since is not None and year < since:
+                continue
+            local = self.local['by_year'].get(year, 0)
+            windows += self.narrow(date(year, 1, 1), date(year, 12, 31),
+                                   remote, local)
 
-                aux.add_work(work)
+        windows = _merge_windows(windows)
+        logger.info("%s works missing from %s in %s windows (%s requests)",
+                    sum(w.remote - w.local for w in windows), self.journal,
+                    len(windows), self.requests)
+        return windows
 
-        logger.info()
+    def add_papers(self, since=TWO_YA):
+        """Scrape the windows missing papers since `since`
 
+        Returns a ScrapeJob with a sub-job for each window, which are
+        run by workers. Its progress is reported by get_progress?job_id=.
+        """
+        windows = self.coverage(since=since.year)
+        job = scrape.window_jobs(self.journal.issn,
+                                 [(w.start, w.end) for w in windows])
+        for subjob in job.subjobs.all():
+            tasks.start_scrape_job(subjob)
+        logger.info("Scraping %s in %s sub-jobs", self.journal, len(windows))
+        return job
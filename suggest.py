@@ -0,0 +1,192 @@
+"""
+Suggest
+-------
+Typeahead suggestions from an in-memory sorted prefix index
+
+Paper short titles, author last names and journal abbreviations are
+normalized and held as one sorted list of keys. A prefix query is two
+binary searches, and the matching slice is ranked by weight with numpy,
+so lookups don't depend on table size. Each process rebuilds its index
+in the background every PAPERNET_SUGGEST_MAX_AGE seconds.
+"""
+
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+
+from papernet.models import Author, Journal, Paper
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Constants
+---------
+"""
+
+SUGGEST_MAX_AGE = getattr(settings, 'PAPERNET_SUGGEST_MAX_AGE', 60 * 15)
+
+# Index keys start at each of the first few words of a title
+TITLE_WORDS = 4
+
+KINDS = ("paper", "author", "journal")
+
+ITER_CHUNKSIZE = 5000
+
+
+"""
+Helper functions
+----------------
+"""
+
+
+def normalize(text):
+    """Lowercase words separated by single spaces"""
+    return " ".join(re.findall(r"\w+", (text or "").lower()))
+
+
+def title_keys(title):
+    """Keys for a title: the whole title and suffixes from its words"""
+    words = normalize(title).split(" ")
+    return [" ".join(words[i:]) for i in range(min(len(words), TITLE_WORDS))]
+
+
+def paper_entries():
+    papers = Paper.objects.exclude(title="").values_list(
+        'pk', 'short_title', 'title', 'cited_by_count')
+    for pk, short_title, title, cites in papers.iterator(ITER_CHUNKSIZE):
+        label = short_title or title
+        for key in title_keys(label):
+            yield key, "paper", pk, label, cites
+
+
+def author_entries():
+    authors = Author.objects.exclude(last_name="").annotate(
+        n=Count('authorship')).values_list('pk', 'first_name', 'last_name', 'n')
+    for pk, first, last, n in authors.iterator(ITER_CHUNKSIZE):
+        yield normalize(last), "author", pk, f"{first} {last}", n
+
+
+def journal_entries():
+    journals = Journal.objects.annotate(n=Count('publication')).values_list(
+        'pk', 'abbreviation', 'title', 'n')
+    for pk, abbreviation, title, n in journals.iterator(ITER_CHUNKSIZE):
+        label = abbreviation or title
+        if label:
+            yield normalize(label), "journal", pk, label, n
+
+
+"""
+Index
+-----
+"""
+
+
+class SuggestIndex():
+    """Sorted prefix keys with parallel arrays of results"""
+
+    def __init__(self, entries):
+        entries = sorted(e for e in entries if e[0])
+        self.keys = [e[0] for e in entries]
+        self.kinds = np.array([KINDS.index(e[1]) for e in entries],
+                              dtype=np.int8)
+        self.pks = np.array([e[2] for e in entries], dtype=np.int64)
+        self.labels = [e[3] for e in entries]
+        self.weights = np.array([e[4] for e in entries], dtype=np.float64)
+        self.built = time.monotonic()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_db(cls):
+        """Build the index from papers, authors and journals"""
+        t0 = time.monotonic()
+        index = cls(entry for entries in (paper_entries(), author_entries(),
+                                          journal_entries())
+                    for entry in entries)
+        logger.info("Built suggest index with %s keys in %.1fs",
+                    len(index), time.monotonic() - t0)
+        return index
+
+    def lookup(self, prefix, n=8):
+        """Best n results whose key starts with `prefix`"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + "\uffff", lo)
+        if lo == hi:
+            return []
+
+        # Candidates by weight; extra to allow for repeated titles
+        weights = self.weights[lo:hi]
+        k = min(len(weights), n * TITLE_WORDS)
+        top = np.argpartition(-weights, k - 1)[:k]
+        top = top[np.argsort(-weights[top], kind='stable')] + lo
+
+        results, seen = [], set()
+        for i in top:
+            kind, pk = KINDS[self.kinds[i]], int(self.pks[i])
+            if (kind, pk) in seen:
+                continue
+            seen.add((kind, pk))
+            results.append({"type": kind, "pk": pk, "label": self.labels[i]})
+            if len(results) == n:
+                break
+
+        return results
+
+
+"""
+Shared instance
+---------------
+"""
+
+_index = None
+_lock = threading.Lock()
+
+
+def _rebuild():
+    """Replace the shared index (run in a background thread)"""
+    global _index
+    try:
+        _index = SuggestIndex.from_db()
+    except Exception as e:
+        logger.exception("Failed to rebuild suggest index: %s", e)
+    finally:
+        connection.close()
+        _lock.release()
+
+
+def get_index(max_age=SUGGEST_MAX_AGE):
+    """Return the process-wide index, refreshing it when stale
+
+    The first call builds the index; later refreshes happen in a
+    background thread while the stale index keeps serving.
+    """
+    global _index
+
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = SuggestIndex.from_db()
+
+    elif time.monotonic() - _index.built > max_age:
+        if _lock.acquire(blocking=False):
+            threading.Thread(target=_rebuild, daemon=True).start()
+
+    return _index
+
+
+def get_suggestions(prefix, n=8):
+    """Typeahead results for `prefix`"""
+    return get_index().lookup(prefix, n=n)
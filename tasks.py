@@ -4,43 +4,150 @@ import logging
 import re
 
 from celery import shared_task
+from celery.schedules import crontab
+from celery.signals import task_postrun, worker_process_shutdown
 
-from papernet import sources
-from papernet.sources import crossref
-from papernet.models import Paper, Project
-from papernet.aux import add_work, get_work, get_reader, add_to_project
+from papernet import sources, graph, ingest, rollups, scrape, frontier
+from papernet.models import pipeline
+from papernet.sources.ratelimit import RateLimited
+from papernet.data import cleaning
+from papernet.models import Journal, Paper, Project, ScrapeJob
+from papernet.aux import get_reader, add_to_project
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# @app.task(bind=True)
-@shared_task
-def retrieve_citations(pk):
-    """Retrieve citations for paper"""
+# Periodic tasks. Include in the project's CELERY_BEAT_SCHEDULE.
+BEAT_SCHEDULE = {
+    "save-citation-graph": {
+        "task": "papernet.tasks.save_citation_graph",
+        "schedule": crontab(minute=0, hour="*/6"),
+    },
+    "update-rollups": {
+        "task": "papernet.tasks.update_rollups",
+        "schedule": crontab(minute="*/5"),
+    },
+    "prune-request-logs": {
+        "task": "papernet.tasks.prune_request_logs",
+        "schedule": crontab(minute=30, hour=3),
+    },
+    "resume-scrape-jobs": {
+        "task": "papernet.tasks.resume_scrape_jobs",
+        "schedule": crontab(minute=15),
+    },
+    "sync-tracked-journals": {
+        "task": "papernet.tasks.sync_tracked_journals",
+        "schedule": crontab(minute=0, hour=2),
+    },
+    "drain-frontier": {
+        "task": "papernet.tasks.drain_frontier",
+        "schedule": crontab(minute="*/10"),
+    },
+    "refresh-frontier": {
+        "task": "papernet.tasks.refresh_frontier",
+        "schedule": crontab(minute=0, hour=1),
+    },
+}
+
+
+@task_postrun.connect
+@worker_process_shutdown.connect
+def flush_request_logs(**kwargs):
+    """Save RequestLogs buffered by the task"""
+    pipeline.request_logs.flush()
+
+
+# DOIs looked up concurrently by get_works
+FETCH_CHUNKSIZE = 50
+
+# Retries for tasks refused by a rate limit
+RATE_LIMITED_RETRIES = 10
+
+
+@shared_task(bind=True, max_retries=RATE_LIMITED_RETRIES)
+def retrieve_citations(self, pk):
+    """Retrieve paper and queue the papers it cites on the frontier"""
     logger.debug("Task: retrieve_citations(pk=%s)", pk)
     paper = Paper.objects.get(pk=pk)
-    paper.retrieve()
-    paper.retrieve_citations()
+    try:
+        paper.retrieve(citations=False)
+        paper.retrieve_citations()
+    except RateLimited as e:
+        raise self.retry(exc=e, countdown=e.wait)
 
 
-@shared_task
-def get_author_papers(author):
+@shared_task(bind=True, max_retries=RATE_LIMITED_RETRIES)
+def add_works(self, works, citations=False):
+    """Add a batch of crossref works to the database"""
+    logger.debug("Task: add_works(%s works, citations=%s)",
+                 len(works), citations)
+    try:
+        tally = ingest.add_works(works, citations=citations)
+    except RateLimited as e:
+        raise self.retry(exc=e, countdown=e.wait)
+    if citations:
+        # Cited papers that aren't stored are fetched by drain_frontier
+        tally['queued'] = frontier.add(
+            ref['DOI'] for work in works for ref in work.get('reference', [])
+            if ref.get('DOI'))
+    return dict(tally)
+
+
+# Journal works stored by get_journal_papers
+JOURNAL_LIMIT = 200
+
+
+def _run_scrape_job(task, job):
+    """Run a scrape job in a task, reporting progress after each page"""
+    if not scrape.claim(job, task.request.id or ""):
+        logger.warning("%s is run by another task", job)
+        return job.progress()
+
+    def progress(job):
+        task.update_state(state="IN PROGRESS", meta=job.progress())
+
+    try:
+        scrape.run(job, on_page=progress)
+    except RateLimited as e:
+        # The job carries on from its checkpoint when retried
+        raise task.retry(exc=e, countdown=e.wait)
+    return job.progress()
+
+
+def start_scrape_job(job):
+    """Queue a scrape job to be run by a worker"""
+    job.task_id = run_scrape_job.delay(job.pk).id
+    job.save()
+
+
+# Scrape tasks are acknowledged once they finish, so they are run again
+# (from their checkpoint) if their worker dies
+@shared_task(bind=True, max_retries=RATE_LIMITED_RETRIES, acks_late=True,
+             reject_on_worker_lost=True)
+def run_scrape_job(self, pk):
+    """Run or resume a scrape job"""
+    logger.info("Task: run_scrape_job(pk=%s)", pk)
+    return _run_scrape_job(self, ScrapeJob.objects.get(pk=pk))
+
+
+@shared_task(bind=True, max_retries=RATE_LIMITED_RETRIES, acks_late=True,
+             reject_on_worker_lost=True)
+def get_author_papers(self, author):
     """Retrieve papers by author"""
     logger.debug("Task: get_author_papers(author=%s)", author)
-    for work in crossref.scrape_author(author):
-        add_work(work)
+    return _run_scrape_job(self, scrape.author_job(author))
 
 
-@shared_task
-def get_journal_papers(issn):
+@shared_task(bind=True, max_retries=RATE_LIMITED_RETRIES, acks_late=True,
+             reject_on_worker_lost=True)
+def get_journal_papers(self, issn, limit=JOURNAL_LIMIT):
     """Retrieve papers in journal"""
     logger.info("Task: get_journal_papers(issn=%s)", issn)
-    works = 0
-    for work in crossref.get_works(filters=f"issn:{issn}", limit=200):
-        logger.debug("Adding work %s, %s, %s", works, work["DOI"], work['ISSN'])
-        add_work(work)
-        works += 1
+    job = scrape.journal_job(issn, limit=limit)
+    progress = _run_scrape_job(self, job)
+    logger.info("Stored %s of %s works for %s", job.stored, job.works, issn)
+    return progress
 
 
 @shared_task(bind=True)
@@ -54,44 +161,140 @@ def get_works(self, data, project_id=None, user_id=None):
     meta = {"total": len(data), "current": 0, "added": 0, "error": 0,
             "errors": []}
 
+    def error(e):
+        meta['error'] += 1
+        meta['errors'].append(str(e))
+        logger.error("Failed to get paper: %s", e)
+
     project = Project.objects.get(pk=project_id)
 
     reader = get_reader(user_id)
 
     self.update_state(state=state, meta=meta)
-    for row in data:
 
+    dois = []
+    for row in data:
         try:
-            paper = get_work(row['DOI'])
-
+            dois.append(cleaning.clean_doi(row['DOI']))
         except (ValueError, TypeError) as e:
-            meta['error'] += 1
-            meta['errors'].append(str(e))
-            logger.error("Failed to get paper: %s", e)
+            dois.append(None)
+            error(e)
+
+    retrieved = set(Paper.objects.filter(
+        doi__in=[doi for doi in dois if doi], retrieved__isnull=False
+        ).values_list('doi', flat=True))
+    found = {doi: doi for doi in retrieved}
 
-        else:
-            perusal = add_to_project(paper, project, reader)
-            meta['added'] += 1
+    def fetch():
+        """Retrieve missing works concurrently, counting progress by row"""
+        for rows in ingest.chunked(dois, FETCH_CHUNKSIZE):
+            missing = list({doi for doi in rows
+                            if doi is not None and doi not in found})
 
-            status = row.get('Status')
-            if status:
-                perusal.status = status
+            for doi, result in zip(missing, sources.get_work_many(missing)):
+                if isinstance(result, Exception):
+                    found[doi] = None
+                    error(result)
+                else:
+                    found[doi] = cleaning.clean_doi(result.data['DOI'])
+                    yield result.data
 
-            priority = row.get("Priority")
-            if priority and isinstance(priority, int):
-                perusal.priority = priority
+            meta['current'] += len(rows)
+            self.update_state(state=state, meta=meta)
 
-            notes = row.get("Notes")
-            if notes:
-                perusal.notes = notes
+    # Store retrieved works in bulk
+    ingest.add_works(fetch())
+    papers = Paper.objects.in_bulk(
+        [doi for doi in found.values() if doi], field_name='doi')
 
-            tag_string = row.get("Tags", [])
-            if tag_string:
-                tags = re.split('[;,:] *', tag_string)
-                for tag in tags:
-                    perusal.add_tag(tag)
+    for row, doi in zip(data, dois):
+        paper = papers.get(found.get(doi))
+        if paper is None:
+            continue
 
-        meta['current'] += 1
-        self.update_state(state=state, meta=meta)
+        perusal = add_to_project(paper, project, reader)
+        meta['added'] += 1
+
+        status = row.get('Status')
+        if status:
+            perusal.status = status
+
+        priority = row.get("Priority")
+        if priority and isinstance(priority, int):
+            perusal.priority = priority
+
+        notes = row.get("Notes")
+        if notes:
+            perusal.notes = notes
+
+        tag_string = row.get("Tags", [])
+        if tag_string:
+            tags = re.split('[;,:] *', tag_string)
+            for tag in tags:
+                perusal.add_tag(tag)
+
+        perusal.save()
 
     return meta
+
+
+@shared_task
+def save_citation_graph():
+    """Rebuild the citation graph snapshot from the db"""
+    logger.info("Task: save_citation_graph()")
+    citation_graph = graph.save_graph()
+    return {"mark": citation_graph.mark, "edges": citation_graph.n_edges}
+
+
+@shared_task
+def update_rollups():
+    """Count new RequestLogs and rows into the monitoring rollups"""
+    logger.info("Task: update_rollups()")
+    return dict(rollups.update())
+
+
+@shared_task
+def prune_request_logs(days=rollups.RETENTION_DAYS):
+    """Delete rolled up RequestLogs older than the retention window"""
+    logger.info("Task: prune_request_logs(days=%s)", days)
+    rollups.update()
+    return rollups.prune(days)
+
+
+@shared_task
+def resume_scrape_jobs():
+    """Queue scrape jobs again that have stopped being checkpointed"""
+    logger.info("Task: resume_scrape_jobs()")
+    jobs = list(scrape.stalled())
+    for job in jobs:
+        logger.warning("Resuming stalled scrape job %s", job)
+        start_scrape_job(job)
+    return len(jobs)
+
+
+@shared_task
+def sync_tracked_journals():
+    """Queue a sync of each tracked journal's works updated since the last"""
+    logger.info("Task: sync_tracked_journals()")
+    queued = 0
+    for journal in Journal.objects.filter(tracked=True):
+        job = scrape.sync_job(journal)
+        # Syncs still queued or running are left to finish
+        if job.status == "PENDING" and not job.task_id:
+            start_scrape_job(job)
+            queued += 1
+    return queued
+
+
+@shared_task
+def drain_frontier(budget=frontier.BUDGET):
+    """Fetch the most valuable missing cited papers"""
+    logger.info("Task: drain_frontier(budget=%s)", budget)
+    return dict(frontier.drain(budget))
+
+
+@shared_task
+def refresh_frontier():
+    """Rescore the crawl frontier from References"""
+    logger.info("Task: refresh_frontier()")
+    return frontier.refresh()
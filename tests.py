@@ -1,3 +1,586 @@
-from django.test import TestCase
+"""
+Tests
+-----
+"""
+import json
+import threading
+import time
+from collections import Counter
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.utils import timezone as tz
+
+from papernet import (graph, models, scrape, search, serializers, sources,
+                      tasks, views)
+from papernet.models import pipeline
+from papernet.sources import base, cassette, crossref, ratelimit
+
+
+"""
+Scrape jobs
+-----------
+"""
+
+
+class ScrapeJobTests(TestCase):
+    """Finding and creating scrape jobs"""
+
+    ISSN = "1234-5678"
+
+    def test_journal_job_skips_parent_jobs(self):
+        windows = [(date(2020, 1, 1), date(2020, 6, 30)),
+                   (date(2020, 7, 1), date(2020, 12, 31))]
+        parent = scrape.window_jobs(self.ISSN, windows)
+        self.assertEqual(parent.status, "IN PROGRESS")
+        self.assertEqual(parent.subjobs.count(), 2)
+
+        job = scrape.journal_job(self.ISSN)
+        self.assertNotEqual(job.pk, parent.pk)
+        self.assertFalse(job.subjobs.exists())
+        self.assertIsNone(job.from_date)
+        self.assertIsNone(job.parent)
+
+        # The whole-journal job is reused, the parent still isn't
+        self.assertEqual(scrape.journal_job(self.ISSN).pk, job.pk)
+
+    def test_journal_job_reuses_window_sub_job(self):
+        window = (date(2021, 1, 1), date(2021, 3, 31))
+        parent = scrape.window_jobs(self.ISSN, [window])
+        subjob = parent.subjobs.get()
+        self.assertEqual(
+            scrape.journal_job(self.ISSN, window, parent=parent).pk,
+            subjob.pk)
+
+    def test_parent_jobs_are_not_run(self):
+        parent = scrape.window_jobs(self.ISSN,
+                                    [(date(2020, 1, 1), date(2020, 1, 31))])
+        with self.assertRaises(ValueError):
+            scrape.run(parent)
+
+    def test_empty_window_jobs_finish(self):
+        parent = scrape.window_jobs(self.ISSN, [])
+        self.assertEqual(parent.status, "SUCCESS")
+        self.assertNotEqual(scrape.journal_job(self.ISSN).pk, parent.pk)
+
+    def test_restart_resets_counts(self):
+        job = scrape.journal_job(self.ISSN)
+        job.works, job.stored, job.rejected, job.total = 50, 40, 10, 100
+        seen = []
+
+        def resume(job, on_page, prefetch_pages):
+            seen.append((job.cursor, job.works, job.stored, job.rejected))
+            return True
+
+        job.cursor = "live"
+        with mock.patch.object(scrape, "_scrape", resume):
+            scrape.run(job)
+        self.assertEqual(seen, [("live", 50, 40, 10), ("*", 0, 0, 0)])
+
+    def test_stalled_includes_queued_jobs(self):
+        queued = scrape.journal_job(self.ISSN)
+        queued.task_id = "lost"
+        queued.save()
+        unqueued = scrape.author_job({"given": "Ada", "family": "Smith"})
+        models.ScrapeJob.objects.update(
+            updated=tz.now() - scrape.STALLED - tz.timedelta(minutes=1))
+
+        self.assertEqual(list(scrape.stalled()), [queued])
+        self.assertEqual(unqueued.status, "PENDING")
+
+    def test_claim(self):
+        job = scrape.journal_job(self.ISSN)
+        self.assertTrue(scrape.claim(job, "first"))
+        self.assertTrue(scrape.claim(job, "first"))
+        self.assertFalse(scrape.claim(job, "second"))
+        self.assertEqual(
+            models.ScrapeJob.objects.get(pk=job.pk).task_id, "first")
+
+
+"""
+Query counts
+------------
+"""
+
+
+class QueryCountTests(TestCase):
+    """Views and serializers use a fixed number of queries
+
+    Each paper has several authors, so a query per paper or per author
+    shows up as extra queries.
+    """
+
+    N_PAPERS = 6
+
+    @classmethod
+    def setUpTestData(cls):
+        journal = models.Journal.objects.create(
+            issn="1234-5678", title="Journal of Networks", abbreviation="JN")
+        authors = [models.Author.objects.create(first_name=f"Ada{i}",
+                                                last_name=f"Smith{i}")
+                   for i in range(3)]
+
+        # views.network shows paper 35
+        cls.paper = models.Paper.objects.create(
+            pk=35, doi="10.1000/network", title="Citation networks")
+        cited = [cls._paper(i, "Network models", journal, authors)
+                 for i in range(cls.N_PAPERS)]
+        citing = [cls._paper(i, "Network growth", journal, authors)
+                  for i in range(cls.N_PAPERS, 2 * cls.N_PAPERS)]
+        cls._publish(cls.paper, journal, authors)
+        # In both of the reader's projects
+        cls.read = cited[0]
+
+        for paper in cited:
+            models.Reference.objects.create(
+                citing_doi=cls.paper.doi, cited_doi=paper.doi,
+                citing_paper=cls.paper, cited_paper=paper)
+        for paper in citing:
+            models.Reference.objects.create(
+                citing_doi=paper.doi, cited_doi=cls.paper.doi,
+                citing_paper=paper, cited_paper=cls.paper)
+        models.Paper.refresh_counts()
+        search.index_papers(models.Paper.objects.values_list('pk', flat=True))
+
+        user = get_user_model().objects.create_user("reader", password="pw")
+        cls.reader = models.Reader.objects.create(user=user)
+        for title in ("Reading", "Writing"):
+            project = models.Project.objects.create(reader=cls.reader,
+                                                    title=title)
+            for paper in cited[:3]:
+                models.Perusal.objects.create(reader=cls.reader, paper=paper,
+                                              project=project)
+
+    @classmethod
+    def _paper(cls, i, title, journal, authors):
+        paper = models.Paper.objects.create(doi=f"10.1000/{i}",
+                                            title=f"{title} {i}")
+        cls._publish(paper, journal, authors)
+        return paper
+
+    @staticmethod
+    def _publish(paper, journal, authors):
+        models.Publication.objects.create(paper=paper, journal=journal,
+                                          published=date(2020, 1, 1))
+        for position, author in enumerate(authors):
+            models.Authorship.objects.create(author=author, paper=paper,
+                                             position=str(position))
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def get(self, path, **params):
+        request = self.factory.get(path, params)
+        request.user = self.reader.user
+        return request
+
+    def test_search(self):
+        with self.assertNumQueries(5):
+            response = views.search(self.get("/search", query="network"))
+        self.assertEqual(len(json.loads(response.content)['results']), 5)
+
+    def test_paper_info(self):
+        with self.assertNumQueries(13):
+            views.paper_info(self.get("/paper/"), self.read.pk)
+
+    def test_network(self):
+        with self.assertNumQueries(6):
+            views.network(self.get("/network/"))
+
+    def test_get_by_doi(self):
+        with self.assertNumQueries(11):
+            response = views.get_by_doi(self.get("/doi", doi=self.paper.doi))
+        data = json.loads(response.content)
+        self.assertEqual(len(data['citations']), self.N_PAPERS)
+        self.assertEqual(len(data['cited_by']), self.N_PAPERS)
+
+    def test_reader_data(self):
+        reader = models.Reader.objects.get(pk=self.reader.pk)
+        with self.assertNumQueries(7):
+            data = reader.data
+        self.assertEqual(len(data['papers']), 5)
+        self.assertEqual(len(data['projects']), 2)
+
+    def test_paper_data(self):
+        papers = list(models.Paper.objects.all())
+        with self.assertNumQueries(4):
+            data = serializers.paper_data(papers)
+        self.assertEqual(len(data), 2 * self.N_PAPERS + 1)
+
+
+"""
+Search
+------
+"""
+
+
+class FilterPapersTests(TestCase):
+    """Filtering querysets by full-text matches"""
+
+    def test_filter_more_matches_than_sqlite_parameters(self):
+        models.Paper.objects.bulk_create(
+            [models.Paper(doi=f"10.1000/{i}", title=f"Graph theory {i}")
+             for i in range(1200)] +
+            [models.Paper(doi="10.1000/other", title="Linguistics")])
+        search.index_papers(models.Paper.objects.values_list('pk', flat=True))
+
+        papers = search.filter_papers(models.Paper.objects.all(), "graph")
+        with self.assertNumQueries(1):
+            self.assertEqual(papers.count(), 1200)
+        self.assertFalse(search.filter_papers(models.Paper.objects.all(),
+                                              "!!").exists())
+
+    def test_index_follows_paper_writes(self):
+        paper = models.Paper.objects.create(doi="10.1000/1", title="Syntax")
+        search.index_papers([paper.pk])
+        paper.from_crossref({"title": ["Semantics"]})
+        self.assertEqual(search.search_papers("semantics"), [paper.pk])
+        self.assertEqual(search.search_papers("syntax"), [])
+
+        pk = paper.pk
+        paper.delete()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {search.FTS_TABLE} WHERE rowid = %s", [pk])
+            self.assertIsNone(cursor.fetchone())
+
+
+"""
+Citation graph
+--------------
+"""
+
+
+class GraphTests(TestCase):
+    """Building graph snapshots in the background"""
+
+    def setUp(self):
+        cache.delete_many([graph.BUILDING_KEY, graph.RELINKED_KEY])
+        patcher = mock.patch.object(graph, "_graph", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(graph, "current_snapshot", return_value=None)
+    def test_missing_snapshot_is_queued(self, current_snapshot):
+        with mock.patch.object(tasks.save_citation_graph, "delay") as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            for _ in range(2):
+                with self.assertRaises(graph.GraphNotReady):
+                    graph.get_graph()
+        delay.assert_called_once_with()
+
+    @mock.patch.object(graph, "GRAPH_RELINK_LIMIT", 10)
+    @mock.patch.object(graph, "schedule_build")
+    def test_relinks_queue_build(self, schedule_build):
+        graph.relinked(6)
+        schedule_build.assert_not_called()
+        graph.relinked(6)
+        schedule_build.assert_called_once_with()
+        self.assertEqual(cache.get(graph.RELINKED_KEY), 0)
+
+
+"""
+Log buffers
+-----------
+"""
+
+
+class LogBufferTests(TestCase):
+    """Buffered request logs"""
+
+    def log(self, status=200):
+        now = tz.now()
+        response = mock.Mock(status_code=status)
+        return pipeline.log_request("https://api.crossref.org/works", {},
+                                    now, now, response, wait=0)
+
+    def setUp(self):
+        self.buffer = pipeline.LogBuffer(pipeline.RequestLog, size=2)
+        patcher = mock.patch.object(pipeline, "request_logs", self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Also cancels the flush timer
+        self.addCleanup(self.buffer.flush)
+
+    def test_flushed_logs_get_pks(self):
+        logs = [self.log(), self.log()]
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(pipeline.RequestLog.objects.count(), 2)
+        self.assertEqual(
+            [log.pk for log in logs],
+            list(pipeline.RequestLog.objects.order_by('pk').values_list(
+                'pk', flat=True)))
+
+    def test_timed_flush_without_later_add(self):
+        self.buffer.interval = 0.01
+        flushed = threading.Event()
+        save = mock.Mock(side_effect=lambda items: flushed.set())
+        with mock.patch.object(self.buffer, "_bulk_create", save):
+            log = self.log()
+            self.assertTrue(flushed.wait(5))
+        save.assert_called_once_with([log])
+        self.assertEqual(len(self.buffer), 0)
+        self.assertIsNone(self.buffer.timer)
+
+    def test_saving_flushed_log_does_not_duplicate_it(self):
+        log = self.log()
+        self.buffer.flush()
+        self.assertIs(self.buffer.save(log), log)
+        self.assertEqual(pipeline.RequestLog.objects.count(), 1)
+
+    def test_saving_buffered_log(self):
+        log = self.log()
+        self.buffer.save(log)
+        self.assertEqual(len(self.buffer), 0)
+        self.buffer.flush()
+        self.assertEqual(pipeline.RequestLog.objects.count(), 1)
+
+    @mock.patch.object(pipeline, "LOG_SAMPLE_RATE", 0.25)
+    @mock.patch.object(pipeline.random, "random")
+    def test_sampling_weights(self, random):
+        random.return_value = 0.1
+        self.assertEqual(self.log().weight, 4)
+
+        random.return_value = 0.9
+        log = self.buffer.save(self.log())
+        self.assertEqual(pipeline.RequestLog.objects.get(pk=log.pk).weight, 0)
+
+
+"""
+Rate limits
+-----------
+"""
+
+
+class RateLimitTests(TestCase):
+    """Token buckets and rate limited views"""
+
+    @mock.patch.dict(ratelimit.RATE_LIMITS, {"example.org": (100, 1),
+                                             "example.org/works": (1, 1)})
+    def test_refused_take_leaves_other_buckets(self):
+        store = ratelimit.LocalStore()
+        names = ratelimit.bucket_names("https://example.org/works/1")
+        self.assertEqual(ratelimit.take(names, now=0, store=store), 0)
+        host = store.get("tat:example.org")
+
+        with self.assertRaises(ratelimit.RateLimited):
+            ratelimit.take(names, max_wait=0.5, now=0, store=store)
+        self.assertEqual(store.get("tat:example.org"), host)
+
+    def test_view_limited_while_storing_work(self):
+        paper = models.Paper.objects.create(doi="10.1000/1")
+        result = mock.Mock(data={"DOI": paper.doi})
+        limited = ratelimit.RateLimited("api.crossref.org", 2.5)
+        request = RequestFactory().get(f"/update/paper/{paper.pk}/")
+
+        with mock.patch.object(views.sources, "get_work",
+                               return_value=result), \
+                mock.patch.object(views.aux, "get_cited_by",
+                                  side_effect=limited):
+            response = views.update_paper(request, paper.pk)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], "3")
+        self.assertFalse(json.loads(response.content)['success'])
+
+
+"""
+References
+----------
+"""
+
+
+class BulkReferenceTests(TestCase):
+    """Storing references from crossref works"""
+
+    def setUp(self):
+        self.paper = models.Paper.objects.create(doi="10.1000/citing")
+        self.work = {"reference": [{"DOI": "10.1000/a"}, {"DOI": "10.1000/b"},
+                                   {"key": "no-doi"}]}
+
+    def test_tally(self):
+        models.Reference.objects.create(citing_doi=self.paper.doi,
+                                        cited_doi="10.1000/a")
+        tally, references = models.Reference.bulk_from_crossref(
+            [(self.paper, self.work)])
+        self.assertEqual(tally, {"added": 1, "duplicates": 1,
+                                 "missing doi": 1})
+        self.assertEqual([ref.cited_doi for ref in references],
+                         ["10.1000/b"])
+
+    def test_conflicts_are_not_counted_as_added(self):
+        from_crossref = models.Reference.from_crossref
+
+        def insert_meanwhile(reference, data):
+            # Another process stores the reference after the lookup
+            if reference.cited_doi == "10.1000/b":
+                models.Reference.objects.create(citing_doi=self.paper.doi,
+                                                cited_doi="10.1000/b")
+            from_crossref(reference, data)
+
+        cited = [models.Paper.objects.create(doi=doi)
+                 for doi in ("10.1000/a", "10.1000/b")]
+        with mock.patch.object(models.Reference, "from_crossref",
+                               insert_meanwhile):
+            tally = self.paper.add_citations(self.work)
+        self.assertEqual(tally['added'], 1)
+        self.assertEqual(tally['duplicates'], 1)
+        self.assertEqual(models.Reference.objects.count(), 2)
+        self.assertEqual(self.paper.citations_count, 1)
+        for paper, count in zip(cited, (1, 0)):
+            paper.refresh_from_db()
+            self.assertEqual(paper.cited_by_count, count)
+
+
+"""
+Cassettes
+---------
+"""
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    """Redirect /old to /new, which returns JSON"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/old":
+            self.send_response(302)
+            self.send_header("Location", "/new")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            body = b'{"found": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+def serve(server):
+    """Serve in a daemon thread, shutting down on cleanup"""
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CassetteTests(TestCase):
+    """Recording and replaying redirected requests"""
+
+    def setUp(self):
+        self.origin = serve(ThreadingHTTPServer(("127.0.0.1", 0),
+                                                RedirectHandler))
+        self.addCleanup(self.origin.server_close)
+        self.addCleanup(self.origin.shutdown)
+        host, port = self.origin.server_address[:2]
+        self.host = f"{host}:{port}"
+
+        # Record through the redirect
+        self.cassette = cassette.Cassette(None)
+        session = requests.Session()
+        session.mount("http://", cassette.RecordingAdapter(self.cassette))
+        response = session.get(f"http://{self.host}/old")
+        self.assertEqual(response.json(), {"found": True})
+
+    def test_replay_follows_redirect(self):
+        session = requests.Session()
+        session.mount("http://", cassette.ReplayAdapter(self.cassette))
+        response = session.get(f"http://{self.host}/old")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"found": True})
+        self.assertEqual(response.history[0].status_code, 302)
+
+    def test_replay_server_follows_redirect(self):
+        server = serve(cassette.ReplayServer(("127.0.0.1", 0), self.cassette))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        response = requests.get(f"{server.url}{self.host}/old", timeout=5)
+        self.assertEqual(response.json(), {"found": True})
+        self.assertEqual(server.counts, {"requests": 2})
+
+
+"""
+Async sources
+-------------
+"""
+
+
+class WorkHandler(BaseHTTPRequestHandler):
+    """Crossref works, slowly, tracking requests in flight
+
+    /works/10.1000/limited is refused with a 429 the first time, and
+    /works/10.1000/missing isn't found.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        doi = self.path.split("/works/", 1)[1]
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            server.hits[doi] += 1
+            hits = server.hits[doi]
+        time.sleep(0.05)
+        with server.lock:
+            server.active -= 1
+
+        if doi == "10.1000/limited" and hits == 1:
+            status, body = 429, b"Too many requests"
+        elif doi == "10.1000/missing":
+            status, body = 404, b"Resource not found."
+        else:
+            status, body = 200, json.dumps({"message": {"DOI": doi}}).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class AsyncSourceTests(TestCase):
+    """Fetching many works concurrently"""
+
+    def setUp(self):
+        self.server = serve(ThreadingHTTPServer(("127.0.0.1", 0),
+                                                WorkHandler))
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.server.lock = threading.Lock()
+        self.server.active = self.server.peak = 0
+        self.server.hits = Counter()
+        host, port = self.server.server_address[:2]
+
+        url = mock.patch.object(crossref.AsyncCrossRef, "work_url",
+                                f"http://{host}:{port}/works/")
+        buffer = pipeline.LogBuffer(pipeline.RequestLog)
+        logs = mock.patch.object(pipeline, "request_logs", buffer)
+        for patcher in (url, logs):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(buffer.flush)
+
+    def test_get_work_many(self):
+        dois = [f"10.1000/{i}" for i in range(2 * base.HTTP_CONCURRENCY)]
+        dois += ["10.1000/limited", "10.1000/missing"]
+        results = sources.get_work_many(dois)
+
+        for doi, result in zip(dois[:-1], results):
+            self.assertEqual(result.data, {"DOI": doi})
+        # Not JSON, so raised while decoding and returned in its place
+        self.assertIsInstance(results[-1], ValueError)
+
+        self.assertEqual(self.server.hits["10.1000/limited"], 2)
+        self.assertLessEqual(self.server.peak, base.HTTP_CONCURRENCY)
+        self.assertGreater(self.server.peak, 1)
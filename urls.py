@@ -10,6 +10,7 @@ urlpatterns = [
     path('doi', views.get_by_doi),
     path('search', views.search),
     path('search_cr', views.search_cr),
+    path('suggest', views.suggest),
 
     path('table/<str:key>/', views.table),
     path('papers/', views.paper_table),
@@ -42,6 +43,8 @@ urlpatterns = [
     path('get_progress/', views.get_progress),
 
     path('monitor/', views.getlogs),
+    path('monitor/cache/', views.cache_stats),
+    path('monitor/views/', views.view_stats),
     path('data_creation/', views.data_creation),
 
     # User views
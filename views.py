@@ -6,21 +6,44 @@ import json
 from collections import Counter
 from email.utils import parseaddr
 
+import numpy as np
 import pandas as pd
 from django.shortcuts import render
 from django.http import JsonResponse
-from django.db.models import Count
+from django.db.models import Avg, Count, F, Q, Sum
+from django.db.models.functions import (TruncDay, TruncHour, TruncMinute,
+                                        TruncMonth, TruncWeek)
 from django.utils import timezone as tz
 from django.contrib.auth import authenticate, login, logout, get_user_model
 from django.contrib.auth.password_validation import validate_password
 from celery.result import AsyncResult
 from django.core.exceptions import ValidationError
 
-from papernet import models, sources, aux, tasks, query
+from papernet import models, sources, aux, tasks, query, serializers, rollups
+from papernet.graph import GraphNotReady
+from papernet.search import filter_papers, search_papers
+from papernet.suggest import get_suggestions
+from papernet.sources import cache as response_cache
+from papernet.sources.ratelimit import RateLimited
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
+# Crossref search results returned to the search box
+N_CR_RESULTS = 5
+
+# Monitor intervals (pandas-style aliases) and their database truncations
+MONITOR_INTERVALS = {
+    "T": TruncMinute, "MIN": TruncMinute,
+    "H": TruncHour,
+    "D": TruncDay,
+    "W": TruncWeek,
+    "M": TruncMonth,
+}
+
+# Intervals served from papernet.rollups
+ROLLUP_INTERVALS = ("H", "D", "W", "M")
+
 
 def home(request, message=None):
     """Homepage"""
@@ -66,24 +89,18 @@ def network(request, message=None):
     citing_papers = paper.citing_papers(n=50)
 
     papers = [paper] + list(cited_papers) + list(citing_papers)
+    papers = serializers.prefetch_papers(papers)
     nodes = [{"id": p.pk, "year": p.year, "ref": p.ref,
               "group": 1, "citations": p.citation_count}
              for p in papers]
 
-    links = []
-    for cited_paper in cited_papers:
-        for citing_paper in cited_paper.citing_papers(n=100):
-            if citing_paper in papers:
-                links.append({"source": citing_paper.pk,
-                              "target": cited_paper.pk,
-                              "value": 1})
-
-    for citing_paper in citing_papers:
-        for cited_paper in citing_paper.cited_papers(n=100):
-            if cited_paper in papers:
-                links.append({"source": citing_paper.pk,
-                              "target": cited_paper.pk,
-                              "value": 1})
+    # Every citation between papers in the network
+    pks = set(p.pk for p in papers)
+    refs = models.Reference.objects.filter(citing_paper__in=pks,
+                                           cited_paper__in=pks)
+    edges = refs.values_list('citing_paper', 'cited_paper').distinct()
+    links = [{"source": source, "target": target, "value": 1}
+             for source, target in edges]
 
     data = {"nodes": nodes, "links": links}
 
@@ -98,46 +115,77 @@ API Views
 
 
 def get_progress(request):
-    """Get status of task"""
+    """Get status of task, or of a scrape job by task_id or job_id"""
     task_id = request.GET.get('task_id')
-    result = AsyncResult(task_id)
-    task = {"state": result.state, "info": result.info}
+    job_id = request.GET.get('job_id')
+    if job_id:
+        job = models.ScrapeJob.objects.filter(pk=job_id).first()
+    else:
+        job = models.ScrapeJob.objects.filter(task_id=task_id).first()
+
+    if job is not None:
+        task = {"state": job.status, "info": job.progress()}
+    else:
+        result = AsyncResult(task_id)
+        task = {"state": result.state, "info": result.info}
     out = {"task": task, "success": True}
     return JsonResponse(out)
 
 
+def rate_limited(error):
+    """JSON response asking the client to retry a rate limited request"""
+    retry_after = int(error.wait) + 1
+    out = {"success": False, "message": "Crossref is busy, try again shortly",
+           "retry_after": retry_after}
+    response = JsonResponse(out, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
 def get_by_doi(request):
     """Retrieve a paper by doi and return JSON object"""
     doi = request.GET.get('doi')
 
-    paper = aux.get_work(doi_raw=doi)
+    try:
+        paper = aux.get_work(doi_raw=doi)
+    except RateLimited as e:
+        return rate_limited(e)
 
     # Check doi
     if paper is None:
         return JsonResponse({"success": False})
 
+    return JsonResponse(paper_json(paper))
+
+
+def paper_json(paper):
+    """Paper data with its top citations, for get_by_doi and refresh"""
     citations = paper.cited_papers(n=10)
-    citations_data = [c.preview for c in citations if c]
+    citations_data = serializers.paper_previews(citations)
 
     cited_by = paper.citing_papers(n=10)
-    cited_by_data = [c.preview for c in cited_by if c]
+    cited_by_data = serializers.paper_previews(cited_by)
 
     out = {}
-    out['paper'] = paper.data
+    out['paper'] = serializers.paper_data([paper])[0]
     out['citations'] = citations_data
     out['cited_by'] = cited_by_data
 
-    return JsonResponse(out)
+    return out
 
 
 def update_paper(request, pk):
     """Refresh data for paper"""
     paper = models.Paper.objects.get(pk=pk)
 
-    result = sources.get_work(doi=paper.doi)
-    aux.add_work(result.data, force=True)
+    # Storing the work also fetches the papers citing it from crossref
+    try:
+        result = sources.get_work(doi=paper.doi)
+        aux.add_work(result.data, force=True)
+    except RateLimited as e:
+        return rate_limited(e)
 
-    # paper.retrieve(citations=False, force=True)
+    # Cited papers are queued, and fetched later by tasks.drain_frontier
     tasks.retrieve_citations.delay(paper.pk)
 
     return paper_info(request, pk)
@@ -166,40 +214,47 @@ def search(request):
     time0 = tz.now()
     query = request.GET.get('query')
     logger.debug("Init search with query %s", query)
-    papers = models.Paper.objects.filter(title__icontains=query)
-    # Sort by n citations
-    papers = papers.annotate(num_cited_by=Count('cited_by'))
-    papers = papers.order_by('-num_cited_by')[:5]
+    # Ranked by text relevance and n citations
+    pks = search_papers(query, n=5)
+    found = models.Paper.objects.in_bulk(pks)
+    papers = [found[pk] for pk in pks if pk in found]
     time1 = tz.now()
     logger.debug("%s Local results found in %s", len(papers), time1 - time0)
 
-    out = {'results': [paper.preview for paper in papers]}
+    out = {'results': serializers.paper_previews(papers)}
 
     return JsonResponse(out)
 
 
+def suggest(request):
+    """Typeahead suggestions for papers, authors and journals"""
+    prefix = request.GET.get('query', '')
+    out = {"results": get_suggestions(prefix)}
+    return JsonResponse(out)
+
+
 def search_cr(request):
     """Search query in crossref"""
     time0 = tz.now()
     query = request.GET.get('query')
-    cr_results = sources.search(query)["items"]
-    cr_data = []
+    try:
+        cr_results = sources.search(query)["items"]
+    except RateLimited as e:
+        return rate_limited(e)
+
+    works = []
     for res in cr_results:
         if 'DOI' not in res:
-            print("No DOI for res, ", res)
-            # TODO: log/flag
+            logger.warning("No DOI for crossref result: %.200s", res)
             continue
-        aux.add_work(res, citations=False)
-        paper, _ = models.Paper.objects.get_or_create(doi=res["DOI"])
-        paper.from_crossref(res)
-        paper.retrieve_authors(res.get('author', []))
-        paper.save()
-        tasks.retrieve_citations.delay(paper.pk)
-        cr_data.append(paper)
+        works.append(res)
 
-    cr_data = cr_data[:5]
+    # Store every result in the background, queueing the papers they cite
+    if works:
+        tasks.add_works.delay(works, citations=True)
 
-    out = {"results": [paper.preview for paper in cr_data]}
+    cr_data = serializers.crossref_previews(works[:N_CR_RESULTS])
+    out = {"results": cr_data}
 
     time1 = tz.now()
     logger.debug("%s Crossref results found in %s", len(cr_data),
@@ -209,13 +264,22 @@ def search_cr(request):
 
 
 def refresh(request):
-    """refresh"""
+    """Refresh a paper's data, queueing the papers it cites
+
+    Cited papers aren't stored yet when this returns; `queued` is the
+    number newly queued to be fetched by tasks.drain_frontier.
+    """
     doi = request.GET.get('doi')
     paper, created = models.Paper.objects.get_or_create(doi=doi)
-    paper.retrieve(force=True)
-    paper.retrieve_citations()
+    try:
+        paper.retrieve(citations=False, force=True)
+    except RateLimited as e:
+        return rate_limited(e)
+    queued = paper.retrieve_citations()
 
-    return get_by_doi(request)
+    out = paper_json(paper)
+    out['queued'] = queued
+    return JsonResponse(out)
 
 
 def modify_perusal(request):
@@ -468,16 +532,10 @@ def table(request, key="Paper"):
 
 def paper_view(request, reader, project, papers, query):
     """Format data for paper table"""
-    paper_data = []
-    print("running paper_view with {}".format(len(papers)))
-    tags = Counter()
-    for paper in papers:
-        print("running paper {}".format(paper))
-        perusal = aux.get_perusal(reader=reader, paper=paper,
-                                  project=project, save=False)
-        perusal_data = perusal.data
-        tags.update(perusal_data['meta']['tags'])
-        paper_data.append(perusal_data)
+    papers = list(papers)
+    perusals = aux.get_perusals(papers, project, reader)
+    paper_data = serializers.perusal_data(perusals)
+    tags = Counter(tag for data in paper_data for tag in data['meta']['tags'])
 
     project_data = project.preview
     info = {"title": "Papers", "description": query,
@@ -506,7 +564,7 @@ def paper_table(request):
 
     # Queries
     if title is not None:
-        papers = papers.filter(title__icontains=title)
+        papers = filter_papers(papers, title)
 
     if citing_paper_id is not None:
         citing_paper = models.Paper.objects.get(pk=citing_paper_id)
@@ -519,7 +577,7 @@ def paper_table(request):
         query += f"citing {cited_paper.ref}"
 
     if order is not None:
-        papers = papers.annotate(no_citations=Count('citations'))
+        papers = papers.annotate(no_citations=F('citations_count'))
         papers = papers.order_by(order)
 
     papers = papers[:limit]
@@ -532,24 +590,22 @@ def find_similar_papers(request):
     logger.info("Finding similar papers")
     project_id = int(request.GET.get('project_id'))
     project = models.Project.objects.get(pk=project_id)
-    perusals = project.get_papers()
-    papers = [perusal.paper for perusal in perusals]
+    papers = models.Paper.objects.filter(perusal__project=project)
     reader = aux.get_reader(request.user)
 
-    # for paper in papers:
-    #     data = get_cited_by(paper)
-    logger.info("Getting refs")
-    refs = aux.get_shared_refs(papers)
-    cites = aux.get_shared_cites(papers)
-    logger.info("Getting similar")
-    similar = aux._get_similar_papers(refs, cites)
+    try:
+        similar = query.get_similar_papers(papers.distinct(), n=20)
+    except GraphNotReady:
+        out = {"success": False,
+               "message": "The citation graph is being built, try again soon"}
+        return JsonResponse(out, status=503)
 
     logger.info("Done")
-    papers = [s[0] for s in similar.most_common(20)]
+    papers = [paper for paper, score in similar]
 
-    query = f"Similar papers to {project.title}"
+    description = f"Similar papers to {project.title}"
 
-    return paper_view(request, reader, project, papers, query)
+    return paper_view(request, reader, project, papers, description)
 
 
 def author_table(request):
@@ -583,7 +639,8 @@ def journal_table(request):
     query = ""
 
     if title is not None:
-        journals = journals.filter(title__icontains=query)
+        matches = Q(title__icontains=title) | Q(abbreviation__icontains=title)
+        journals = journals.filter(matches)
         query += f"Title includes '{title}'"
 
     if order is not None:
@@ -602,15 +659,8 @@ def journal_table(request):
 def get_project_data(pk):
     """Project data"""
     project = models.Project.objects.get(pk=pk)
-    perusals = project.get_papers()
-
-    tags = Counter()
-    paper_data = []
-
-    for perusal in perusals:
-        perusal_data = perusal.data
-        tags.update(perusal_data['meta']['tags'])
-        paper_data.append(perusal_data)
+    paper_data = serializers.perusal_data(project.get_papers())
+    tags = Counter(tag for data in paper_data for tag in data['meta']['tags'])
 
     project_data = project.preview
 
@@ -649,11 +699,11 @@ def paper_info(request, pk):
     """View a detailed info about a paper"""
     paper = models.Paper.objects.get(pk=pk)
 
-    paper_data = paper.data
-    refs = [ref.preview for ref in paper.cited_papers()]
+    paper_data = serializers.paper_data([paper])[0]
+    refs = serializers.paper_previews(paper.cited_papers())
     paper_data['references'] = refs
 
-    cites = [ref.preview for ref in paper.citing_papers()]
+    cites = serializers.paper_previews(paper.citing_papers())
     paper_data['citations'] = cites
 
     out = aux.get_paper_metadata(paper, request.user)
@@ -680,9 +730,9 @@ def journal_info(request, pk):
     journal_data = journal.data
 
     papers = journal.get_papers(n=5)
-    journal_data['papers'] = [p.preview for p in papers]
+    journal_data['papers'] = serializers.paper_previews(papers)
 
-    authors = journal.get_authors(n=5)
+    authors = serializers.prefetch_authors(journal.get_authors(n=5))
     author_data = []
     for a in authors:
         a_data = a.preview
@@ -715,34 +765,117 @@ Monitoring
 """
 
 
+def _table(df, title=""):
+    """Template context for a dataframe shown by monitor.html"""
+    return {"title": title, "colnames": list(df.columns),
+            "data": df.values.tolist()}
+
+
+def _weighted_quantile(values, weights, q):
+    """Quantile of values where each stands for `weights` observations"""
+    order = np.argsort(values)
+    values, weights = np.asarray(values)[order], np.asarray(weights)[order]
+    cumulative = np.cumsum(weights)
+    return values[np.searchsorted(cumulative, q * cumulative[-1])]
+
+
+def _monitor_period(request, field):
+    """Truncation of `field` for the request's interval and its filter
+
+    `interval` is a pandas-style alias (T, H, D, W, M; default H) and
+    `days`, if given, limits rows to the last n days.
+    """
+    interval = request.GET.get('interval', 'H').upper()
+    trunc = MONITOR_INTERVALS.get(interval, TruncHour)
+    days = request.GET.get('days')
+    since = {}
+    if days is not None:
+        since[f"{field}__gte"] = tz.now() - tz.timedelta(days=float(days))
+    return trunc(field), since
+
+
 def getlogs(request):
-    """Display logging data"""
-    interval = request.GET.get('interval', 'H')
-    logs = models.RequestLog.objects.all()
-    log_data = [[log.url, log.end_time, log.delta] for log in logs]
-    df = pd.DataFrame(log_data)
-    df.columns = ['url', 'end_time', 'delta']
-    df = df.set_index('end_time').groupby(pd.Grouper(freq=interval)).count()
-    df = df.reset_index()
-    data = df.values.tolist()
-    colnames = list(df.columns)
-    return render(request, 'papernet/monitor.html', {'data': data,
-                                                     'colnames': colnames})
+    """Display logging data
+
+    Hourly and longer intervals come from the rollups, which are up to
+    date to within a few minutes; minutes are aggregated from RequestLogs.
+    """
+    interval = request.GET.get('interval', 'H').upper()
+    if interval in ROLLUP_INTERVALS:
+        days = request.GET.get('days')
+        tables = rollups.request_tables(
+            interval, float(days) if days is not None else None)
+        return render(request, 'papernet/monitor.html', {'tables': tables})
+
+    period, since = _monitor_period(request, 'end_time')
+    # Sampled logs stand for `weight` requests each
+    rows = models.RequestLog.objects.filter(**since).annotate(
+        period=period).values('period').annotate(
+        requests=Sum('weight'), logged=Count('pk'),
+        delta=Avg('delta')).order_by('period').values_list(
+        'period', 'requests', 'logged', 'delta')
+    df = pd.DataFrame(list(rows),
+                      columns=['end_time', 'requests', 'logged', 'delta'])
+    return render(request, 'papernet/monitor.html', {'tables': [_table(df)]})
+
+
+def view_stats(request):
+    """Views with the highest p95 and total time, from ViewLogs"""
+    days = float(request.GET.get('days', 1))
+    n = int(request.GET.get('n', 20))
+    since = tz.now() - tz.timedelta(days=days)
+
+    logs = models.ViewLog.objects.filter(start_time__gte=since).values_list(
+        'view', 'wall', 'db_time', 'queries', 'duplicates', 'cache_hits',
+        'weight')
+    df = pd.DataFrame(list(logs), columns=[
+        'view', 'wall', 'db_time', 'queries', 'duplicates', 'cache_hits',
+        'weight'])
+    if df.empty:
+        return render(request, 'papernet/monitor.html', {'tables': []})
+
+    # Sampled logs stand for `weight` views each
+    df['total'] = df['wall'] * df['weight']
+    grouped = df.groupby('view')
+    stats = pd.DataFrame({
+        'requests': grouped['weight'].sum(),
+        'p50': grouped.apply(lambda g: _weighted_quantile(
+            g['wall'], g['weight'], 0.5)),
+        'p95': grouped.apply(lambda g: _weighted_quantile(
+            g['wall'], g['weight'], 0.95)),
+        'total': grouped['total'].sum(),
+        'db_share': grouped['db_time'].sum() / grouped['wall'].sum(),
+        'queries': grouped['queries'].mean(),
+        'max_queries': grouped['queries'].max(),
+        'duplicates': grouped['duplicates'].mean(),
+        'cache_hits': grouped['cache_hits'].sum(),
+    }).round(3).reset_index()
+
+    tables = [_table(stats.nlargest(n, 'p95'), "Slowest views (p95, s)"),
+              _table(stats.nlargest(n, 'total'), "Total time (s)")]
+    return render(request, 'papernet/monitor.html', {'tables': tables})
+
+
+def cache_stats(request):
+    """Hit rate and size of this process's source response cache"""
+    return JsonResponse(response_cache.stats())
 
 
 def data_creation(request):
-    """Display data_creation data"""
-    interval = request.GET.get('interval', 'H')
+    """Display rows created per period, from the rollups where kept"""
     model_name = request.GET.get('model', 'Paper')
+    interval = request.GET.get('interval', 'H').upper()
+    if model_name in rollups.ROLLUP_MODELS and interval in ROLLUP_INTERVALS:
+        days = request.GET.get('days')
+        table = rollups.creation_table(
+            model_name, interval, float(days) if days is not None else None)
+        return render(request, 'papernet/monitor.html', {'tables': [table]})
+
     model = getattr(models, model_name)
-    mods = model.objects.all()
-    mod_data = [[mod.pk, mod.created] for mod in mods]
-    df = pd.DataFrame(mod_data)
-    df.columns = ['pk', 'created']
-    df = df.set_index('created').groupby(pd.Grouper(freq=interval)).count()
-    df = df.reset_index()
-    data = df.values.tolist()
-    colnames = list(df.columns)
-    return render(request, 'papernet/monitor.html', {'data': data,
-                                                     'colnames': colnames})
+    period, since = _monitor_period(request, 'created')
+    rows = model.objects.filter(**since).annotate(period=period).values(
+        'period').annotate(count=Count('pk')).order_by('period').values_list(
+        'period', 'count')
+    df = pd.DataFrame(list(rows), columns=['created', 'count'])
+    return render(request, 'papernet/monitor.html', {'tables': [_table(df)]})
 